@@ -0,0 +1,4 @@
+from portia.benchmarks.suite import main
+
+if __name__ == '__main__':
+    main(prog_name='python -m portia.benchmarks')
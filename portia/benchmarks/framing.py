@@ -0,0 +1,100 @@
+"""
+Compares the size and the encoding and decoding cost of ``resolve_many``
+commands and their replies with the line JSON and MessagePack framings::
+
+    $ python -m portia.benchmarks.framing --batch-size 100
+"""
+import timeit
+
+import click
+from phonenumbers import parse
+
+from portia.benchmarks.storage_memory import generate_entries
+from portia.protocol import FRAMINGS, JsonProtocol
+
+
+def resolve_many_messages(batch_size):
+    entries = generate_entries(batch_size)
+    command = {
+        'cmd': 'resolve_many',
+        'id': 1,
+        'version': JsonProtocol.version,
+        'request': {'msisdns': [msisdn for msisdn, _ in entries]},
+    }
+    response = {}
+    for msisdn, annotations in entries:
+        phonenumber = parse(msisdn)
+        entry = {}
+        for key, (value, timestamp) in annotations.iteritems():
+            entry[key] = value
+            entry['%s-timestamp' % (key,)] = timestamp.isoformat()
+        response[msisdn] = {
+            'entry': entry,
+            'msisdn': msisdn,
+            'network': entry['ported-to'],
+            'strategy': 'ported-to',
+            'country_code': phonenumber.country_code,
+            'national_number': phonenumber.national_number,
+            'region_code': 'ZA',
+            'country_description': 'South Africa',
+            'timezones': ['Africa/Johannesburg'],
+            'original_carrier': '',
+        }
+    reply = {
+        'status': 'ok',
+        'cmd': 'reply',
+        'reference_cmd': 'resolve_many',
+        'reference_id': 1,
+        'version': JsonProtocol.version,
+        'response': response,
+    }
+    return command, reply
+
+
+def benchmark(batch_size, number=1000, repeat=3):
+    command, reply = resolve_many_messages(batch_size)
+    results = {}
+    for name, framing in sorted(FRAMINGS.items()):
+        framing = framing()
+        payloads = [framing.dumps(message) for message in [command, reply]]
+
+        def encode():
+            framing.encode(command)
+            framing.encode(reply)
+
+        def decode():
+            for payload in payloads:
+                framing.loads(payload)
+
+        results[name] = {
+            'command_bytes': len(''.join(framing.encode(command))),
+            'reply_bytes': len(''.join(framing.encode(reply))),
+            'encode': min(timeit.repeat(
+                encode, number=number, repeat=repeat)) / number,
+            'decode': min(timeit.repeat(
+                decode, number=number, repeat=repeat)) / number,
+        }
+    return results
+
+
+@click.command()
+@click.option('--batch-size', default=100,
+              help='MSISDNs per resolve_many command.')
+@click.option('--number', default=1000,
+              help='How many commands and replies to time.')
+@click.option('--repeat', default=3)
+def main(batch_size, number, repeat):
+    results = benchmark(batch_size, number=number, repeat=repeat)
+    click.echo('%-8s %13s %11s %11s %11s' % (
+        'framing', 'command bytes', 'reply bytes', 'encode us',
+        'decode us'))
+    for name, result in sorted(results.items()):
+        click.echo(
+            '%(name)-8s %(command_bytes)13d %(reply_bytes)11d '
+            '%(encode)11.1f %(decode)11.1f' % dict(
+                result, name=name, encode=result['encode'] * 10 ** 6,
+                decode=result['decode'] * 10 ** 6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Compares the per-resolve CPU cost of computing the phonenumber metadata
+in ``Portia.resolve_geocode`` from scratch against the memoized lookup::
+
+    $ python -m portia.benchmarks.geocode --numbers 1000 --resolves 20000
+"""
+import random
+import timeit
+
+import click
+import phonenumbers
+from phonenumbers import carrier, geocoder, timezone
+
+from portia.metadata import GeocodeMetadata
+from portia.portia import Portia
+
+
+def legacy_resolve_geocode(annotations, phonenumber):
+    defaults = {
+        'msisdn': phonenumbers.format_number(
+            phonenumber, phonenumbers.PhoneNumberFormat.E164),
+        'country_code': phonenumber.country_code,
+        'national_number': phonenumber.national_number,
+        'region_code': geocoder.region_code_for_country_code(
+            phonenumber.country_code),
+        'country_description': geocoder.country_name_for_number(
+            phonenumber, "en"),
+        'original_carrier': carrier.name_for_number(phonenumber, "en"),
+        'timezones': timezone.time_zones_for_number(
+            phonenumber)
+    }
+    defaults.update(annotations)
+    return defaults
+
+
+def generate_phonenumbers(count, seed=0):
+    """
+    Generate ``count`` South African and Nigerian mobile numbers.
+    """
+    rand = random.Random(seed)
+    prefixes = [('2772', 11), ('2773', 11), ('2776', 11), ('2782', 11),
+                ('2783', 11), ('2784', 11), ('234803', 13), ('234805', 13),
+                ('234806', 13), ('234703', 13)]
+    numbers = []
+    for _ in range(count):
+        prefix, length = rand.choice(prefixes)
+        numbers.append(phonenumbers.parse('+%s%s' % (prefix, ''.join(
+            str(rand.randint(0, 9)) for _ in range(length - len(prefix))))))
+    return numbers
+
+
+def benchmark(numbers, resolves, repeat=3, seed=0):
+    rand = random.Random(seed)
+    workload = [rand.choice(numbers) for _ in range(resolves)]
+    portia = Portia(None, geocode_metadata=GeocodeMetadata())
+    annotations = {'network': 'MNO', 'strategy': 'ported-to', 'entry': {}}
+
+    def legacy():
+        for phonenumber in workload:
+            legacy_resolve_geocode(annotations, phonenumber)
+
+    def memoized():
+        for phonenumber in workload:
+            portia.resolve_geocode(annotations, phonenumber)
+
+    return {
+        'numbers': len(numbers),
+        'resolves': resolves,
+        'legacy': min(timeit.repeat(legacy, number=1, repeat=repeat)),
+        'memoized': min(timeit.repeat(memoized, number=1, repeat=repeat)),
+        'cache': portia.geocode_metadata.cache.stats(),
+    }
+
+
+@click.command()
+@click.option('--numbers', default=1000,
+              help='The number of distinct MSISDNs to resolve.')
+@click.option('--resolves', default=20000,
+              help='The number of resolves to time.')
+@click.option('--repeat', default=3)
+def main(numbers, resolves, repeat):
+    result = benchmark(
+        generate_phonenumbers(numbers), resolves, repeat=repeat)
+    click.echo('%(numbers)d numbers, %(resolves)d resolves' % result)
+    for name in ['legacy', 'memoized']:
+        click.echo('%-8s %8.3fs %8.1f usec/resolve' % (
+            name, result[name], result[name] * 1e6 / result['resolves']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+from twisted.internet.defer import succeed
+
+from portia.storage import Storage
+
+
+class MemoryStorage(Storage):
+    """
+    An in-memory stand-in for the Redis storages so the benchmarks can
+    measure Portia's own overhead without a Redis server. Entries are kept
+    in the same shape ``HashStorage`` stores them in and writes are only
+    applied if they are newer than what is stored.
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def write_many(self, entries):
+        skipped = 0
+        for msisdn, annotations in entries:
+            stored = self.entries.setdefault(msisdn, {})
+            for key, (value, timestamp) in annotations.iteritems():
+                timestamp_key = '%s-timestamp' % (key,)
+                timestamp = timestamp.isoformat()
+                current = stored.get(timestamp_key)
+                if current is not None and current >= timestamp:
+                    skipped += 1
+                    continue
+                stored[key] = value
+                stored[timestamp_key] = timestamp
+        return succeed(skipped)
+
+    def get(self, msisdn):
+        return succeed(dict(self.entries.get(msisdn, {})))
+
+    def get_many(self, msisdns):
+        return succeed([
+            dict(self.entries.get(msisdn, {})) for msisdn in msisdns])
+
+    def select(self, msisdn, keys):
+        stored = self.entries.get(msisdn, {})
+        selected = {}
+        for key in keys:
+            timestamp_key = '%s-timestamp' % (key,)
+            if key in stored:
+                selected[key] = stored[key]
+                selected[timestamp_key] = stored[timestamp_key]
+        return selected
+
+    def get_keys(self, msisdn, keys):
+        return succeed(self.select(msisdn, keys))
+
+    def get_keys_many(self, msisdns, keys):
+        return succeed([self.select(msisdn, keys) for msisdn in msisdns])
+
+    def read(self, msisdn, key):
+        stored = self.entries.get(msisdn, {})
+        timestamp_key = '%s-timestamp' % (key,)
+        return succeed({
+            key: stored.get(key),
+            timestamp_key: stored.get(timestamp_key),
+        })
+
+    def delete_annotations(self, msisdn, keys):
+        stored = self.entries.get(msisdn, {})
+        deleted = 0
+        for key in keys:
+            for field in [key, '%s-timestamp' % (key,)]:
+                if stored.pop(field, None) is not None:
+                    deleted += 1
+        if not stored:
+            self.entries.pop(msisdn, None)
+        return succeed(deleted)
+
+    def remove(self, msisdn):
+        return succeed(int(self.entries.pop(msisdn, None) is not None))
+
+    def flush(self, count=1000, concurrency=4, progress=None):
+        deleted = len(self.entries)
+        self.entries.clear()
+        if progress is not None:
+            progress.update(deleted)
+        return succeed(deleted)
+
+    def scan_entries(self, process, count=1000, concurrency=4):
+        return succeed(process(sorted(self.entries.items())))
@@ -0,0 +1,84 @@
+"""
+Compares what it costs per request to turn the MSISDN a client sent into
+the phonenumber and E.164 strings a resolve needs, with
+``phonenumbers.parse`` and with ``MsisdnNormalizer``::
+
+    $ python -m portia.benchmarks.normalize --numbers 10000
+"""
+import random
+import timeit
+
+import click
+import phonenumbers
+
+from portia.benchmarks.geocode import generate_phonenumbers
+from portia.normalize import MsisdnNormalizer
+from portia.portia import as_msisdn
+
+# How often a resolve formats the phonenumber as an MSISDN: the cache
+# key, the storage key and the result's ``msisdn``.
+FORMATS_PER_REQUEST = 3
+
+
+def legacy_request(msisdn):
+    phonenumber = phonenumbers.parse(msisdn)
+    for _ in range(FORMATS_PER_REQUEST):
+        phonenumbers.format_number(
+            phonenumber, phonenumbers.PhoneNumberFormat.E164)
+
+
+def normalizer_request(normalizer):
+    def request(msisdn):
+        phonenumber = normalizer.parse(msisdn)
+        for _ in range(FORMATS_PER_REQUEST):
+            as_msisdn(phonenumber)
+    return request
+
+
+def generate_requests(numbers, requests, seed=0):
+    """
+    Generate ``requests`` E.164 MSISDNs drawn from ``numbers`` distinct
+    ones.
+    """
+    rand = random.Random(seed)
+    msisdns = [as_msisdn(phonenumber)
+               for phonenumber in generate_phonenumbers(numbers, seed=seed)]
+    return [rand.choice(msisdns) for _ in range(requests)]
+
+
+def benchmark(msisdns, cache_size=65536, repeat=3):
+    cases = [
+        ('phonenumbers', legacy_request),
+        ('normalizer', normalizer_request(MsisdnNormalizer(size=0))),
+        ('memoized', normalizer_request(MsisdnNormalizer(size=cache_size))),
+    ]
+    results = []
+    for name, request in cases:
+        def run():
+            for msisdn in msisdns:
+                request(msisdn)
+
+        results.append(
+            (name, min(timeit.repeat(run, number=1, repeat=repeat))))
+    return results
+
+
+@click.command()
+@click.option('--numbers', default=10000,
+              help='The number of distinct MSISDNs to request.')
+@click.option('--requests', default=100000,
+              help='The number of requests to time.')
+@click.option('--cache-size', default=65536,
+              help='How many MSISDNs the memoized normalizer remembers.')
+@click.option('--repeat', default=3)
+def main(numbers, requests, cache_size, repeat):
+    msisdns = generate_requests(numbers, requests)
+    click.echo('%d requests for %d distinct MSISDNs' % (requests, numbers))
+    for name, elapsed in benchmark(
+            msisdns, cache_size=cache_size, repeat=repeat):
+        click.echo('%-12s %8.3fs %8.2f us/request' % (
+            name, elapsed, elapsed / len(msisdns) * 10 ** 6))
+
+
+if __name__ == '__main__':
+    main()
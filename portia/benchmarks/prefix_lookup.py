@@ -0,0 +1,124 @@
+"""
+Compares the compiled network prefix trie against the dictionary scan
+``Portia.network_prefix_lookup`` used to do::
+
+    $ python -m portia.benchmarks.prefix_lookup --prefixes 100000
+"""
+import json
+import random
+import timeit
+from glob import glob
+
+import click
+
+from portia.prefixes import NetworkPrefixTrie
+
+
+def legacy_network_prefix_lookup(msisdn, mapping):
+    for key, value in mapping.iteritems():
+        if msisdn.startswith('+%s' % (key,)):
+            if isinstance(value, dict):
+                return legacy_network_prefix_lookup(msisdn, value)
+            return value
+    return None
+
+
+def generate_mapping(prefixes, seed=0):
+    """
+    Generate a nested mapping of roughly ``prefixes`` prefixes shaped like
+    the ones shipped in ``portia/assets/mappings``.
+    """
+    rand = random.Random(seed)
+    networks = ['NETWORK-%d' % (i,) for i in range(20)]
+    mapping = {}
+    count = 0
+    while count < prefixes:
+        country = str(rand.randint(20, 999))
+        country_mapping = mapping.setdefault(country, {})
+        for _ in range(100):
+            block = '%s%02d' % (country, rand.randint(0, 99))
+            block_mapping = country_mapping.setdefault(block, {})
+            if not isinstance(block_mapping, dict):
+                continue
+            for digit in range(10):
+                block_mapping['%s%d' % (block, digit)] = rand.choice(networks)
+                count += 1
+    return mapping
+
+
+def load_mappings(glob_paths):
+    mappings = []
+    for glob_path in glob_paths:
+        for mapping_file in glob(glob_path):
+            with open(mapping_file) as fp:
+                mappings.append(json.load(fp))
+    return mappings
+
+
+def generate_msisdns(mapping, lookups, seed=0):
+    rand = random.Random(seed)
+    prefixes = []
+
+    def collect(mapping):
+        for key, value in mapping.iteritems():
+            if isinstance(value, dict):
+                collect(value)
+            else:
+                prefixes.append(key)
+    collect(mapping)
+
+    msisdns = []
+    for _ in range(lookups):
+        prefix = rand.choice(prefixes) if rand.random() < 0.9 else '999'
+        msisdns.append('+%s%s' % (
+            prefix, ''.join(str(rand.randint(0, 9))
+                            for _ in range(12 - len(prefix)))))
+    return msisdns
+
+
+def benchmark(mapping, msisdns, repeat=3):
+    trie = NetworkPrefixTrie.from_mapping(mapping)
+
+    def legacy():
+        for msisdn in msisdns:
+            legacy_network_prefix_lookup(msisdn, mapping)
+
+    def compiled():
+        for msisdn in msisdns:
+            trie.lookup(msisdn)
+
+    return {
+        'prefixes': len(trie),
+        'lookups': len(msisdns),
+        'legacy': min(timeit.repeat(legacy, number=1, repeat=repeat)),
+        'trie': min(timeit.repeat(compiled, number=1, repeat=repeat)),
+    }
+
+
+@click.command()
+@click.option('--prefixes', default=100000,
+              help='The number of prefixes to generate.')
+@click.option('--lookups', default=10000,
+              help='The number of lookups to time.')
+@click.option('--mappings-path', multiple=True,
+              help='Benchmark against these mapping files instead of '
+                   'a generated mapping.')
+@click.option('--repeat', default=3)
+def main(prefixes, lookups, mappings_path, repeat):
+    if mappings_path:
+        mapping = {}
+        for loaded in load_mappings(mappings_path):
+            mapping.update(loaded)
+    else:
+        mapping = generate_mapping(prefixes)
+
+    result = benchmark(
+        mapping, generate_msisdns(mapping, lookups), repeat=repeat)
+    click.echo('%(prefixes)d prefixes, %(lookups)d lookups' % result)
+    for name in ['legacy', 'trie']:
+        click.echo('%-8s %8.3fs %12.0f lookups/sec' % (
+            name, result[name], result['lookups'] / result[name]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Measures how resolve throughput scales with the number of pooled Redis
+connections when many resolves are in flight at once::
+
+    $ python -m portia.benchmarks.redis_pool --pool-size 1 --pool-size 4
+
+This writes to and flushes the given prefix, point it at a scratch
+database.
+"""
+from timeit import default_timer
+
+import click
+from phonenumbers import parse
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, gatherResults)
+from twisted.internet.task import react
+
+from portia.benchmarks.storage_memory import generate_entries
+from portia.benchmarks.suite import summarise
+from portia.portia import Portia
+from portia.storage import storage_for_layout
+from portia.utils import start_redis, chunked
+
+
+@inlineCallbacks
+def resolve_concurrently(portia, phonenumbers, ops, concurrency):
+    """
+    Resolve ``ops`` phonenumbers with ``concurrency`` resolves in flight and
+    summarise the latencies.
+    """
+    samples = []
+
+    @inlineCallbacks
+    def worker(offset):
+        for index in range(offset, ops, concurrency):
+            started = default_timer()
+            yield portia.resolve(phonenumbers[index % len(phonenumbers)])
+            samples.append(default_timer() - started)
+
+    started = default_timer()
+    yield gatherResults([worker(offset) for offset in range(concurrency)])
+    returnValue(summarise(samples, default_timer() - started))
+
+
+@inlineCallbacks
+def benchmark(redis_uri, prefix, pool_sizes, records, ops, concurrency,
+              layout='hash'):
+    entries = generate_entries(records)
+    phonenumbers = [parse(msisdn) for msisdn, _ in entries]
+    results = {}
+    for pool_size in pool_sizes:
+        redis = yield start_redis(redis_uri, pool_size=pool_size)
+        portia = Portia(
+            redis, prefix=prefix,
+            storage=storage_for_layout(layout, redis, prefix))
+        try:
+            if not results:
+                for chunk in chunked(entries, 1000):
+                    yield portia.storage.write_many(chunk)
+            results[pool_size] = yield resolve_concurrently(
+                portia, phonenumbers, ops, concurrency)
+            if pool_size == pool_sizes[-1]:
+                yield portia.flush()
+        finally:
+            yield redis.disconnect()
+    returnValue(results)
+
+
+@click.command()
+@click.option('--redis-uri', default='redis://localhost:6379/15',
+              help='The redis://hostname:port/db to benchmark against.')
+@click.option('--prefix', default='portia-benchmark:',
+              help='The scratch Redis keyspace prefix to use.')
+@click.option('--layout', default='hash',
+              type=click.Choice(['hash', 'compact']))
+@click.option('--pool-size', multiple=True, type=click.IntRange(1),
+              help='A pool size to measure, may be repeated.')
+@click.option('--records', default=10000,
+              help='The number of MSISDNs to store.')
+@click.option('--ops', default=20000,
+              help='The number of resolves to time per pool size.')
+@click.option('--concurrency', default=64,
+              help='The number of resolves in flight at once.')
+def main(redis_uri, prefix, layout, pool_size, records, ops, concurrency):
+    pool_sizes = sorted(pool_size or [1, 2, 4, 8, 16])
+
+    @inlineCallbacks
+    def run(reactor):
+        results = yield benchmark(
+            redis_uri, prefix, pool_sizes, records, ops, concurrency,
+            layout=layout)
+        click.echo('%-9s %10s %9s %9s %9s' % (
+            'pool size', 'ops/sec', 'p50 ms', 'p99 ms', 'max ms'))
+        for size in pool_sizes:
+            click.echo(
+                '%(size)-9d %(ops_per_sec)10.1f %(p50_ms)9.3f '
+                '%(p99_ms)9.3f %(max_ms)9.3f' % dict(
+                    results[size], size=size))
+
+    react(run)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Compares how much Redis memory the storage layouts use for porting
+records, scaled to a million MSISDNs::
+
+    $ python -m portia.benchmarks.storage_memory --records 100000
+
+This writes to and flushes the given prefix, point it at a scratch
+database. The compact layout relies on its buckets staying listpack
+(ziplist before Redis 7) encoded, ``--configure`` raises
+``hash-max-listpack-entries`` for the duration of the run.
+"""
+import random
+from datetime import datetime, timedelta
+
+import click
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import react
+
+from portia.benchmarks.geocode import generate_phonenumbers
+from portia.portia import as_msisdn
+from portia.storage import storage_for_layout
+from portia.utils import UTC, start_redis, chunked
+
+NETWORKS = ['MTN', 'VODACOM', 'CELLC', 'TELKOM', 'GLO', 'AIRTEL']
+
+
+def generate_entries(count, seed=0):
+    rand = random.Random(seed)
+    start = datetime(2015, 1, 1, tzinfo=UTC())
+    entries = []
+    for phonenumber in generate_phonenumbers(count, seed=seed):
+        timestamp = start + timedelta(seconds=rand.randint(0, 10 ** 8))
+        donor, recipient = rand.sample(NETWORKS, 2)
+        entries.append((as_msisdn(phonenumber), {
+            'ported-to': (recipient, timestamp),
+            'ported-from': (donor, timestamp),
+        }))
+    return entries
+
+
+@inlineCallbacks
+def used_memory(redis):
+    info = yield redis.info('memory')
+    returnValue(int(info['used_memory']))
+
+
+@inlineCallbacks
+def configure_hash_entries(redis, entries):
+    """
+    Set the maximum number of listpack encoded hash entries, fires with
+    the config parameter changed and its previous value.
+    """
+    for name in ['hash-max-listpack-entries', 'hash-max-ziplist-entries']:
+        previous = yield redis.execute_command('CONFIG', 'GET', name)
+        if previous:
+            yield redis.execute_command('CONFIG', 'SET', name, entries)
+            returnValue((name, previous[1]))
+    returnValue((None, None))
+
+
+@inlineCallbacks
+def measure(redis, storage, entries, batch_size):
+    yield storage.flush()
+    before = yield used_memory(redis)
+    for chunk in chunked(entries, batch_size):
+        yield storage.write_many(chunk)
+    after = yield used_memory(redis)
+    yield storage.flush()
+    returnValue(after - before)
+
+
+@inlineCallbacks
+def benchmark(redis, prefix, records, bucket_digits=2, batch_size=1000,
+              configure=True):
+    entries = generate_entries(records)
+    name, previous = None, None
+    if configure:
+        name, previous = yield configure_hash_entries(redis, max(
+            512, 2 * 10 ** bucket_digits))
+
+    results = {}
+    try:
+        for layout in ['hash', 'compact']:
+            storage = storage_for_layout(
+                layout, redis, prefix, bucket_digits=bucket_digits)
+            used = yield measure(redis, storage, entries, batch_size)
+            results[layout] = {
+                'used_memory': used,
+                'per_million': used * 10 ** 6 / records,
+            }
+    finally:
+        if name is not None:
+            yield redis.execute_command('CONFIG', 'SET', name, previous)
+    returnValue(results)
+
+
+@click.command()
+@click.option('--redis-uri', default='redis://localhost:6379/15',
+              help='The redis://hostname:port/db to benchmark against.')
+@click.option('--prefix', default='portia-benchmark:',
+              help='The scratch Redis keyspace prefix to use.')
+@click.option('--records', default=100000,
+              help='The number of MSISDNs to store.')
+@click.option('--bucket-digits', default=2)
+@click.option('--configure/--no-configure', default=True,
+              help='Raise the listpack hash entry limit during the run.')
+def main(redis_uri, prefix, records, bucket_digits, configure):
+    @inlineCallbacks
+    def run(reactor):
+        redis = yield start_redis(redis_uri)
+        results = yield benchmark(
+            redis, prefix, records, bucket_digits=bucket_digits,
+            configure=configure)
+        click.echo('%d records' % (records,))
+        for layout in ['hash', 'compact']:
+            click.echo('%-8s %12d bytes %8.1f MB/million' % (
+                layout, results[layout]['used_memory'],
+                results[layout]['per_million'] / 2.0 ** 20))
+        yield redis.disconnect()
+
+    react(run)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+"""
+Measures throughput and latency percentiles of Portia's hot paths and
+compares them against a stored baseline::
+
+    $ python -m portia.benchmarks --output baseline.json
+    $ python -m portia.benchmarks --baseline baseline.json
+
+The in-memory backend is used unless ``--backend redis`` is given, which
+writes to and flushes ``--prefix`` in ``--redis-uri``. The command exits
+with a non-zero status if any benchmark regressed by more than its
+threshold.
+"""
+import json
+import math
+import platform
+import random
+from datetime import datetime
+from StringIO import StringIO
+from timeit import default_timer
+
+import click
+import pkg_resources
+import treq
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, maybeDeferred)
+from twisted.internet import reactor
+from twisted.internet.task import react
+from twisted.web.client import HTTPConnectionPool
+from twisted.test.proto_helpers import StringTransport
+
+from portia.benchmarks.geocode import generate_phonenumbers
+from portia.benchmarks.memory import MemoryStorage
+from portia.portia import Portia, as_msisdn
+from portia.protocol import JsonProtocol, FRAMINGS, msgpack
+from portia.storage import storage_for_layout
+from portia.utils import (
+    compile_network_prefix_mappings, start_redis, start_webserver)
+
+PERCENTILES = [50, 90, 99]
+
+
+def percentile(samples, percent):
+    """
+    Return the nearest-rank ``percent`` percentile of sorted ``samples``.
+    """
+    if not samples:
+        return 0.0
+    rank = int(math.ceil(percent / 100.0 * len(samples))) - 1
+    return samples[max(0, min(rank, len(samples) - 1))]
+
+
+def summarise(samples, elapsed):
+    samples = sorted(samples)
+    summary = {
+        'ops': len(samples),
+        'ops_per_sec': len(samples) / elapsed if elapsed else 0.0,
+        'max_ms': samples[-1] * 1000 if samples else 0.0,
+    }
+    for percent in PERCENTILES:
+        summary['p%d_ms' % (percent,)] = percentile(samples, percent) * 1000
+    return summary
+
+
+@inlineCallbacks
+def measure(operation, ops, warmup=0):
+    """
+    Call ``operation`` with the op index ``ops`` times in a row, waiting
+    for any Deferred it returns, and summarise the latencies.
+    """
+    for index in range(warmup):
+        yield maybeDeferred(operation, index)
+
+    samples = []
+    started = default_timer()
+    for index in range(ops):
+        op_started = default_timer()
+        yield maybeDeferred(operation, index)
+        samples.append(default_timer() - op_started)
+    returnValue(summarise(samples, default_timer() - started))
+
+
+def compare(results, baseline, threshold=0.1, thresholds=None):
+    """
+    Compare ``results`` against ``baseline`` and return a list of
+    ``(name, metric, baseline value, value)`` regressions. A benchmark
+    regresses if its ops/sec dropped or its p99 latency grew by more
+    than its threshold, given as a fraction of the baseline.
+    """
+    thresholds = thresholds or {}
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        allowed = thresholds.get(name, threshold)
+        if result['ops_per_sec'] < previous['ops_per_sec'] * (1 - allowed):
+            regressions.append(
+                (name, 'ops_per_sec', previous['ops_per_sec'],
+                 result['ops_per_sec']))
+        if result['p99_ms'] > previous['p99_ms'] * (1 + allowed):
+            regressions.append(
+                (name, 'p99_ms', previous['p99_ms'], result['p99_ms']))
+    return regressions
+
+
+def generate_porting_rows(phonenumbers, seed=0):
+    rand = random.Random(seed)
+    networks = ['MNO%d' % (i,) for i in range(10)]
+    return [
+        [as_msisdn(phonenumber)] + rand.sample(networks, 2) +
+        ['2015%02d%02d' % (rand.randint(1, 12), rand.randint(1, 28))]
+        for phonenumber in phonenumbers]
+
+
+def porting_file(rows):
+    return StringIO(''.join(
+        '%s\n' % (','.join(row),)
+        for row in [['MSISDN', 'DONOR', 'RECIPIENT', 'DATE']] + rows))
+
+
+class BenchmarkSuite(object):
+    """
+    Sets up Portia against ``storage`` with ``numbers`` entries and runs
+    each of the ``BENCHMARKS`` against it.
+    """
+
+    BENCHMARKS = [
+        'resolve',
+        'resolve_without_entry',
+        'resolve_many',
+        'network_prefix_lookup',
+        'import_porting_file',
+        'protocol_parse_line',
+        'protocol_parse_frame',
+        'web_resolve',
+        'web_entry',
+    ]
+
+    def __init__(self, redis, storage, numbers=1000, batch_size=100,
+                 seed=0):
+        self.portia = Portia(
+            redis, storage=storage,
+            network_prefix_mapping=compile_network_prefix_mappings(
+                [pkg_resources.resource_filename(
+                    'portia', 'assets/mappings/*.mapping.json')]))
+        self.batch_size = batch_size
+        self.phonenumbers = generate_phonenumbers(numbers, seed=seed)
+        self.rows = generate_porting_rows(self.phonenumbers, seed=seed)
+
+    def phonenumber(self, index):
+        return self.phonenumbers[index % len(self.phonenumbers)]
+
+    def setUp(self):
+        return self.portia.import_porting_file(porting_file(self.rows))
+
+    def tearDown(self):
+        return self.portia.flush()
+
+    def bench_resolve(self, index):
+        return self.portia.resolve(self.phonenumber(index))
+
+    def bench_resolve_without_entry(self, index):
+        return self.portia.resolve(self.phonenumber(index), entry=False)
+
+    def bench_resolve_many(self, index):
+        start = index * self.batch_size
+        return self.portia.resolve_many([
+            self.phonenumber(start + offset)
+            for offset in range(self.batch_size)])
+
+    def bench_network_prefix_lookup(self, index):
+        return self.portia.network_prefix_lookup(
+            self.phonenumber(index), self.portia.network_prefix_mapping)
+
+    def bench_import_porting_file(self, index):
+        start = (index * self.batch_size) % len(self.rows)
+        return self.portia.import_porting_file(
+            porting_file(self.rows[start:start + self.batch_size]))
+
+    def web_get(self, path):
+        @inlineCallbacks
+        def get(index):
+            response = yield treq.get(str('%s%s' % (
+                self.web_url, path(self.phonenumber(index)))), pool=self.pool)
+            yield response.content()
+        return get
+
+    @inlineCallbacks
+    def run_all(self, ops, names=None, warmup=100):
+        names = names or self.BENCHMARKS
+        results = {}
+        yield self.setUp()
+        listener = yield start_webserver(
+            self.portia, 'tcp:0:interface=127.0.0.1')
+        self.web_url = 'http://127.0.0.1:%s' % (listener.getHost().port,)
+        self.pool = HTTPConnectionPool(reactor)
+        try:
+            for name in names:
+                operation = self.operation(name)
+                if operation is None:
+                    continue
+                results[name] = yield measure(operation, ops, warmup=warmup)
+        finally:
+            yield listener.stopListening()
+            yield self.pool.closeCachedConnections()
+            yield self.tearDown()
+        returnValue(results)
+
+    def operation(self, name):
+        if name == 'protocol_parse_line':
+            return self.protocol_operation('json')
+        if name == 'protocol_parse_frame':
+            return self.protocol_operation('msgpack')
+        if name == 'web_resolve':
+            return self.web_get(
+                lambda phonenumber: '/resolve/%s' % (
+                    as_msisdn(phonenumber).replace('+', '%2B'),))
+        if name == 'web_entry':
+            return self.web_get(
+                lambda phonenumber: '/entry/%s' % (
+                    as_msisdn(phonenumber).replace('+', '%2B'),))
+        return getattr(self, 'bench_%s' % (name,))
+
+    def protocol_operation(self, framing):
+        """
+        Parse, resolve and encode the reply of ``resolve`` commands sent
+        with the named framing, ``None`` if it is not available.
+        """
+        if framing not in FRAMINGS:
+            return None
+        protocol = JsonProtocol(self.portia)
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        commands = [{
+            'cmd': 'resolve',
+            'id': index,
+            'version': JsonProtocol.version,
+            'request': {'msisdn': as_msisdn(phonenumber)},
+        } for index, phonenumber in enumerate(self.phonenumbers)]
+
+        if framing == 'json':
+            parse = protocol.parseLine
+            messages = [json.dumps(command) for command in commands]
+        else:
+            protocol.framing = FRAMINGS[framing]()
+            parse = protocol.parseFrame
+            messages = [msgpack.packb(command) for command in commands]
+
+        def parse_message(index):
+            transport.clear()
+            return parse(messages[index % len(messages)])
+
+        return parse_message
+
+
+def parse_thresholds(values):
+    thresholds = {}
+    for value in values:
+        name, _, threshold = value.partition('=')
+        try:
+            thresholds[name] = float(threshold)
+        except ValueError:
+            raise click.BadParameter(
+                'Expected name=fraction, got: %s' % (value,))
+    return thresholds
+
+
+@click.command()
+@click.option('--backend', default='memory',
+              help='Run against the in-memory stand-in or a Redis server.',
+              type=click.Choice(['memory', 'redis']))
+@click.option('--redis-uri', default='redis://localhost:6379/15',
+              help='The redis://hostname:port/db to benchmark against.')
+@click.option('--prefix', default='portia-benchmark:',
+              help='The scratch Redis keyspace prefix to use.')
+@click.option('--layout', default='hash',
+              type=click.Choice(['hash', 'compact']))
+@click.option('--numbers', default=1000,
+              help='The number of distinct MSISDNs to store.')
+@click.option('--ops', default=2000,
+              help='The number of operations to time per benchmark.')
+@click.option('--batch-size', default=100,
+              help='MSISDNs per resolve_many and rows per import.')
+@click.option('--only', multiple=True,
+              type=click.Choice(BenchmarkSuite.BENCHMARKS),
+              help='Only run the named benchmark, may be repeated.')
+@click.option('--output', type=click.Path(),
+              help='Where to save the results as JSON.')
+@click.option('--baseline', type=click.File(),
+              help='Results JSON to compare against.')
+@click.option('--threshold', default=0.1,
+              help='The allowed regression as a fraction of the baseline.')
+@click.option('--benchmark-threshold', multiple=True,
+              help='A name=fraction threshold for a single benchmark.')
+def main(backend, redis_uri, prefix, layout, numbers, ops, batch_size,
+         only, output, baseline, threshold, benchmark_threshold):
+    thresholds = parse_thresholds(benchmark_threshold)
+    previous = json.load(baseline)['results'] if baseline else None
+
+    @inlineCallbacks
+    def run(reactor):
+        redis = None
+        if backend == 'redis':
+            redis = yield start_redis(redis_uri)
+            storage = storage_for_layout(layout, redis, prefix)
+        else:
+            storage = MemoryStorage()
+
+        suite = BenchmarkSuite(
+            redis, storage, numbers=numbers, batch_size=batch_size)
+        try:
+            results = yield suite.run_all(ops, names=list(only))
+        finally:
+            if redis is not None:
+                yield redis.disconnect()
+
+        click.echo('%-24s %10s %9s %9s %9s %9s' % (
+            'benchmark', 'ops/sec', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+        for name in suite.BENCHMARKS:
+            if name in results:
+                click.echo(
+                    '%(name)-24s %(ops_per_sec)10.1f %(p50_ms)9.3f '
+                    '%(p90_ms)9.3f %(p99_ms)9.3f %(max_ms)9.3f' % dict(
+                        results[name], name=name))
+
+        if output:
+            with open(output, 'w') as fp:
+                json.dump({
+                    'created': datetime.utcnow().isoformat(),
+                    'backend': backend,
+                    'layout': layout,
+                    'python': platform.python_version(),
+                    'numbers': numbers,
+                    'ops': ops,
+                    'results': results,
+                }, fp, indent=2, sort_keys=True)
+
+        if previous is not None:
+            regressions = compare(
+                results, previous, threshold=threshold,
+                thresholds=thresholds)
+            for name, metric, before, after in regressions:
+                click.echo('REGRESSION %s %s: %.3f -> %.3f' % (
+                    name, metric, before, after))
+            if regressions:
+                raise SystemExit(1)
+
+    react(run)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+from collections import OrderedDict
+
+from twisted.internet import reactor as default_reactor
+
+
+class LRUCache(object):
+    """
+    A bounded least recently used cache with an optional time to live.
+
+    :param int size:
+        The maximum number of entries to keep.
+    :param float ttl:
+        How many seconds an entry remains valid for, ``None`` for no expiry.
+    """
+
+    def __init__(self, size, ttl=None, clock=default_reactor):
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            expires, value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        if expires is not None and expires <= self.clock.seconds():
+            self.expirations += 1
+            self.misses += 1
+            return default
+
+        self._entries[key] = (expires, value)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, version=None):
+        """
+        Store ``value`` under ``key``. If ``version`` is given the value
+        is only stored if nothing was invalidated since that version was
+        read, so results fetched before a write never replace it.
+        """
+        if self.size < 1:
+            return value
+
+        if version is not None and version != self.version:
+            return value
+
+        self._entries.pop(key, None)
+        while len(self._entries) >= self.size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+        expires = None
+        if self.ttl is not None:
+            expires = self.clock.seconds() + self.ttl
+        self._entries[key] = (expires, value)
+        return value
+
+    def invalidate(self, *keys):
+        self.version += 1
+        for key in keys:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        self.version += 1
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'max_size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
+import os
 import sys
 import pkg_resources
 
 from twisted.python import log
 from twisted.internet import reactor
-from twisted.internet.defer import gatherResults
+from twisted.internet.defer import gatherResults, maybeDeferred
 from twisted.internet.task import react
 
 from .portia import Portia
@@ -18,14 +19,50 @@ def main():
 
 
 @main.command()
-@click.option('--redis-uri', default='redis://localhost:6379/1',
-              help='The redis://hostname:port/db to connect to.',
-              type=str)
+@click.option('--redis-uri', 'redis_uris',
+              default=['redis://localhost:6379/1'],
+              help='The redis://hostname:port/db or '
+                   'unix:///path/to/redis.sock?db=db to connect to. '
+                   'Repeat to shard entries over several Redis servers.',
+              type=str, multiple=True)
+@click.option('--redis-replica-uri', 'replica_uris', default=[],
+              help='A Redis replica to send reads to, may be repeated. '
+                   'When sharding give it as <primary uri>,<replica uri>.',
+              type=str, multiple=True)
+@click.option('--replica-strategy', default='round-robin',
+              help='How to pick the replica a read is sent to.',
+              type=click.Choice(['round-robin', 'least-latency']))
+@click.option('--read-your-writes', default=0.0,
+              help='For how many seconds after an MSISDN is annotated '
+                   'its reads go to the primary.',
+              type=float)
+@click.option('--redis-pool-size', default=1,
+              help='How many connections to open to Redis, commands are '
+                   'spread over those that are free.',
+              type=click.IntRange(1))
+@click.option('--redis-lazy/--no-redis-lazy', default=False,
+              help='Start serving straight away and connect to Redis in '
+                   'the background.')
+@click.option('--redis-connect-timeout', default=None,
+              help='Seconds to wait for a Redis connection to be made.',
+              type=float)
+@click.option('--redis-timeout', default=None,
+              help='Seconds to wait for a Redis reply before dropping the '
+                   'connection and failing the command.',
+              type=float)
 @click.option('--web/--no-web', default=True)
 @click.option('--web-endpoint', default='tcp:8000', type=str)
 @click.option('--tcp/--no-tcp', default=False)
 @click.option('--tcp-endpoint', default='tcp:8001', type=str)
+@click.option('--tcp-max-in-flight', default=100,
+              help='How many commands a TCP connection can have in flight '
+                   'before Portia stops reading from it.',
+              type=click.IntRange(1))
 @click.option('--cors', default=None, type=str)
+@click.option('--max-batch-size', default=10000,
+              help='The maximum number of MSISDNs accepted by a single '
+                   'batch resolve request.',
+              type=click.IntRange(1))
 @click.option('--prefix', default='bayes:',
               help='The Redis keyspace prefix to use.',
               type=str)
@@ -42,39 +79,322 @@ def main():
               help='Where to log output to.',
               type=click.File('a'),
               default=sys.stdout)
-def run(redis_uri, web, web_endpoint, tcp, tcp_endpoint,
-        cors, prefix, mappings_path, logfile):
+@click.option('--cache-size', default=0,
+              help='How many resolve results to cache in memory, '
+                   '0 disables the cache.',
+              type=click.IntRange(0))
+@click.option('--cache-ttl', default=60.0,
+              help='How many seconds cached resolve results are valid for. '
+                   'Writes made by other processes are only seen once '
+                   'this runs out.',
+              type=float)
+@click.option('--layout', default='hash',
+              help='How entries are laid out in Redis, compact packs '
+                   'MSISDNs into shared hashes to save memory.',
+              type=click.Choice(['hash', 'compact']))
+@click.option('--bucket-digits', default=2,
+              help='How many trailing MSISDN digits share a hash with '
+                   'the compact layout.',
+              type=click.IntRange(1, 4))
+@click.option('--metrics/--no-metrics', default=True,
+              help='Record request and Redis metrics and expose them '
+                   'on the web server\'s /metrics endpoint.')
+@click.option('--workers', default=1,
+              help='How many server processes to run, they share the '
+                   'listening sockets and are restarted if they exit.',
+              type=click.IntRange(1))
+@click.option('--web-fd', default=None,
+              help='Serve the web server on this inherited listening '
+                   'socket, used by --workers.',
+              type=int)
+@click.option('--tcp-fd', default=None,
+              help='Serve the TCP server on this inherited listening '
+                   'socket, used by --workers.',
+              type=int)
+@click.option('--snapshot', default=None,
+              help='Serve read-only lookups from a snapshot file built '
+                   'with `portia snapshot build` instead of Redis.',
+              type=click.Path(exists=True, dir_okay=False))
+def run(redis_uris, replica_uris, replica_strategy, read_your_writes,
+        redis_pool_size, redis_lazy, redis_connect_timeout,
+        redis_timeout, web, web_endpoint, tcp, tcp_endpoint,
+        tcp_max_in_flight, cors, max_batch_size, prefix, mappings_path,
+        logfile, cache_size, cache_ttl, layout, bucket_digits, metrics,
+        workers, web_fd, tcp_fd, snapshot):
     from .utils import (
-        start_redis, start_webserver, start_tcpserver,
-        compile_network_prefix_mappings)
+        start_webserver, start_tcpserver, compile_network_prefix_mappings)
+    from .cache import LRUCache
+    from .sharding import start_storage
+    from .snapshot import SnapshotStorage
+    from .metrics import Metrics, InstrumentedRedis
     log.startLogging(logfile)
+    if workers > 1:
+        return supervise_workers(workers, web and web_endpoint,
+                                 tcp and tcp_endpoint)
+
+    metrics = Metrics() if metrics else None
 
-    d = start_redis(redis_uri)
+    if snapshot:
+        d = maybeDeferred(SnapshotStorage, snapshot)
+    else:
+        d = start_storage(
+            redis_uris, prefix, layout=layout, bucket_digits=bucket_digits,
+            wrap=(
+                (lambda redis: InstrumentedRedis(redis, metrics))
+                if metrics is not None else None),
+            replica_uris=replica_uris, replica_strategy=replica_strategy,
+            read_your_writes=read_your_writes,
+            pool_size=redis_pool_size, lazy=redis_lazy,
+            connect_timeout=redis_connect_timeout,
+            command_timeout=redis_timeout)
     d.addCallback(
-        Portia, prefix=prefix,
-        network_prefix_mapping=compile_network_prefix_mappings(mappings_path))
+        lambda storage: Portia(
+            None, prefix=prefix,
+            network_prefix_mapping=compile_network_prefix_mappings(
+                mappings_path),
+            resolve_cache=(
+                LRUCache(cache_size, ttl=cache_ttl) if cache_size else None),
+            storage=storage))
+
+    def track_caches(portia):
+        if metrics is not None:
+            if portia.resolve_cache is not None:
+                metrics.track_cache('resolve', portia.resolve_cache)
+            metrics.track_cache('geocode', portia.geocode_metadata.cache)
+        return portia
+
+    d.addCallback(track_caches)
 
     def start_servers(portia):
         callbacks = []
         if web:
-            callbacks.append(start_webserver(portia, web_endpoint, cors))
+            callbacks.append(start_webserver(
+                portia, web_endpoint, cors, max_batch_size=max_batch_size,
+                metrics=metrics, fd=web_fd))
         if tcp:
-            callbacks.append(start_tcpserver(portia, tcp_endpoint))
+            callbacks.append(start_tcpserver(
+                portia, tcp_endpoint, metrics=metrics, fd=tcp_fd,
+                max_in_flight=tcp_max_in_flight))
         return gatherResults(callbacks)
 
+    def stop_listening_on_shutdown(ports):
+        reactor.addSystemEventTrigger(
+            'before', 'shutdown',
+            lambda: gatherResults([port.stopListening() for port in ports]))
+
     d.addCallback(start_servers)
+    d.addCallback(stop_listening_on_shutdown)
     reactor.run()
 
 
+def supervise_workers(workers, web_endpoint, tcp_endpoint):
+    """
+    Listen on the endpoints and run ``workers`` copies of the current
+    ``portia run`` command that serve on the shared sockets.
+    """
+    from .utils import listen_shared
+    from .workers import WorkerSupervisor
+
+    endpoints = [
+        (option, endpoint)
+        for option, endpoint in [
+            ('--web-fd', web_endpoint), ('--tcp-fd', tcp_endpoint)]
+        if endpoint]
+    d = gatherResults([
+        listen_shared(endpoint) for _, endpoint in endpoints])
+
+    def start_workers(ports):
+        args = ['-m', 'portia.cli'] + sys.argv[1:] + ['--workers', '1']
+        fds = []
+        for (option, _), port in zip(endpoints, ports):
+            fd = port.socket.fileno()
+            args.extend([option, str(fd)])
+            fds.append(fd)
+        supervisor = WorkerSupervisor(args, workers, fds=fds)
+        reactor.addSystemEventTrigger('before', 'shutdown', supervisor.stop)
+        supervisor.start()
+
+    def failed(failure):
+        log.err(failure)
+        reactor.stop()
+
+    d.addCallback(start_workers)
+    d.addErrback(failed)
+    reactor.run()
+
+
+@main.command()
+@click.option('--redis-uri', 'redis_uris',
+              default=['redis://localhost:6379/1'],
+              help='The redis://hostname:port/db to connect to. Repeat '
+                   'to shard entries over several Redis servers.',
+              type=str, multiple=True)
+@click.option('--prefix', default='bayes:',
+              help='The Redis keyspace prefix to use.',
+              type=str)
+@click.option('--logfile',
+              help='Where to log output to.',
+              type=click.File('a'),
+              default=sys.stdout)
+@click.option('--batch-size', default=1000,
+              help='How many keys to SCAN for and delete at a time.',
+              type=click.IntRange(1))
+@click.option('--concurrency', default=4,
+              help='The maximum number of delete batches in flight.',
+              type=click.IntRange(1))
+@click.confirmation_option(
+    help='Confirm the deletion without prompting.',
+    prompt='Are you sure you want to delete every key under the prefix?')
+def flush(redis_uris, prefix, logfile, batch_size, concurrency):
+    from .utils import Progress
+    from .sharding import start_storage
+    log.startLogging(logfile)
+    progress = Progress('Deleted', 'keys')
+    progress.start()
+    d = start_storage(redis_uris, prefix)
+    d.addCallback(lambda storage: Portia(None, prefix=prefix, storage=storage))
+    d.addCallback(
+        lambda portia: portia.flush(
+            count=batch_size, concurrency=concurrency, progress=progress))
+    d.addCallback(lambda _: progress.finish())
+
+    react(lambda _reactor: d)
+
+
+@main.command()
+@click.option('--redis-uri', 'redis_uris',
+              default=['redis://localhost:6379/1'],
+              help='The redis://hostname:port/db to connect to. Repeat '
+                   'to shard entries over several Redis servers.',
+              type=str, multiple=True)
+@click.option('--prefix', default='bayes:',
+              help='The Redis keyspace prefix to use.',
+              type=str)
+@click.option('--logfile',
+              help='Where to log output to.',
+              type=click.File('a'),
+              default=sys.stdout)
+@click.option('--from', 'source', default='hash',
+              help='The layout entries are currently stored in.',
+              type=click.Choice(['hash', 'compact']))
+@click.option('--to', 'target', default='compact',
+              help='The layout to move entries to.',
+              type=click.Choice(['hash', 'compact']))
+@click.option('--bucket-digits', default=2,
+              help='How many trailing MSISDN digits share a hash with '
+                   'the compact layout.',
+              type=click.IntRange(1, 4))
+@click.option('--batch-size', default=1000,
+              help='How many keys to SCAN for and migrate at a time.',
+              type=click.IntRange(1))
+@click.option('--concurrency', default=4,
+              help='The maximum number of migration batches in flight.',
+              type=click.IntRange(1))
+def migrate(redis_uris, prefix, logfile, source, target, bucket_digits,
+            batch_size, concurrency):
+    from .utils import Progress
+    from .storage import migrate
+    from .sharding import start_storage
+    log.startLogging(logfile)
+    if source == target:
+        raise click.BadParameter('--from and --to must differ.')
+
+    progress = Progress('Migrated', 'entries')
+    progress.start()
+    d = gatherResults([
+        start_storage(
+            redis_uris, prefix, layout=layout, bucket_digits=bucket_digits)
+        for layout in [source, target]])
+    d.addCallback(lambda storages: migrate(
+        storages[0], storages[1], count=batch_size, concurrency=concurrency,
+        progress=progress))
+    d.addCallback(lambda _: progress.finish())
+
+    react(lambda _reactor: d)
+
+
+def parse_timestamp(ctx, param, value):
+    import dateutil.parser
+    if value is None:
+        return None
+    try:
+        return dateutil.parser.parse(value)
+    except ValueError:
+        raise click.BadParameter('%s is not a timestamp.' % (value,))
+
+
+@main.command()
+@click.option('--redis-uri', 'redis_uris',
+              default=['redis://localhost:6379/1'],
+              help='The redis://hostname:port/db to connect to. Repeat '
+                   'to shard entries over several Redis servers.',
+              type=str, multiple=True)
+@click.option('--prefix', default='bayes:',
+              help='The Redis keyspace prefix to use.',
+              type=str)
+@click.option('--layout', default='hash',
+              help='How entries are laid out in Redis.',
+              type=click.Choice(['hash', 'compact']))
+@click.option('--bucket-digits', default=2,
+              help='How many trailing MSISDN digits share a hash with '
+                   'the compact layout.',
+              type=click.IntRange(1, 4))
+@click.option('--logfile',
+              help='Where to log output to.',
+              type=click.File('a'),
+              default=sys.stderr)
+@click.option('--format', 'format_', default='csv',
+              help='CSV with a row per annotation or NDJSON with an '
+                   'object per entry.',
+              type=click.Choice(['csv', 'ndjson']))
+@click.option('--key', 'keys', multiple=True,
+              help='Only export annotations for this key. Repeat for '
+                   'several keys.',
+              type=str)
+@click.option('--since', default=None, callback=parse_timestamp,
+              help='Only export annotations made at or after this time.',
+              type=str)
+@click.option('--until', default=None, callback=parse_timestamp,
+              help='Only export annotations made before this time.',
+              type=str)
+@click.option('--batch-size', default=1000,
+              help='How many keys to SCAN for and fetch at a time.',
+              type=click.IntRange(1))
+@click.option('--concurrency', default=4,
+              help='The maximum number of batches in flight.',
+              type=click.IntRange(1))
+@click.argument('output', type=click.File('wb'), default='-')
+def export(redis_uris, prefix, layout, bucket_digits, logfile, format_,
+           keys, since, until, batch_size, concurrency, output):
+    from .exporter import EntryExporter
+    from .sharding import start_storage
+    log.startLogging(logfile, setStdout=False)
+    d = start_storage(
+        redis_uris, prefix, layout=layout, bucket_digits=bucket_digits)
+    d.addCallback(lambda storage: EntryExporter(
+        storage, output, format=format_, keys=keys or None, since=since,
+        until=until, count=batch_size, concurrency=concurrency).export())
+
+    def flush(result):
+        output.flush()
+        return result
+
+    d.addBoth(flush)
+
+    react(lambda _reactor: d)
+
+
 @main.group('import')
 def import_():
     pass
 
 
 @import_.command('porting-db')
-@click.option('--redis-uri', default='redis://localhost:6379/1',
-              help='The redis://hostname:port/db to connect to.',
-              type=str)
+@click.option('--redis-uri', 'redis_uris',
+              default=['redis://localhost:6379/1'],
+              help='The redis://hostname:port/db to connect to. Repeat '
+                   'to shard entries over several Redis servers.',
+              type=str, multiple=True)
 @click.option('--prefix', default='bayes:',
               help='The Redis keyspace prefix to use.',
               type=str)
@@ -84,15 +404,148 @@ def import_():
               default=sys.stdout)
 @click.option('--header/--no-header', default=True,
               help='Whether the CSV file has a header or not.')
-@click.argument('file', type=click.File())
-def import_porting_db(redis_uri, prefix, logfile, header, file):
-    from .utils import start_redis
+@click.option('--stream/--no-stream', default=True,
+              help='Stream the file in chunks rather than loading it '
+                   'into memory all at once.')
+@click.option('--chunk-size', default=1000,
+              help='The number of rows written per Redis transaction '
+                   'when streaming.',
+              type=click.IntRange(1))
+@click.option('--concurrency', default=4,
+              help='The maximum number of chunks in flight when streaming.',
+              type=click.IntRange(1))
+@click.option('--layout', default='hash',
+              help='How entries are laid out in Redis, compact packs '
+                   'MSISDNs into shared hashes to save memory.',
+              type=click.Choice(['hash', 'compact']))
+@click.option('--bucket-digits', default=2,
+              help='How many trailing MSISDN digits share a hash with '
+                   'the compact layout.',
+              type=click.IntRange(1, 4))
+@click.option('--workers', default=0,
+              help='How many processes to parse and normalize rows in '
+                   'when streaming, 0 does it in the importing process.',
+              type=click.IntRange(0))
+@click.option('--max-errors', default=0,
+              help='How many invalid rows to skip before giving up when '
+                   'streaming.',
+              type=click.IntRange(0))
+@click.option('--checkpoint', default=None,
+              help='Where to save the progress of the import when '
+                   'streaming. Defaults to FILE.checkpoint unless FILE '
+                   'is - for stdin.',
+              type=click.Path(dir_okay=False))
+@click.option('--checkpoint-interval', default=10,
+              help='How often to save the progress, in seconds.',
+              type=click.IntRange(1))
+@click.option('--resume/--no-resume', default=False,
+              help='Continue where the checkpointed import left off.')
+@click.argument('file', type=click.File('rb'))
+def import_porting_db(redis_uris, prefix, logfile, header, stream,
+                      chunk_size, concurrency, layout, bucket_digits, workers,
+                      max_errors, checkpoint, checkpoint_interval, resume,
+                      file):
+    from .compression import open_compressed
+    from .importer import PortingImporter
+    from .sharding import start_storage
     log.startLogging(logfile)
-    d = start_redis(redis_uri)
-    d.addCallback(Portia, prefix=prefix)
-    d.addCallback(lambda portia: portia.import_porting_file(file, header))
-    d.addCallback(
-        lambda msisdns: [
-            log.msg('Imported %s' % (msisdn,)) for msisdn in msisdns])
+    if checkpoint is None and os.path.isfile(file.name):
+        checkpoint = '%s.checkpoint' % (file.name,)
+    pool = None
+    if stream and workers:
+        # Fork the workers before the reactor is running.
+        from multiprocessing import Pool
+        pool = Pool(workers)
+
+    d = start_storage(
+        redis_uris, prefix, layout=layout, bucket_digits=bucket_digits)
+    d.addCallback(lambda storage: Portia(None, prefix=prefix, storage=storage))
+    if stream:
+        d.addCallback(
+            lambda portia: PortingImporter(
+                portia, chunk_size=chunk_size, concurrency=concurrency,
+                pool=pool, max_errors=max_errors, checkpoint=checkpoint,
+                checkpoint_interval=checkpoint_interval).import_file(
+                    file, header, resume=resume))
+    else:
+        d.addCallback(lambda portia: portia.import_porting_file(
+            open_compressed(file), header))
+        d.addCallback(
+            lambda msisdns: log.msg('Imported %d rows.' % (len(msisdns),)))
 
+    def stop_pool(result):
+        # Pool.terminate() can deadlock on an idle worker, close instead.
+        if pool is not None:
+            pool.close()
+            pool.join()
+        return result
+
+    d.addBoth(stop_pool)
     react(lambda _reactor: d)
+
+
+@main.group()
+def snapshot():
+    pass
+
+
+@snapshot.command('build')
+@click.option('--redis-uri', 'redis_uris',
+              default=['redis://localhost:6379/1'],
+              help='The redis://hostname:port/db to read entries from. '
+                   'Repeat for every shard.',
+              type=str, multiple=True)
+@click.option('--prefix', default='bayes:',
+              help='The Redis keyspace prefix to use.',
+              type=str)
+@click.option('--layout', default='hash',
+              help='How entries are laid out in Redis.',
+              type=click.Choice(['hash', 'compact']))
+@click.option('--bucket-digits', default=2,
+              help='How many trailing MSISDN digits share a hash with '
+                   'the compact layout.',
+              type=click.IntRange(1, 4))
+@click.option('--batch-size', default=1000,
+              help='How many keys to SCAN for and read at a time.',
+              type=click.IntRange(1))
+@click.option('--porting-db', default=None,
+              help='Build from a porting database CSV file instead of '
+                   'Redis.',
+              type=click.File())
+@click.option('--header/--no-header', default=True,
+              help='Whether the CSV file has a header or not.')
+@click.option('--logfile',
+              help='Where to log output to.',
+              type=click.File('a'),
+              default=sys.stdout)
+@click.argument('output', type=click.Path(dir_okay=False))
+def build_snapshot(redis_uris, prefix, layout, bucket_digits, batch_size,
+                   porting_db, header, logfile, output):
+    from .importer import PortingImporter
+    from .sharding import start_storage
+    from .snapshot import SnapshotBuilder
+    log.startLogging(logfile)
+    builder = SnapshotBuilder()
+
+    if porting_db is not None:
+        d = PortingImporter(
+            Portia(None, storage=builder)).import_file(porting_db, header)
+    else:
+        d = start_storage(
+            redis_uris, prefix, layout=layout, bucket_digits=bucket_digits)
+        d.addCallback(lambda storage: storage.scan_entries(
+            builder.add_entries, count=batch_size))
+
+    def save(_):
+        saved = builder.save(output)
+        log.msg('Saved %d entries to %s.' % (saved, output))
+        if builder.dropped:
+            log.msg('Left out %d annotations a snapshot cannot hold.' % (
+                builder.dropped,))
+
+    d.addCallback(save)
+    react(lambda _reactor: d)
+
+
+if __name__ == '__main__':
+    main()
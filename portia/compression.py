@@ -0,0 +1,181 @@
+import bz2
+import threading
+import zlib
+from Queue import Queue
+
+from .exceptions import PortiaException
+
+try:
+    import lzma
+except ImportError:  # pragma: no cover
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+class Passthrough(object):
+    """
+    A decompressor for data that is not compressed.
+    """
+
+    unused_data = ''
+
+    def decompress(self, data):
+        return data
+
+
+def stream_ended(decompressor):
+    """
+    Whether ``decompressor`` has seen the end of its stream, found by
+    feeding it a byte more: zlib keeps it as unused data, bz2 and lzma
+    raise ``EOFError``.
+    """
+    if isinstance(decompressor, Passthrough):
+        return True
+    try:
+        decompressor.decompress('\0')
+    except EOFError:
+        return True
+    return bool(decompressor.unused_data)
+
+
+def gzip_decompressor():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def xz_decompressor():
+    if lzma is None:
+        raise PortiaException(
+            'Reading xz files needs the lzma module from backports.lzma.')
+    return lzma.LZMADecompressor()
+
+
+# The magic bytes each compression format starts with.
+DECOMPRESSORS = [
+    ('\x1f\x8b', gzip_decompressor),
+    ('BZh', bz2.BZ2Decompressor),
+    ('\xfd7zXZ\x00', xz_decompressor),
+]
+
+
+class DecompressingFile(object):
+    """
+    A read-only file of the decompressed contents of ``fp``.
+
+    A thread reads and decompresses ``fp`` in blocks, staying up to
+    ``buffers`` blocks ahead of what has been read, so decompressing
+    overlaps with whatever is done with the data. Concatenated streams,
+    as ``pigz`` and ``pbzip2`` write them, are read one after the other.
+    Input that stops in the middle of a stream raises a
+    ``PortiaException`` once the data before that has been read.
+
+    :param data:
+        Bytes that were already read from the start of ``fp``.
+    """
+
+    block_size = 64 * 1024
+
+    def __init__(self, fp, decompressor, data='', buffers=16):
+        self.fp = fp
+        self.decompressor = decompressor
+        self.blocks = Queue(buffers)
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+        self.thread = threading.Thread(target=self.decompress, args=(data,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def decompress(self, data):
+        try:
+            decompressor = self.decompressor()
+            while True:
+                if not data:
+                    data = self.fp.read(self.block_size)
+                    if not data:
+                        break
+                try:
+                    block = decompressor.decompress(data)
+                except EOFError:
+                    # bz2 raises when fed data past the end of a stream
+                    # rather than keeping it as unused_data.
+                    decompressor = self.decompressor()
+                    continue
+                data = decompressor.unused_data
+                if data:
+                    decompressor = self.decompressor()
+                if block:
+                    self.blocks.put(block)
+            if not stream_ended(decompressor):
+                raise PortiaException(
+                    'The compressed input ends mid-stream, it looks '
+                    'truncated.')
+        except Exception, e:
+            self.blocks.put(e)
+        self.blocks.put('')
+
+    def fill(self):
+        """
+        Add the next decompressed block to the buffer, ``False`` if there
+        are no more.
+        """
+        if self.eof:
+            return False
+        block = self.blocks.get()
+        if isinstance(block, Exception):
+            self.eof = True
+            raise block
+        if not block:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.position:] + block
+        self.position = 0
+        return True
+
+    def readline(self):
+        start = self.position
+        end = self.buffer.find('\n', start)
+        while end == -1:
+            searched = len(self.buffer) - start
+            if not self.fill():
+                end = len(self.buffer) - 1
+                break
+            start = 0
+            end = self.buffer.find('\n', searched)
+        line = self.buffer[start:end + 1]
+        self.position = start + len(line)
+        return line
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buffer) - self.position < size) and (
+                self.fill()):
+            pass
+        end = len(self.buffer) if size < 0 else self.position + size
+        data = self.buffer[self.position:end]
+        self.position += len(data)
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        self.fp.close()
+
+
+def open_compressed(fp):
+    """
+    Wrap ``fp`` so that gzip, bzip2 and xz compressed files are
+    decompressed as they are read. Uncompressed files are returned as is
+    unless they cannot be rewound after checking for compression, as is
+    the case with ``stdin``.
+    """
+    data = fp.read(6)
+    for magic, decompressor in DECOMPRESSORS:
+        if data.startswith(magic):
+            return DecompressingFile(fp, decompressor, data)
+    try:
+        fp.seek(0)
+    except IOError:
+        return DecompressingFile(fp, Passthrough, data)
+    return fp
@@ -2,6 +2,10 @@ class PortiaException(Exception):
     pass
 
 
+class ReadOnlyStorageException(PortiaException):
+    pass
+
+
 class JsonProtocolException(PortiaException):
     def __init__(self, message, command, reference_id):
         super(JsonProtocolException, self).__init__(message)
@@ -0,0 +1,107 @@
+import csv
+import json
+
+from twisted.internet import reactor as default_reactor
+
+from .utils import UTC, Progress
+
+FORMATS = ('csv', 'ndjson')
+
+CSV_HEADER = ('msisdn', 'key', 'value', 'timestamp')
+
+
+class EntryExporter(object):
+    """
+    Streams the entries of a storage to ``fp``, as CSV with a row per
+    annotation or as NDJSON with an object per entry.
+
+    Entries are walked with ``scan_entries`` and written as each batch
+    arrives, so at most ``concurrency`` batches of ``count`` entries are
+    held in memory however big the database is.
+
+    :param keys:
+        Only export annotations for these keys, ``None`` exports all.
+    :param datetime since:
+        Only export annotations made at or after this time.
+    :param datetime until:
+        Only export annotations made before this time.
+    """
+
+    def __init__(self, storage, fp, format='csv', keys=None, since=None,
+                 until=None, count=1000, concurrency=4,
+                 clock=default_reactor, report_interval=5):
+        self.storage = storage
+        self.fp = fp
+        self.format = format
+        self.keys = None if keys is None else frozenset(keys)
+        self.since = self.isoformat(since)
+        self.until = self.isoformat(until)
+        self.count = count
+        self.concurrency = concurrency
+        self.progress = Progress(
+            'Exported', 'entries', clock=clock, interval=report_interval)
+        self.writer = None
+
+    def isoformat(self, timestamp):
+        # Storages return UTC ISO 8601 timestamps, which sort the same as
+        # strings as they do as datetimes, so there is no need to parse
+        # every one of them.
+        if timestamp is None:
+            return None
+        if timestamp.tzinfo:
+            return timestamp.astimezone(UTC()).isoformat()
+        return timestamp.replace(tzinfo=UTC()).isoformat()
+
+    def export(self):
+        self.progress.start()
+        if self.format == 'csv':
+            self.writer = csv.writer(self.fp)
+            self.writer.writerow(CSV_HEADER)
+        d = self.storage.scan_entries(
+            self.write_entries, count=self.count,
+            concurrency=self.concurrency)
+        d.addCallback(lambda _: self.progress.finish())
+        return d
+
+    def annotations(self, entry):
+        """
+        The ``(key, value, timestamp)`` annotations of ``entry`` that
+        pass the filters.
+        """
+        annotations = []
+        for key, value in entry.iteritems():
+            if key.endswith('-timestamp'):
+                continue
+            if self.keys is not None and key not in self.keys:
+                continue
+            timestamp = entry.get('%s-timestamp' % (key,))
+            if self.since is not None and (
+                    timestamp is None or timestamp < self.since):
+                continue
+            if self.until is not None and (
+                    timestamp is None or timestamp >= self.until):
+                continue
+            annotations.append((key, value, timestamp))
+        return sorted(annotations)
+
+    def write_entries(self, entries):
+        exported = 0
+        for msisdn, entry in entries:
+            annotations = self.annotations(entry)
+            if not annotations:
+                continue
+            if self.writer is not None:
+                self.writer.writerows([
+                    (msisdn, key, value, timestamp)
+                    for key, value, timestamp in annotations])
+            else:
+                exported_entry = {}
+                for key, value, timestamp in annotations:
+                    exported_entry[key] = value
+                    exported_entry['%s-timestamp' % (key,)] = timestamp
+                self.fp.write(json.dumps(
+                    {'msisdn': msisdn, 'entry': exported_entry},
+                    sort_keys=True))
+                self.fp.write('\n')
+            exported += 1
+        return self.progress.update(exported)
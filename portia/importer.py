@@ -0,0 +1,408 @@
+import calendar
+import csv
+import hashlib
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+import phonenumbers
+
+from twisted.internet import reactor as default_reactor
+from twisted.internet.defer import (
+    fail, gatherResults, maybeDeferred, succeed)
+from twisted.internet.task import Cooperator
+from twisted.internet.threads import deferToThread
+from twisted.python import log
+
+from .compression import open_compressed
+from .exceptions import PortiaException
+from .normalize import MsisdnNormalizer
+from .utils import UTC, chunked, Progress
+
+EPOCH = datetime(1970, 1, 1, tzinfo=UTC())
+
+# Only the first few invalid rows are logged, the rest are only counted.
+MAX_LOGGED_ERRORS = 10
+
+# Rows of a porting database rarely repeat an MSISDN, so there is no
+# point remembering them.
+normalizer = MsisdnNormalizer(size=0)
+
+
+def normalize_porting_row(row):
+    msisdn, donor, recipient, date = row[0:4]
+    try:
+        msisdn = normalizer.parse(msisdn).msisdn
+    except phonenumbers.NumberParseException, e:
+        raise PortiaException('Invalid MSISDN %s: %s' % (msisdn, e))
+    return (msisdn, donor, recipient,
+            calendar.timegm(time.strptime(date, '%Y%m%d')))
+
+
+def normalize_porting_rows(rows):
+    """
+    Turn porting database rows into ``(msisdn, donor, recipient, epoch)``
+    records with E.164 MSISDNs and the porting date in seconds since the
+    epoch. Rows that cannot be normalized are returned separately as
+    ``(row, exception)`` pairs.
+
+    This runs in the import's worker processes, so it only returns
+    exceptions that survive being pickled.
+    """
+    records = []
+    errors = []
+    for row in rows:
+        try:
+            records.append(normalize_porting_row(row))
+        except (ValueError, PortiaException), e:
+            errors.append((row, e))
+    return records, errors
+
+
+def read_checkpoint(path):
+    with open(path, 'r') as fp:
+        return json.load(fp)
+
+
+def write_checkpoint(path, checkpoint):
+    tmp_path = '%s.tmp' % (path,)
+    with open(tmp_path, 'w') as fp:
+        json.dump(checkpoint, fp)
+    os.rename(tmp_path, path)
+
+
+def file_size(fp):
+    """
+    The size of the file behind ``fp`` or ``None`` if it is not a regular
+    file.
+    """
+    try:
+        return os.fstat(fp.fileno()).st_size or None
+    except (AttributeError, IOError, OSError):
+        return None
+
+
+class LineReader(object):
+    """
+    Iterates over the lines of ``fp`` while keeping track of the byte
+    offset they end at and of the SHA-1 of everything read so far.
+    """
+
+    block_size = 1024 * 1024
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.offset = 0
+        self.sha1 = hashlib.sha1()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.fp.readline()
+        if not line:
+            raise StopIteration()
+        self.offset += len(line)
+        self.sha1.update(line)
+        return line
+
+    def skip(self, offset):
+        """
+        Read up to ``offset`` in blocks rather than lines.
+        """
+        while self.offset < offset:
+            data = self.fp.read(min(self.block_size, offset - self.offset))
+            if not data:
+                break
+            self.offset += len(data)
+            self.sha1.update(data)
+
+    def fingerprint(self):
+        """
+        What a checkpoint records to tell whether it is resumed against
+        the same file.
+        """
+        return self.sha1.hexdigest()
+
+
+class SeekableLineReader(LineReader):
+    """
+    A ``LineReader`` for a regular file of ``size`` bytes. Instead of
+    hashing everything read, the file is fingerprinted by its size and
+    the SHA-1 of its first ``head_size`` bytes, so resuming can seek
+    straight to an offset rather than read up to it.
+    """
+
+    head_size = 1024 * 1024
+
+    def __init__(self, fp, size):
+        super(SeekableLineReader, self).__init__(fp)
+        self.sha1.update(fp.read(self.head_size))
+        fp.seek(0)
+        self.head = '%d:%s' % (size, self.sha1.hexdigest())
+
+    def next(self):
+        line = self.fp.readline()
+        if not line:
+            raise StopIteration()
+        self.offset += len(line)
+        return line
+
+    def skip(self, offset):
+        self.fp.seek(offset)
+        self.offset = offset
+
+    def fingerprint(self):
+        return self.head
+
+
+class ImportProgress(Progress):
+    """
+    ``Progress`` that also reports the number of invalid rows and, if the
+    size of the file is known, an estimate of the time left.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ImportProgress, self).__init__(*args, **kwargs)
+        self.errors = 0
+        self.reader = None
+        self.size = None
+        self.start_offset = 0
+
+    def track(self, reader, size):
+        self.reader = reader
+        self.size = size
+        self.start_offset = reader.offset
+
+    def eta(self):
+        if not self.size or self.reader is None:
+            return None
+        done = self.reader.offset - self.start_offset
+        elapsed = self.elapsed()
+        if not done or not elapsed:
+            return None
+        return max(self.size - self.reader.offset, 0) * elapsed / done
+
+    def report(self):
+        details = ['%.1f %s/sec' % (self.rate(), self.unit)]
+        eta = self.eta()
+        if eta is not None:
+            details.append('%.1f%%, ETA %s' % (
+                100.0 * self.reader.offset / self.size,
+                timedelta(seconds=int(eta))))
+        details.append('%d errors' % (self.errors,))
+        log.msg('%s %d %s (%s).' % (
+            self.action, self.count, self.unit, ', '.join(details)))
+
+    def finish(self):
+        count = super(ImportProgress, self).finish()
+        if self.errors:
+            log.msg('Skipped %d invalid rows.' % (self.errors,))
+        return count
+
+
+class PortingImporter(object):
+    """
+    Streams a porting database CSV file, which may be gzip, bzip2 or xz
+    compressed, into Portia.
+
+    Rows are read lazily, grouped into chunks of ``chunk_size`` rows
+    which are each written in a single round trip and at most
+    ``concurrency`` chunks are in flight at any given time. Annotations
+    older than the ones already stored are skipped and counted.
+
+    :param multiprocessing.Pool pool:
+        Worker processes to parse and normalize the rows in, leaving the
+        reactor free for the writes. ``None`` does it in this process.
+    :param int max_errors:
+        How many invalid rows to skip before failing the import, ``None``
+        skips all of them.
+    :param str checkpoint:
+        Where to save how far into the file the import got every
+        ``checkpoint_interval`` seconds, so that it can be resumed.
+    """
+
+    def __init__(self, portia, chunk_size=1000, concurrency=4,
+                 clock=default_reactor, report_interval=5, pool=None,
+                 max_errors=0, checkpoint=None, checkpoint_interval=10):
+        self.portia = portia
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.pool = pool
+        self.max_errors = max_errors
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.clock = clock
+        self.progress = ImportProgress(
+            'Imported', 'rows', clock=clock, interval=report_interval)
+        self.skipped = 0
+        self.errors = 0
+        # The part of the file every row of which has been written.
+        self.committed = None
+        self.pending = {}
+        self.last_checkpoint = None
+
+    def import_filename(self, file_name, has_header=True, resume=False):
+        fp = open(file_name, 'r')
+
+        def close(result):
+            fp.close()
+            return result
+
+        d = self.import_file(fp, has_header=has_header, resume=resume)
+        d.addBoth(close)
+        return d
+
+    def import_file(self, fp, has_header=True, resume=False):
+        fp = open_compressed(fp)
+        size = file_size(fp)
+        if size is None:
+            # Compressed files and pipes cannot seek, so resuming reads up
+            # to the checkpoint and compares the hash of what it read.
+            reader = LineReader(fp)
+        else:
+            reader = SeekableLineReader(fp, size)
+        self.committed = {
+            'offset': 0, 'fingerprint': reader.fingerprint(),
+            'sequence': 0, 'rows': 0, 'errors': 0, 'skipped': 0}
+        if resume:
+            try:
+                self.resume(reader)
+            except Exception:
+                return fail()
+        rows = csv.reader(reader)
+        if has_header and not reader.offset:
+            # Skip the first row if it is a document header
+            next(rows, None)
+            self.committed.update(
+                offset=reader.offset, fingerprint=reader.fingerprint())
+        self.progress.track(reader, size)
+        return self.import_rows(rows, reader=reader)
+
+    def resume(self, reader):
+        if self.checkpoint is None:
+            raise PortiaException('Resuming an import needs a checkpoint.')
+        if not os.path.exists(self.checkpoint):
+            log.msg('No checkpoint in %s, starting from the beginning.' % (
+                self.checkpoint,))
+            return
+        checkpoint = read_checkpoint(self.checkpoint)
+        reader.skip(checkpoint['offset'])
+        if (reader.offset != checkpoint['offset'] or
+                reader.fingerprint() != checkpoint['fingerprint']):
+            raise PortiaException(
+                'The file does not match the one checkpointed in %s.' % (
+                    self.checkpoint,))
+        self.committed.update(checkpoint, sequence=0)
+        self.errors = checkpoint['errors']
+        self.skipped = checkpoint['skipped']
+        log.msg('Resuming after %d rows at byte %d.' % (
+            checkpoint['rows'], checkpoint['offset']))
+
+    def import_rows(self, rows, reader=None):
+        self.progress.start()
+        self.last_checkpoint = self.clock.seconds()
+
+        def chunks():
+            for sequence, chunk in enumerate(chunked(rows, self.chunk_size)):
+                position = None
+                if reader is not None:
+                    position = {
+                        'sequence': sequence,
+                        'offset': reader.offset,
+                        'fingerprint': reader.fingerprint(),
+                        'rows': len(chunk),
+                    }
+                yield self.import_chunk(chunk, position)
+
+        work = chunks()
+        cooperator = Cooperator()
+        d = gatherResults([
+            cooperator.coiterate(work) for _ in range(self.concurrency)],
+            consumeErrors=True)
+        d.addErrback(lambda failure: failure.value.subFailure)
+        d.addCallbacks(lambda _: self.finish(), self.failed)
+        return d
+
+    def normalize(self, rows):
+        if self.pool is None:
+            return maybeDeferred(normalize_porting_rows, rows)
+        # Pool.apply blocks until a worker is done, so wait in a thread.
+        return deferToThread(self.pool.apply, normalize_porting_rows, (rows,))
+
+    def skip_errors(self, result, position=None):
+        records, errors = result
+        for row, error in errors:
+            self.errors += 1
+            if self.max_errors is not None and self.errors > self.max_errors:
+                raise error
+            if self.errors <= MAX_LOGGED_ERRORS:
+                log.msg('Skipping invalid row %r: %s' % (row, error))
+        self.progress.errors = self.errors
+        if position is not None:
+            position['errors'] = len(errors)
+        return records
+
+    def write_records(self, records):
+        if not records:
+            return succeed((0, 0))
+        return self.portia.write_porting_msisdns([
+            (msisdn, donor, recipient, EPOCH + timedelta(seconds=epoch))
+            for msisdn, donor, recipient, epoch in records])
+
+    def import_chunk(self, rows, position=None):
+        d = self.normalize(rows)
+        d.addCallback(self.skip_errors, position)
+        d.addCallback(self.write_records)
+        d.addCallback(self.chunk_written, position)
+        return d
+
+    def chunk_written(self, result, position=None):
+        rows, skipped = result
+        self.skipped += skipped
+        if position is not None:
+            position['skipped'] = skipped
+            self.commit(position)
+        return self.progress.update(rows)
+
+    def commit(self, position):
+        """
+        Advance the committed part of the file past every chunk that has
+        been written along with all the ones before it.
+        """
+        self.pending[position['sequence']] = position
+        while self.committed['sequence'] in self.pending:
+            position = self.pending.pop(self.committed['sequence'])
+            for key in ['rows', 'errors', 'skipped']:
+                self.committed[key] += position[key]
+            self.committed.update(
+                offset=position['offset'],
+                fingerprint=position['fingerprint'],
+                sequence=position['sequence'] + 1)
+        if (self.checkpoint is not None and
+                self.clock.seconds() - self.last_checkpoint >=
+                self.checkpoint_interval):
+            self.save_checkpoint()
+
+    def save_checkpoint(self):
+        self.last_checkpoint = self.clock.seconds()
+        write_checkpoint(self.checkpoint, dict(
+            (key, value) for key, value in self.committed.items()
+            if key != 'sequence'))
+
+    def failed(self, failure):
+        if self.checkpoint is not None and self.committed is not None:
+            self.save_checkpoint()
+            log.msg('Import failed, resume it from %s.' % (self.checkpoint,))
+        return failure
+
+    def finish(self):
+        rows = self.progress.finish()
+        if self.skipped:
+            log.msg('Skipped %d annotations older than those stored.' % (
+                self.skipped,))
+        if self.checkpoint is not None and os.path.exists(self.checkpoint):
+            # The import is done, there is nothing left to resume.
+            os.remove(self.checkpoint)
+        return rows
@@ -0,0 +1,90 @@
+from phonenumbers import (
+    carrier, geocoder, number_type, region_codes_for_country_code, timezone)
+from phonenumbers.carrierdata import CARRIER_DATA
+from phonenumbers.tzdata import TIMEZONE_DATA
+
+from .cache import LRUCache
+
+
+class GeocodeMetadata(object):
+    """
+    Memoizes the static libphonenumber metadata ``Portia.resolve_geocode``
+    returns for a number.
+
+    The carrier and timezone data is keyed on prefixes of the number,
+    so results are cached per country code, national number length and
+    the leading national digits deep enough to cover the longest carrier
+    or timezone prefix known for that country code. Whether the carrier
+    and timezones are looked up at all depends on the number's type,
+    which is part of the key too, as is the country name for country
+    codes shared by several regions.
+
+    :param int size:
+        The maximum number of prefixes to keep metadata for.
+    """
+
+    MIN_PREFIX_DEPTH = 3
+
+    def __init__(self, size=65536, lang='en'):
+        self.lang = lang
+        self.cache = LRUCache(size)
+        self.prefix_depths = {}
+        self.region_codes = {}
+
+    def prefix_depth(self, country_code):
+        depth = self.prefix_depths.get(country_code)
+        if depth is None:
+            cc = str(country_code)
+            depth = max([self.MIN_PREFIX_DEPTH] + [
+                len(prefix) - len(cc)
+                for data in (CARRIER_DATA, TIMEZONE_DATA)
+                for prefix in data
+                if prefix.startswith(cc)])
+            self.prefix_depths[country_code] = depth
+        return depth
+
+    def key(self, phonenumber):
+        national_number = str(phonenumber.national_number)
+        key = (
+            phonenumber.country_code,
+            phonenumber.number_of_leading_zeros
+            if phonenumber.italian_leading_zero else 0,
+            len(national_number),
+            national_number[:self.prefix_depth(phonenumber.country_code)],
+            number_type(phonenumber),
+        )
+        if len(region_codes_for_country_code(phonenumber.country_code)) > 1:
+            # The country name is that of the one region sharing the
+            # country code that the number is valid for, if any.
+            key += (geocoder.country_name_for_number(
+                phonenumber, self.lang),)
+        return key
+
+    def region_code(self, country_code):
+        region_code = self.region_codes.get(country_code)
+        if region_code is None:
+            region_code = geocoder.region_code_for_country_code(country_code)
+            self.region_codes[country_code] = region_code
+        return region_code
+
+    def compute(self, phonenumber):
+        return {
+            'region_code': self.region_code(phonenumber.country_code),
+            'country_description': geocoder.country_name_for_number(
+                phonenumber, self.lang),
+            'original_carrier': carrier.name_for_number(
+                phonenumber, self.lang),
+            'timezones': timezone.time_zones_for_number(phonenumber),
+        }
+
+    def lookup(self, phonenumber):
+        """
+        Return the ``region_code``, ``country_description``,
+        ``original_carrier`` and ``timezones`` for ``phonenumber``.
+        The returned dictionary is shared and must not be modified.
+        """
+        key = self.key(phonenumber)
+        metadata = self.cache.get(key)
+        if metadata is None:
+            metadata = self.cache.set(key, self.compute(phonenumber))
+        return metadata
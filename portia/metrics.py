@@ -0,0 +1,315 @@
+from bisect import bisect_left
+from functools import wraps
+
+from twisted.internet import reactor as default_reactor
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0)
+
+
+def escape(value):
+    return unicode(value).replace(
+        '\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % (','.join(
+        '%s="%s"' % (name, escape(value)) for name, value in pairs),)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def render(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s %s' % (self.name, self.type),
+        ]
+        for values, value in sorted(self.values.iteritems()):
+            lines.extend(self.render_value(values, value))
+        return lines
+
+    def render_value(self, values, value):
+        return ['%s%s %s' % (
+            self.name, format_labels(self.labels, values),
+            format_value(value))]
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, *values, **kwargs):
+        amount = kwargs.get('amount', 1)
+        self.values[values] = self.values.get(values, 0) + amount
+
+
+class Gauge(Metric):
+
+    type = 'gauge'
+
+    def inc(self, *values):
+        self.values[values] = self.values.get(values, 0) + 1
+
+    def dec(self, *values):
+        self.values[values] = self.values.get(values, 0) - 1
+
+    def set(self, value, *values):
+        self.values[values] = value
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, amount, *values):
+        counts = self.values.get(values)
+        if counts is None:
+            counts = self.values[values] = [
+                [0] * (len(self.buckets) + 1), 0.0]
+        counts[0][bisect_left(self.buckets, amount)] += 1
+        counts[1] += amount
+
+    def render_value(self, values, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (
+                self.name,
+                format_labels(
+                    self.labels, values, [('le', format_value(bound))]),
+                cumulative))
+        labels = format_labels(self.labels, values)
+        lines.append('%s_sum%s %s' % (self.name, labels, format_value(total)))
+        lines.append('%s_count%s %d' % (self.name, labels, cumulative))
+        return lines
+
+
+class Metrics(object):
+    """
+    A registry of counters, gauges and histograms rendered in the
+    Prometheus text exposition format.
+    """
+
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, clock=default_reactor):
+        self.clock = clock
+        self.metrics = []
+        self.http_requests = self.histogram(
+            'portia_http_request_duration_seconds',
+            'Time spent handling HTTP requests.', ['route'])
+        self.http_responses = self.counter(
+            'portia_http_responses_total',
+            'HTTP responses sent.', ['route', 'code'])
+        self.http_in_flight = self.gauge(
+            'portia_http_requests_in_flight',
+            'HTTP requests being handled.')
+        self.tcp_commands = self.histogram(
+            'portia_tcp_command_duration_seconds',
+            'Time spent handling TCP commands.', ['command'])
+        self.tcp_replies = self.counter(
+            'portia_tcp_replies_total',
+            'TCP command replies sent.', ['command', 'status'])
+        self.tcp_in_flight = self.gauge(
+            'portia_tcp_commands_in_flight',
+            'TCP commands being handled.')
+        self.tcp_connections = self.gauge(
+            'portia_tcp_connections',
+            'Open TCP connections.')
+        self.tcp_queue_depth = self.histogram(
+            'portia_tcp_queue_depth',
+            'Commands in flight on a connection as each one arrives.',
+            buckets=[1, 2, 5, 10, 25, 50, 100, 250, 500, 1000])
+        self.tcp_pauses = self.counter(
+            'portia_tcp_pauses_total',
+            'Times a connection stopped being read from because too many '
+            'of its commands were in flight.')
+        self.tcp_paused = self.gauge(
+            'portia_tcp_connections_paused',
+            'TCP connections not being read from.')
+        self.redis_commands = self.histogram(
+            'portia_redis_command_duration_seconds',
+            'Time spent waiting for Redis replies.', ['command'])
+        self.redis_errors = self.counter(
+            'portia_redis_errors_total',
+            'Redis commands that failed.', ['command'])
+
+        self.caches = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def track_cache(self, name, cache):
+        """
+        Expose the size and the hit, miss, eviction and expiration counts
+        of an ``LRUCache`` labelled with ``name``, they are read from the
+        cache whenever the metrics are rendered.
+        """
+        if not self.caches:
+            self.cache_entries = self.gauge(
+                'portia_cache_entries',
+                'Entries held in an in-memory cache.', ['cache'])
+            self.cache_hits = self.counter(
+                'portia_cache_hits_total',
+                'Cache lookups that found a live entry.', ['cache'])
+            self.cache_misses = self.counter(
+                'portia_cache_misses_total',
+                'Cache lookups that found no live entry.', ['cache'])
+            self.cache_evictions = self.counter(
+                'portia_cache_evictions_total',
+                'Entries dropped to make room for new ones.', ['cache'])
+            self.cache_expirations = self.counter(
+                'portia_cache_expirations_total',
+                'Entries found to have outlived their TTL.', ['cache'])
+        self.caches.append((name, cache))
+
+    def collect(self):
+        for name, cache in self.caches:
+            stats = cache.stats()
+            self.cache_entries.set(stats['size'], name)
+            for metric, key in [(self.cache_hits, 'hits'),
+                                (self.cache_misses, 'misses'),
+                                (self.cache_evictions, 'evictions'),
+                                (self.cache_expirations, 'expirations')]:
+                metric.values[(name,)] = stats[key]
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def time(self, d, callback):
+        """
+        Call ``callback`` with the result of ``d`` and the seconds it took
+        to fire, passes the result through.
+        """
+        started = self.clock.seconds()
+
+        def timed(result):
+            callback(result, self.clock.seconds() - started)
+            return result
+
+        return d.addBoth(timed)
+
+    def render(self):
+        self.collect()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return (u'\n'.join(lines) + u'\n').encode('utf-8')
+
+
+def timed_route(name):
+    """
+    Record the duration and response code of a ``PortiaWebServer`` route
+    if the server has metrics enabled.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, request, *args, **kwargs):
+            metrics = self.metrics
+            if metrics is None:
+                return func(self, request, *args, **kwargs)
+
+            metrics.http_in_flight.inc()
+            started = metrics.clock.seconds()
+
+            def finished(result):
+                metrics.http_in_flight.dec()
+                metrics.http_requests.observe(
+                    metrics.clock.seconds() - started, name)
+                metrics.http_responses.inc(
+                    name, 500 if isinstance(result, Failure) else request.code)
+                return result
+
+            try:
+                result = func(self, request, *args, **kwargs)
+            except Exception:
+                request.setResponseCode(500)
+                finished(None)
+                raise
+
+            if isinstance(result, Deferred):
+                return result.addBoth(finished)
+            return finished(result)
+        return wrapper
+    return decorator
+
+
+class InstrumentedRedis(object):
+    """
+    Wraps a txredisapi connection and records how long each command
+    takes to be answered. Commands queued in a MULTI block are timed
+    together as ``EXEC``.
+    """
+
+    def __init__(self, redis, metrics):
+        self._redis = redis
+        self._metrics = metrics
+
+    def _record(self, command):
+        def record(result, duration):
+            self._metrics.redis_commands.observe(duration, command)
+            if isinstance(result, Failure):
+                self._metrics.redis_errors.inc(command)
+        return record
+
+    def __getattr__(self, name):
+        attr = getattr(self._redis, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            command = name.upper()
+            if name == 'execute_command':
+                command = str(args[0]).upper()
+            d = attr(*args, **kwargs)
+            if not isinstance(d, Deferred):
+                return d
+            self._metrics.time(d, self._record(command))
+            if name == 'multi':
+                d.addCallback(InstrumentedTransaction, self._metrics)
+            return d
+        return call
+
+
+class InstrumentedTransaction(InstrumentedRedis):
+
+    def commit(self):
+        d = self._redis.commit()
+        return self._metrics.time(d, self._record('EXEC'))
+
+    def __getattr__(self, name):
+        return getattr(self._redis, name)
@@ -0,0 +1,91 @@
+import re
+
+import phonenumbers
+from phonenumbers import PhoneMetadata, PhoneNumber, PhoneNumberFormat
+from phonenumbers.phonenumberutil import COUNTRY_CODE_TO_REGION_CODE
+
+from .cache import LRUCache
+
+E164 = re.compile(r'^\+[1-9][0-9]{6,14}$')
+
+
+class NormalizedNumber(PhoneNumber):
+    """
+    A ``PhoneNumber`` that carries its E.164 format as ``msisdn`` so it
+    never needs to be formatted again.
+    """
+
+    @classmethod
+    def from_phonenumber(cls, phonenumber):
+        number = cls()
+        number.merge_from(phonenumber)
+        number.msisdn = phonenumbers.format_number(
+            phonenumber, PhoneNumberFormat.E164)
+        return number
+
+
+class MsisdnNormalizer(object):
+    """
+    Parses MSISDNs into ``NormalizedNumber`` instances and remembers the
+    last ``size`` of them.
+
+    Input that already is in E.164 format is split into its country code
+    and national number directly. It only goes through
+    ``phonenumbers.parse`` if the national number starts with a zero or
+    could start with a national prefix, which ``phonenumbers.parse``
+    would strip.
+    """
+
+    def __init__(self, size=65536):
+        self.cache = LRUCache(size)
+        self.national_prefixes = {}
+
+    def parse(self, msisdn):
+        number = self.cache.get(msisdn)
+        if number is None:
+            number = self.cache.set(msisdn, self.normalize(msisdn))
+        return number
+
+    def normalize(self, msisdn):
+        number = None
+        if isinstance(msisdn, basestring) and E164.match(msisdn):
+            number = self.split_e164(msisdn)
+        if number is None:
+            number = NormalizedNumber.from_phonenumber(
+                phonenumbers.parse(msisdn))
+        return number
+
+    def national_prefix(self, country_code):
+        """
+        The pattern of national prefixes ``phonenumbers.parse`` strips
+        for ``country_code``, ``None`` if there are none and ``False`` if
+        the country code is unknown.
+        """
+        if country_code not in self.national_prefixes:
+            pattern = False
+            regions = COUNTRY_CODE_TO_REGION_CODE.get(country_code)
+            if regions:
+                metadata = PhoneMetadata.metadata_for_region_or_calling_code(
+                    country_code, regions[0])
+                if metadata is not None:
+                    pattern = metadata.national_prefix_for_parsing
+                    if pattern is not None:
+                        pattern = re.compile(pattern)
+            self.national_prefixes[country_code] = pattern
+        return self.national_prefixes[country_code]
+
+    def split_e164(self, msisdn):
+        for length in (1, 2, 3):
+            country_code = int(msisdn[1:1 + length])
+            national = msisdn[1 + length:]
+            pattern = self.national_prefix(country_code)
+            if pattern is False:
+                continue
+            if national.startswith('0') or (
+                    pattern is not None and pattern.match(national)):
+                return None
+            number = NormalizedNumber(
+                country_code=country_code, national_number=int(national))
+            number.msisdn = str(msisdn)
+            return number
+        return None
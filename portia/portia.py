@@ -1,34 +1,21 @@
 import csv
 import phonenumbers
-from phonenumbers import geocoder
-from phonenumbers import timezone
-from phonenumbers import carrier
-from datetime import datetime, tzinfo, timedelta
+from itertools import chain
+from datetime import datetime
 
 from twisted.internet.defer import gatherResults, succeed, maybeDeferred
 
 from .exceptions import PortiaException
-
-
-class UTC(tzinfo):
-    """
-    UTC implementation taken from Python's docs.
-    """
-
-    def __repr__(self):
-        return "<UTC>"
-
-    def utcoffset(self, dt):
-        return timedelta(0)
-
-    def tzname(self, dt):
-        return "UTC"
-
-    def dst(self, dt):
-        return timedelta(0)
+from .prefixes import NetworkPrefixTrie
+from .metadata import GeocodeMetadata
+from .normalize import MsisdnNormalizer, NormalizedNumber
+from .storage import HashStorage
+from .utils import UTC, chunked
 
 
 def as_msisdn(pn):
+    if isinstance(pn, NormalizedNumber):
+        return pn.msisdn
     return phonenumbers.format_number(pn, phonenumbers.PhoneNumberFormat.E164)
 
 
@@ -46,10 +33,19 @@ class Portia(object):
         'ported-to',
     ])
 
-    def __init__(self, redis, prefix="portia:", network_prefix_mapping=None):
+    def __init__(self, redis, prefix="portia:", network_prefix_mapping=None,
+                 resolve_cache=None, geocode_metadata=None, storage=None,
+                 normalizer=None):
         self.redis = redis
         self.prefix = prefix
-        self.network_prefix_mapping = network_prefix_mapping or {}
+        self.storage = storage or HashStorage(redis, prefix)
+        self.resolve_cache = resolve_cache
+        self.geocode_metadata = geocode_metadata or GeocodeMetadata()
+        self.normalizer = normalizer or MsisdnNormalizer()
+        if not isinstance(network_prefix_mapping, NetworkPrefixTrie):
+            network_prefix_mapping = NetworkPrefixTrie.from_mapping(
+                network_prefix_mapping or {})
+        self.network_prefix_mapping = network_prefix_mapping
         self.timezone = UTC()
 
     def to_utc(self, timestamp):
@@ -60,8 +56,13 @@ class Portia(object):
     def now(self):
         return self.to_utc(datetime.utcnow())
 
-    def key(self, *parts):
-        return '%s%s' % (self.prefix, ':'.join(parts))
+    def parse(self, msisdn):
+        """
+        Parse ``msisdn`` into a phonenumber that is formatted for free
+        everywhere else, raises ``phonenumbers.NumberParseException`` like
+        ``phonenumbers.parse``.
+        """
+        return self.normalizer.parse(msisdn)
 
     def import_porting_filename(self, file_name, has_header=True):
         with open(file_name, 'r') as fp:
@@ -80,8 +81,47 @@ class Portia(object):
                     datetime.strptime(date, '%Y%m%d')))
         return gatherResults(records)
 
+    def parse_porting_row(self, row):
+        msisdn, donor, recipient, date = row[0:4]
+        return (self.parse(msisdn), donor, recipient,
+                datetime.strptime(date, '%Y%m%d'))
+
+    def import_porting_rows(self, rows):
+        d = maybeDeferred(
+            lambda: [self.parse_porting_row(row) for row in rows])
+        d.addCallback(self.write_porting_records)
+        return d
+
+    def write_porting_records(self, records):
+        """
+        Write ``(phonenumber, donor, recipient, timestamp)`` records
+        in a single round trip, fires with the number of records and the
+        number of annotations skipped because newer ones were stored.
+        """
+        return self.write_porting_msisdns([
+            (as_msisdn(phonenumber), donor, recipient, timestamp)
+            for phonenumber, donor, recipient, timestamp in records])
+
+    def write_porting_msisdns(self, records):
+        """
+        Like ``write_porting_records`` for records that already have the
+        MSISDN in E.164 format instead of a phonenumber.
+        """
+        entries = []
+        for msisdn, donor, recipient, timestamp in records:
+            annotations = self.annotation('ported-to', recipient, timestamp)
+            annotations.update(
+                self.annotation('ported-from', donor, timestamp))
+            entries.append((msisdn, annotations))
+
+        d = self.storage.write_many(entries)
+        d.addCallback(self.invalidate_msisdns, *[
+            msisdn for msisdn, _, _, _ in records])
+        d.addCallback(lambda skipped: (len(records), skipped))
+        return d
+
     def import_porting_record(self, msisdn, donor, recipient, timestamp):
-        phonenumber = phonenumbers.parse(msisdn)
+        phonenumber = self.parse(msisdn)
         d = gatherResults([
             self.annotate(
                 phonenumber,
@@ -98,7 +138,28 @@ class Portia(object):
         return d
 
     def remove(self, phonenumber):
-        return self.redis.delete(self.key(as_msisdn(phonenumber)))
+        d = self.storage.remove(as_msisdn(phonenumber))
+        d.addCallback(self.invalidate, phonenumber)
+        return d
+
+    def invalidate(self, result, *phonenumbers):
+        """
+        Drop cached resolve results for ``phonenumbers``, passes ``result``
+        through so it can be used as a callback after writes.
+        """
+        return self.invalidate_msisdns(result, *map(as_msisdn, phonenumbers))
+
+    def invalidate_msisdns(self, result, *msisdns):
+        if self.resolve_cache is not None:
+            msisdns = list(msisdns)
+            self.resolve_cache.invalidate(*(msisdns + [
+                self.cache_key(msisdn, entry=False) for msisdn in msisdns]))
+        return result
+
+    def cache_key(self, msisdn, entry=True):
+        if entry:
+            return msisdn
+        return (msisdn, 'without-entry')
 
     def validate_annotate_key(self, key):
         if key not in self.ANNOTATION_KEYS and not key.startswith('X-'):
@@ -106,35 +167,108 @@ class Portia(object):
         return key
 
     def network_prefix_lookup(self, phonenumber, mapping):
-        msisdn = as_msisdn(phonenumber)
-        for key, value in mapping.iteritems():
-            if msisdn.startswith('+%s' % (key,)):
-                if isinstance(value, dict):
-                    return self.network_prefix_lookup(
-                        phonenumber, value)
-                return succeed(value)
-        return succeed(None)
-
-    def resolve(self, phonenumber):
-        d = self.get_annotations(phonenumber)
-        d.addCallback(self.resolve_cb, phonenumber)
+        if not isinstance(mapping, NetworkPrefixTrie):
+            mapping = NetworkPrefixTrie.from_mapping(mapping)
+        return succeed(mapping.lookup(as_msisdn(phonenumber)))
+
+    def resolve(self, phonenumber, entry=True):
+        """
+        Resolve the network for ``phonenumber``. Unless ``entry`` is set
+        only the ``RESOLVE_KEYS`` are fetched and the result has no
+        ``entry``.
+        """
+        if self.resolve_cache is None:
+            return self.resolve_uncached(phonenumber, entry=entry)
+
+        key = self.cache_key(as_msisdn(phonenumber), entry=entry)
+        cached = self.resolve_cache.get(key)
+        if cached is not None:
+            return succeed(cached)
+
+        d = self.resolve_uncached(phonenumber, entry=entry)
+        d.addCallback(
+            lambda result, version: self.resolve_cache.set(
+                key, result, version=version),
+            self.resolve_cache.version)
+        return d
+
+    def resolve_uncached(self, phonenumber, entry=True):
+        if entry:
+            d = self.get_annotations(phonenumber)
+        else:
+            d = self.storage.get_keys(
+                as_msisdn(phonenumber), self.RESOLVE_KEYS)
+        d.addCallback(self.resolve_entry, phonenumber, entry=entry)
+        return d
+
+    def resolve_many(self, phonenumbers, chunk_size=1000, entry=True):
+        """
+        Resolve a list of phonenumbers, entries are fetched with one
+        round trip per ``chunk_size`` numbers. Fires with the results
+        in the same order as ``phonenumbers``.
+        """
+        results = [None] * len(phonenumbers)
+        misses = []
+        for index, phonenumber in enumerate(phonenumbers):
+            if self.resolve_cache is not None:
+                results[index] = self.resolve_cache.get(
+                    self.cache_key(as_msisdn(phonenumber), entry=entry))
+            if results[index] is None:
+                misses.append((index, phonenumber))
+
+        version = None
+        if self.resolve_cache is not None:
+            version = self.resolve_cache.version
+
+        def resolved(chunk_results, chunk):
+            for (index, phonenumber), result in zip(chunk, chunk_results):
+                if self.resolve_cache is not None:
+                    self.resolve_cache.set(
+                        self.cache_key(as_msisdn(phonenumber), entry=entry),
+                        result, version=version)
+                results[index] = result
+
+        def resolve_chunk(chunk):
+            d = self.resolve_uncached_many(
+                [phonenumber for _, phonenumber in chunk], entry=entry)
+            d.addCallback(resolved, chunk)
+            return d
+
+        d = gatherResults([
+            resolve_chunk(chunk) for chunk in chunked(misses, chunk_size)])
+        d.addCallback(lambda _: results)
+        return d
+
+    def resolve_uncached_many(self, phonenumbers, entry=True):
+        if entry:
+            d = self.get_annotations_many(
+                phonenumbers, chunk_size=len(phonenumbers))
+        else:
+            d = self.storage.get_keys_many(
+                map(as_msisdn, phonenumbers), self.RESOLVE_KEYS)
+        d.addCallback(lambda entries: gatherResults([
+            self.resolve_entry(annotations, phonenumber, entry=entry)
+            for annotations, phonenumber in zip(entries, phonenumbers)]))
+        return d
+
+    def resolve_entry(self, annotations, phonenumber, entry=True):
+        d = maybeDeferred(self.resolve_cb, annotations, phonenumber)
+        if not entry:
+            d.addCallback(self.without_entry)
         d.addCallback(self.resolve_geocode, phonenumber)
         return d
 
+    def without_entry(self, result):
+        del result['entry']
+        return result
+
     def resolve_geocode(self, annotations, phonenumber):
-        defaults = {
-            'msisdn': phonenumbers.format_number(
-                phonenumber, phonenumbers.PhoneNumberFormat.E164),
+        defaults = dict(self.geocode_metadata.lookup(phonenumber))
+        defaults.update({
+            'msisdn': as_msisdn(phonenumber),
             'country_code': phonenumber.country_code,
             'national_number': phonenumber.national_number,
-            'region_code': geocoder.region_code_for_country_code(
-                phonenumber.country_code),
-            'country_description': geocoder.country_name_for_number(
-                phonenumber, "en"),
-            'original_carrier': carrier.name_for_number(phonenumber, "en"),
-            'timezones': timezone.time_zones_for_number(
-                phonenumber)
-        }
+        })
         defaults.update(annotations)
         return defaults
 
@@ -171,42 +305,59 @@ class Portia(object):
         })
         return d
 
+    def annotation(self, key, value, timestamp):
+        return {key: (value, self.to_utc(timestamp))}
+
     def annotate(self, phonenumber, key, value, timestamp):
+        """
+        Store an annotation unless a newer one is stored already, fires
+        with the number of annotations skipped.
+        """
         d = maybeDeferred(self.validate_annotate_key, key)
-        d.addCallback(lambda key: self.redis.hmset(
-            self.key(as_msisdn(phonenumber)), {
-                key: value,
-                '%s-timestamp' % (key,): self.to_utc(timestamp).isoformat(),
-            }))
+        d.addCallback(lambda key: self.storage.write(
+            as_msisdn(phonenumber), self.annotation(key, value, timestamp)))
+        d.addCallback(self.invalidate, phonenumber)
         return d
 
     def get_annotations(self, phonenumber):
-        return self.redis.hgetall(self.key(as_msisdn(phonenumber)))
+        return self.storage.get(as_msisdn(phonenumber))
+
+    def get_annotations_many(self, phonenumbers, chunk_size=1000):
+        """
+        Fetch the entries for a list of phonenumbers with one round
+        trip per ``chunk_size`` numbers, fires with the entries in the
+        same order.
+        """
+        d = gatherResults([
+            self.storage.get_many(map(as_msisdn, chunk))
+            for chunk in chunked(phonenumbers, chunk_size)])
+        d.addCallback(lambda chunks: list(chain.from_iterable(chunks)))
+        return d
 
     def remove_annotations(self, phonenumber, *keys):
         d = gatherResults([
             maybeDeferred(self.validate_annotate_key, key) for key in keys])
-        d.addCallback(lambda keys: keys + [
-            '%s-timestamp' % (key,) for key in keys])
-        d.addCallback(lambda keys: self.redis.hdel(
-            self.key(as_msisdn(phonenumber)), keys))
+        d.addCallback(lambda keys: self.storage.delete_annotations(
+            as_msisdn(phonenumber), keys))
+        d.addCallback(self.invalidate, phonenumber)
         return d
 
+    def get_timestamps(self, phonenumber):
+        return self.storage.get_timestamps(as_msisdn(phonenumber))
+
     def read_annotation(self, phonenumber, key):
         d = maybeDeferred(self.validate_annotate_key, key)
-        d.addCallback(lambda key: [key, '%s-timestamp' % (key,)])
         d.addCallback(
-            lambda keys: self.redis.hmget(
-                self.key(as_msisdn(phonenumber)), keys))
-        d.addCallback(lambda values: {
-            key: values[0],
-            '%s-timestamp' % (key,): values[1],
-        })
+            lambda key: self.storage.read(as_msisdn(phonenumber), key))
         return d
 
-    def flush(self):
-        d = self.redis.keys('%s*' % (self.prefix,))
-        d.addCallback(lambda keys: gatherResults([
-            self.redis.delete(key) for key in keys
-        ]))
+    def flush(self, count=1000, concurrency=4, progress=None):
+        d = self.storage.flush(
+            count=count, concurrency=concurrency, progress=progress)
+        d.addCallback(self.clear_cache)
         return d
+
+    def clear_cache(self, result=None):
+        if self.resolve_cache is not None:
+            self.resolve_cache.clear()
+        return result
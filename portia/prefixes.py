@@ -0,0 +1,77 @@
+from twisted.python import log
+
+
+class NetworkPrefixTrie(object):
+    """
+    An immutable digit trie mapping MSISDN prefixes to networks.
+
+    Lookups return the network of the longest matching prefix and take
+    time proportional to the number of digits in the MSISDN rather than
+    the number of prefixes known.
+
+    :param list mappings:
+        A list of, possibly nested, mappings of prefixes to network names
+        as found in the ``*.mapping.json`` files. Later mappings take
+        precedence over earlier ones where prefixes conflict.
+    """
+
+    def __init__(self, mappings=()):
+        self.conflicts = []
+        self.shadowed = []
+        self.size = 0
+        root = [None, {}]
+        for mapping in mappings:
+            self._insert(root, mapping)
+        self._root = self._freeze(root)
+
+    @classmethod
+    def from_mapping(cls, mapping):
+        return cls([mapping])
+
+    def _insert(self, root, mapping, parent=None):
+        for prefix, value in sorted(mapping.items()):
+            prefix = str(prefix).lstrip('+')
+            if not prefix.isdigit():
+                log.msg('Ignoring invalid network prefix: %r.' % (prefix,))
+                continue
+            if parent is not None and not prefix.startswith(parent):
+                # These were never reachable with nested dictionary lookups
+                self.shadowed.append((parent, prefix))
+            if isinstance(value, dict):
+                self._insert(root, value, parent=prefix)
+                continue
+            node = root
+            for digit in prefix:
+                node = node[1].setdefault(digit, [None, {}])
+            if node[0] is None:
+                self.size += 1
+            elif node[0] != value:
+                self.conflicts.append((prefix, node[0], value))
+            node[0] = value
+
+    def _freeze(self, node):
+        value, children = node
+        return (value, dict(
+            (digit, self._freeze(child))
+            for digit, child in children.iteritems()))
+
+    def lookup(self, msisdn):
+        """
+        Return the network for the longest prefix matching ``msisdn``
+        or ``None`` if no prefix matches.
+        """
+        network, children = self._root
+        for digit in msisdn.lstrip('+'):
+            node = children.get(digit)
+            if node is None:
+                break
+            value, children = node
+            if value is not None:
+                network = value
+        return network
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return '<NetworkPrefixTrie prefixes=%d>' % (self.size,)
@@ -1,31 +1,191 @@
 import json
+import struct
 
 import dateutil.parser
 import phonenumbers
 
+from twisted.internet import reactor as default_reactor
 from twisted.internet.protocol import Factory
 from twisted.internet.defer import maybeDeferred
 from twisted.protocols.basic import LineReceiver
+from twisted.python.failure import Failure
 
-from .exceptions import JsonProtocolException
+from .exceptions import PortiaException, JsonProtocolException
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+class JsonFraming(object):
+    """
+    Newline delimited JSON, what every connection starts with.
+    """
+
+    name = 'json'
+
+    def dumps(self, message):
+        return json.dumps(message)
+
+    def loads(self, payload):
+        return json.loads(payload)
+
+    def encode(self, message):
+        return [self.dumps(message), JsonProtocol.delimiter]
+
+
+class MessagePackFraming(object):
+    """
+    MessagePack messages each prefixed with their length as a 32 bit big
+    endian integer. The ``version`` is settled by the handshake and the
+    ``cmd`` and ``reference_cmd`` of replies are implied by the
+    ``reference_id``, so those are left out.
+    """
+
+    name = 'msgpack'
+    header = struct.Struct('>I')
+    implied = ('version', 'cmd', 'reference_cmd')
+
+    def dumps(self, message):
+        return msgpack.packb(dict(
+            (key, value) for key, value in message.iteritems()
+            if key not in self.implied), use_bin_type=False)
+
+    def loads(self, payload):
+        return msgpack.unpackb(payload, raw=False)
+
+    def encode(self, message):
+        payload = self.dumps(message)
+        return [self.header.pack(len(payload)), payload]
+
+
+FRAMINGS = dict(
+    (framing.name, framing)
+    for framing in [JsonFraming, MessagePackFraming]
+    if framing is not MessagePackFraming or msgpack is not None)
 
 
 class JsonProtocol(LineReceiver):
+    """
+    Answers newline delimited JSON commands.
+
+    At most ``max_in_flight`` commands are handled at a time per
+    connection, once that many are in flight the connection stops being
+    read from until half of them have been answered. Replies are written
+    out together once the commands that finish in the same reactor
+    iteration have been answered, or as soon as ``max_in_flight`` of them
+    are waiting.
+
+    A ``framing`` command as the only one in flight switches a JSON
+    connection to another of the ``FRAMINGS``. It is answered in JSON and
+    every message after it uses the new framing.
+    """
 
     version = '0.1.0'
 
-    def __init__(self, portia):
+    def __init__(self, portia, metrics=None, max_in_flight=100,
+                 clock=default_reactor):
         self.portia = portia
+        self.metrics = metrics
+        self.max_in_flight = max_in_flight
+        self.clock = clock
+        self.in_flight = 0
+        self.replies = []
+        self.flush_call = None
+        self.framing = JsonFraming()
+        self.next_framing = None
+        self.frames = ''
+
+    def connectionMade(self):
+        if self.metrics is not None:
+            self.metrics.tcp_connections.inc()
+
+    def connectionLost(self, reason):
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        if self.metrics is not None:
+            self.metrics.tcp_connections.dec()
+            if self.paused:
+                self.metrics.tcp_paused.dec()
 
     def valid_version(self, received_version):
         return received_version == self.version
 
     def lineReceived(self, line):
-        d = maybeDeferred(self.parseLine, line)
+        self.received(self.parseLine, line)
+
+    def rawDataReceived(self, data):
+        self.frames += data
+        self.process_frames()
+
+    def process_frames(self):
+        header = MessagePackFraming.header
+        while len(self.frames) >= header.size and not self.paused:
+            length, = header.unpack_from(self.frames)
+            if length > self.MAX_LENGTH:
+                self.frames = ''
+                self.transport.loseConnection()
+                return
+            end = header.size + length
+            if len(self.frames) < end:
+                return
+            frame = self.frames[header.size:end]
+            self.frames = self.frames[end:]
+            self.received(self.parseFrame, frame)
+
+    def received(self, parse, message):
+        self.in_flight += 1
+        if self.metrics is not None:
+            self.metrics.tcp_queue_depth.observe(self.in_flight)
+        if self.in_flight >= self.max_in_flight and not self.paused:
+            self.pauseProducing()
+            if self.metrics is not None:
+                self.metrics.tcp_pauses.inc()
+                self.metrics.tcp_paused.inc()
+
+        d = maybeDeferred(parse, message)
         d.addErrback(self.error)
+        d.addBoth(self.finished)
+
+    def finished(self, _):
+        self.in_flight -= 1
+        if self.paused and self.in_flight <= self.max_in_flight // 2 and \
+                self.transport.connected:
+            if self.metrics is not None:
+                self.metrics.tcp_paused.dec()
+            self.resumeProducing()
+            if not self.line_mode:
+                self.process_frames()
+
+    def send_reply(self, data):
+        self.replies.extend(self.framing.encode(data))
+        if self.next_framing is not None:
+            self.framing, self.next_framing = self.next_framing, None
+        if len(self.replies) >= self.max_in_flight * 2:
+            self.flush_replies()
+        elif self.flush_call is None:
+            self.flush_call = self.clock.callLater(0, self.flush_replies)
+
+    def flush_replies(self):
+        if self.flush_call is not None:
+            if self.flush_call.active():
+                self.flush_call.cancel()
+            self.flush_call = None
+        replies, self.replies = self.replies, []
+        if replies:
+            self.transport.writeSequence(replies)
 
     def parseLine(self, line):
-        data = json.loads(line)
+        return self.handle_message(json.loads(line))
+
+    def parseFrame(self, frame):
+        data = self.framing.loads(frame)
+        if isinstance(data, dict):
+            data.setdefault('version', self.version)
+        return self.handle_message(data)
+
+    def handle_message(self, data):
         version = data.get('version')
         command = data.pop('cmd', None)
         reference_id = data.pop('id', None)
@@ -43,20 +203,34 @@ class JsonProtocol(LineReceiver):
                 command=command,
                 reference_id=reference_id)
 
-        d = handler(**data.get('request'))
+        d = maybeDeferred(handler, **data.get('request'))
+        if self.metrics is not None:
+            self.track(d, command)
         d.addCallback(self.reply, command, reference_id)
         d.addErrback(self.error, command, reference_id)
         return d
 
+    def track(self, d, command):
+        metrics = self.metrics
+        metrics.tcp_in_flight.inc()
+
+        def record(result, duration):
+            metrics.tcp_in_flight.dec()
+            metrics.tcp_commands.observe(duration, command)
+            metrics.tcp_replies.inc(
+                command, 'error' if isinstance(result, Failure) else 'ok')
+
+        return metrics.time(d, record)
+
     def reply(self, data, cmd, reference_id):
-        self.sendLine(json.dumps({
+        self.send_reply({
             'status': 'ok',
             'cmd': 'reply',
             'reference_cmd': cmd,
             'reference_id': reference_id,
             'version': self.version,
             'response': data,
-        }))
+        })
 
     def error(self, failure, command=None, reference_id=None):
         exc = failure.check(JsonProtocolException)
@@ -64,38 +238,100 @@ class JsonProtocol(LineReceiver):
             command = failure.value.command
             reference_id = failure.value.reference_id
 
-        self.sendLine(json.dumps({
+        self.send_reply({
             'status': 'error',
             'reference_cmd': command,
             'reference_id': reference_id,
             'message': failure.getErrorMessage(),
             'version': self.version,
-        }))
+        })
+
+    def handle_framing(self, framing):
+        if framing not in FRAMINGS:
+            raise PortiaException('Unsupported framing: %s.' % (framing,))
+        if self.in_flight > 1:
+            raise PortiaException(
+                'Framing can only be changed with no commands in flight.')
+        if framing != self.framing.name:
+            if not self.line_mode:
+                raise PortiaException(
+                    'Framing can only be changed from JSON.')
+            self.next_framing = FRAMINGS[framing]()
+            self.setRawMode()
+        return framing
 
     def handle_get(self, msisdn):
-        phonenumber = phonenumbers.parse(msisdn)
+        phonenumber = self.portia.parse(msisdn)
         return self.portia.get_annotations(phonenumber)
 
     def handle_annotate(self, msisdn, key, value, timestamp=None):
-        phonenumber = phonenumbers.parse(msisdn)
+        phonenumber = self.portia.parse(msisdn)
         if timestamp:
             ts = self.portia.to_utc(dateutil.parser.parse(timestamp))
         else:
             ts = self.portia.now()
-        return self.portia.annotate(phonenumber, key, value, timestamp=ts)
+        d = self.portia.annotate(phonenumber, key, value, timestamp=ts)
+        d.addCallback(lambda _: 'OK')
+        return d
 
-    def handle_resolve(self, msisdn):
+    def handle_resolve(self, msisdn, entry=True):
         return self.portia.resolve(
-            phonenumbers.parse(msisdn))
+            self.portia.parse(msisdn), entry=entry)
+
+    def parse_many(self, msisdns):
+        """
+        Parse a list of MSISDNs, the errors of those that cannot be
+        parsed are keyed by the MSISDN as given or by its JSON encoding if
+        it is not a string.
+        """
+        if not isinstance(msisdns, list):
+            raise PortiaException('msisdns must be a list.')
+        parsed = []
+        errors = {}
+        for msisdn in msisdns:
+            if not isinstance(msisdn, basestring):
+                key = json.dumps(msisdn)
+                errors[key] = {'error': 'Invalid MSISDN: %s' % (key,)}
+                continue
+            try:
+                parsed.append((msisdn, self.portia.parse(msisdn)))
+            except (PortiaException, phonenumbers.NumberParseException), e:
+                errors[msisdn] = {'error': str(e)}
+        return parsed, errors
+
+    def reply_many(self, results, parsed, errors):
+        reply = dict(
+            (msisdn, result)
+            for (msisdn, _), result in zip(parsed, results))
+        reply.update(errors)
+        return reply
+
+    def handle_get_many(self, msisdns):
+        parsed, errors = self.parse_many(msisdns)
+        d = self.portia.get_annotations_many(
+            [phonenumber for _, phonenumber in parsed])
+        d.addCallback(self.reply_many, parsed, errors)
+        return d
+
+    def handle_resolve_many(self, msisdns, entry=True):
+        parsed, errors = self.parse_many(msisdns)
+        d = self.portia.resolve_many(
+            [phonenumber for _, phonenumber in parsed], entry=entry)
+        d.addCallback(self.reply_many, parsed, errors)
+        return d
 
 
 class JsonProtocolFactory(Factory):
     protocol = JsonProtocol
 
-    def __init__(self, portia):
+    def __init__(self, portia, metrics=None, max_in_flight=100):
         self.portia = portia
+        self.metrics = metrics
+        self.max_in_flight = max_in_flight
 
     def buildProtocol(self, *args):
-        p = self.protocol(self.portia)
+        p = self.protocol(
+            self.portia, metrics=self.metrics,
+            max_in_flight=self.max_in_flight)
         p.factory = self
         return p
@@ -0,0 +1,192 @@
+from collections import OrderedDict
+from itertools import cycle
+
+from twisted.internet import reactor as default_reactor
+
+from .exceptions import PortiaException
+from .storage import Storage
+
+
+class RoundRobin(object):
+    """
+    Hands out the replicas in turn.
+    """
+
+    def __init__(self, replicas):
+        self.replicas = cycle(replicas)
+
+    def choose(self):
+        return next(self.replicas)
+
+    def observe(self, replica, duration, failed=False):
+        pass
+
+
+class LeastLatency(object):
+    """
+    Hands out the replica with the lowest moving average of read
+    latencies. Failed reads count as ``failure_penalty`` seconds so a
+    replica that is down is only tried now and again.
+
+    Only the chosen replica is timed, so every read also shrinks the
+    averages of the others by ``decay``. A replica that was slow or down
+    drifts back below the one in use and gets another try, rather than
+    being shunned on stale numbers forever.
+    """
+
+    def __init__(self, replicas, alpha=0.2, failure_penalty=1.0,
+                 decay=0.01):
+        self.replicas = list(replicas)
+        self.alpha = alpha
+        self.failure_penalty = failure_penalty
+        self.decay = decay
+        self.latencies = dict((id(replica), 0.0) for replica in replicas)
+
+    def choose(self):
+        return min(
+            self.replicas, key=lambda replica: self.latencies[id(replica)])
+
+    def observe(self, replica, duration, failed=False):
+        if failed:
+            duration += self.failure_penalty
+        for other in self.replicas:
+            if other is not replica:
+                self.latencies[id(other)] *= 1 - self.decay
+        latency = self.latencies[id(replica)]
+        self.latencies[id(replica)] = (
+            latency + self.alpha * (duration - latency))
+
+
+STRATEGIES = {
+    'round-robin': RoundRobin,
+    'least-latency': LeastLatency,
+}
+
+
+class ReplicatedStorage(Storage):
+    """
+    Sends writes to the ``primary`` storage and reads to its
+    ``replicas``, falling back to the primary if a replica read fails.
+
+    :param float read_your_writes:
+        For how many seconds after an MSISDN is annotated or removed its
+        reads go to the primary so they see the write, ``0`` to disable.
+        Batch writes like imports are not tracked.
+    """
+
+    def __init__(self, primary, replicas, strategy='round-robin',
+                 read_your_writes=0, clock=default_reactor):
+        if not replicas:
+            raise PortiaException('At least one replica is needed.')
+        if strategy not in STRATEGIES:
+            raise PortiaException('Unknown replica strategy: %s.' % (
+                strategy,))
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.strategy = STRATEGIES[strategy](self.replicas)
+        self.read_your_writes = read_your_writes
+        self.clock = clock
+        self.recent_writes = OrderedDict()
+
+    def shard_key(self, msisdn):
+        return self.primary.shard_key(msisdn)
+
+    def written(self, result, msisdn):
+        if self.read_your_writes:
+            now = self.clock.seconds()
+            self.recent_writes.pop(msisdn, None)
+            self.recent_writes[msisdn] = now + self.read_your_writes
+            while next(self.recent_writes.itervalues()) <= now:
+                self.recent_writes.popitem(last=False)
+        return result
+
+    def recently_written(self, msisdn):
+        expires = self.recent_writes.get(msisdn)
+        return expires is not None and expires > self.clock.seconds()
+
+    def from_replica(self, method, *args):
+        """
+        Call ``method`` on a replica, or on the primary if that fails.
+        """
+        replica = self.strategy.choose()
+        started = self.clock.seconds()
+
+        def observe(result, failed):
+            self.strategy.observe(
+                replica, self.clock.seconds() - started, failed=failed)
+            return result
+
+        d = getattr(replica, method)(*args)
+        d.addCallbacks(
+            observe, observe, callbackArgs=(False,), errbackArgs=(True,))
+        d.addErrback(lambda _: getattr(self.primary, method)(*args))
+        return d
+
+    def read_from(self, method, msisdns, *args):
+        if any(self.recently_written(msisdn) for msisdn in msisdns):
+            return getattr(self.primary, method)(*args)
+        return self.from_replica(method, *args)
+
+    def write(self, msisdn, annotations):
+        d = self.primary.write(msisdn, annotations)
+        return d.addCallback(self.written, msisdn)
+
+    def write_many(self, entries):
+        return self.primary.write_many(entries)
+
+    def get(self, msisdn):
+        return self.read_from('get', [msisdn], msisdn)
+
+    def get_many(self, msisdns):
+        return self.read_from('get_many', msisdns, msisdns)
+
+    def get_keys(self, msisdn, keys):
+        return self.read_from('get_keys', [msisdn], msisdn, keys)
+
+    def get_keys_many(self, msisdns, keys):
+        return self.read_from('get_keys_many', msisdns, msisdns, keys)
+
+    def read(self, msisdn, key):
+        return self.read_from('read', [msisdn], msisdn, key)
+
+    def get_timestamps(self, msisdn):
+        return self.read_from('get_timestamps', [msisdn], msisdn)
+
+    def delete_annotations(self, msisdn, keys):
+        d = self.primary.delete_annotations(msisdn, keys)
+        return d.addCallback(self.written, msisdn)
+
+    def remove(self, msisdn):
+        d = self.primary.remove(msisdn)
+        return d.addCallback(self.written, msisdn)
+
+    def flush(self, count=1000, concurrency=4, progress=None):
+        self.recent_writes.clear()
+        return self.primary.flush(
+            count=count, concurrency=concurrency, progress=progress)
+
+    def scan_entries(self, process, count=1000, concurrency=4):
+        return self.primary.scan_entries(
+            process, count=count, concurrency=concurrency)
+
+
+def parse_replica_uris(values, redis_uris):
+    """
+    Map each of ``redis_uris`` to its replicas' URIs. Replicas are given
+    as ``<primary uri>,<replica uri>``, the primary can be left out if
+    there is only one.
+    """
+    replicas = OrderedDict((redis_uri, []) for redis_uri in redis_uris)
+    for value in values:
+        primary, _, replica = value.rpartition(',')
+        if not primary:
+            if len(replicas) != 1:
+                raise PortiaException(
+                    'Replica %s needs its primary as <primary uri>,'
+                    '<replica uri>.' % (replica,))
+            primary = next(iter(replicas))
+        if primary not in replicas:
+            raise PortiaException(
+                'Replica %s is for unknown primary %s.' % (replica, primary))
+        replicas[primary].append(replica)
+    return replicas
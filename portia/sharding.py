@@ -0,0 +1,179 @@
+from bisect import bisect
+from collections import OrderedDict
+from hashlib import md5
+from itertools import chain
+
+from twisted.internet.defer import gatherResults
+
+from .exceptions import PortiaException
+from .replication import ReplicatedStorage, parse_replica_uris
+from .storage import Storage, storage_for_layout
+from .utils import start_redis
+
+
+class HashRing(object):
+    """
+    A consistent hash ring, each node is placed on the ring ``replicas``
+    times so keys spread evenly and adding or removing a node only moves
+    the keys it owns.
+    """
+
+    def __init__(self, nodes, replicas=160):
+        if not nodes:
+            raise PortiaException('A hash ring needs at least one node.')
+        points = sorted(
+            (self.hash('%s-%d' % (node, replica)), node)
+            for node in nodes for replica in range(replicas))
+        self.points = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    @staticmethod
+    def hash(value):
+        return int(md5(value).hexdigest()[:8], 16)
+
+    def get(self, key):
+        index = bisect(self.points, self.hash(key)) % len(self.points)
+        return self.nodes[index]
+
+
+class ShardedStorage(Storage):
+    """
+    Spreads MSISDNs over several storages with consistent hashing.
+    Batch operations are split up per shard and run in parallel.
+
+    :param list shards:
+        The storages to shard over, all with the same layout.
+    :param list names:
+        What each shard is known as on the hash ring, typically its Redis
+        URI. These, not the order of ``shards``, decide where MSISDNs go.
+    """
+
+    def __init__(self, shards, names=None, replicas=160):
+        self.shards = list(shards)
+        names = list(names or map(str, range(len(self.shards))))
+        if len(names) != len(self.shards):
+            raise PortiaException('Every shard needs a name.')
+        if len(set(names)) != len(names):
+            raise PortiaException('Shard names must be unique.')
+        self.by_name = dict(zip(names, self.shards))
+        self.ring = HashRing(names, replicas=replicas)
+
+    def shard(self, msisdn):
+        return self.by_name[self.ring.get(self.shards[0].shard_key(msisdn))]
+
+    def group(self, items, msisdn=lambda item: item):
+        """
+        Split ``items`` up per shard into an ordered mapping of shard to
+        ``(positions, items)``.
+        """
+        groups = OrderedDict()
+        for position, item in enumerate(items):
+            positions, grouped = groups.setdefault(
+                self.shard(msisdn(item)), ([], []))
+            positions.append(position)
+            grouped.append(item)
+        return groups
+
+    def fan_out(self, msisdns, call):
+        """
+        Call ``call`` with each shard and its share of ``msisdns`` in
+        parallel and put the per MSISDN results back in order.
+        """
+        groups = self.group(msisdns)
+
+        def merge(replies):
+            results = [None] * len(msisdns)
+            for (positions, _), reply in zip(groups.values(), replies):
+                for position, result in zip(positions, reply):
+                    results[position] = result
+            return results
+
+        d = gatherResults([
+            call(shard, grouped)
+            for shard, (_, grouped) in groups.iteritems()])
+        return d.addCallback(merge)
+
+    def write(self, msisdn, annotations):
+        return self.shard(msisdn).write(msisdn, annotations)
+
+    def write_many(self, entries):
+        d = gatherResults([
+            shard.write_many(grouped)
+            for shard, (_, grouped) in self.group(
+                entries, msisdn=lambda entry: entry[0]).iteritems()])
+        return d.addCallback(sum)
+
+    def get(self, msisdn):
+        return self.shard(msisdn).get(msisdn)
+
+    def get_many(self, msisdns):
+        return self.fan_out(
+            msisdns, lambda shard, grouped: shard.get_many(grouped))
+
+    def get_keys(self, msisdn, keys):
+        return self.shard(msisdn).get_keys(msisdn, keys)
+
+    def get_keys_many(self, msisdns, keys):
+        return self.fan_out(
+            msisdns, lambda shard, grouped: shard.get_keys_many(grouped, keys))
+
+    def read(self, msisdn, key):
+        return self.shard(msisdn).read(msisdn, key)
+
+    def get_timestamps(self, msisdn):
+        return self.shard(msisdn).get_timestamps(msisdn)
+
+    def delete_annotations(self, msisdn, keys):
+        return self.shard(msisdn).delete_annotations(msisdn, keys)
+
+    def remove(self, msisdn):
+        return self.shard(msisdn).remove(msisdn)
+
+    def flush(self, count=1000, concurrency=4, progress=None):
+        d = gatherResults([
+            shard.flush(
+                count=count, concurrency=concurrency, progress=progress)
+            for shard in self.shards])
+        return d.addCallback(sum)
+
+    def scan_entries(self, process, count=1000, concurrency=4):
+        d = gatherResults([
+            shard.scan_entries(process, count=count, concurrency=concurrency)
+            for shard in self.shards])
+        return d.addCallback(sum)
+
+
+def start_storage(redis_uris, prefix, layout='hash', bucket_digits=2,
+                  wrap=None, replica_uris=(), replica_strategy='round-robin',
+                  read_your_writes=0, **redis_options):
+    """
+    Connect to each of ``redis_uris`` and fire with a storage using
+    ``layout``, sharded over them if there is more than one. ``wrap`` is
+    called with each connection and returns what the storage should use.
+    Reads are sent to the replicas in ``replica_uris``, see
+    ``parse_replica_uris``.
+    """
+    replicas = parse_replica_uris(replica_uris, redis_uris)
+    uris = list(redis_uris) + list(chain.from_iterable(replicas.values()))
+
+    def connected(connections):
+        storages = iter([
+            storage_for_layout(
+                layout, wrap(redis) if wrap else redis, prefix,
+                bucket_digits=bucket_digits)
+            for redis in connections])
+        primaries = [next(storages) for _ in redis_uris]
+        shards = [
+            ReplicatedStorage(
+                primary, [next(storages) for _ in replicas[redis_uri]],
+                strategy=replica_strategy,
+                read_your_writes=read_your_writes)
+            if replicas[redis_uri] else primary
+            for redis_uri, primary in zip(redis_uris, primaries)]
+        if len(shards) == 1:
+            return shards[0]
+        return ShardedStorage(shards, names=redis_uris)
+
+    d = gatherResults([
+        start_redis(redis_uri, **redis_options) for redis_uri in uris])
+    return d.addCallback(connected)
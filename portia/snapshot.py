@@ -0,0 +1,263 @@
+import mmap
+import os
+import struct
+from datetime import datetime, timedelta
+
+from twisted.internet.defer import succeed, fail, maybeDeferred
+from twisted.internet.task import coiterate
+
+from .exceptions import PortiaException, ReadOnlyStorageException
+from .storage import Storage, parse_annotations
+from .utils import UTC
+
+MAGIC = 'PORTIASN'
+VERSION = 1
+
+# The annotations a snapshot holds, in the order of a record's slots.
+SLOTS = ('observed-network', 'ported-to', 'ported-from', 'do-not-call')
+
+# Magic, version, slots, records, keys offset, records offset,
+# dictionary offset.
+HEADER = struct.Struct('<8sHHQQQQ')
+KEY = struct.Struct('<Q')
+# A value id into the dictionary and epoch microseconds per slot.
+RECORD = struct.Struct('<' + 'Hq' * len(SLOTS))
+LENGTH = struct.Struct('<H')
+COUNT = struct.Struct('<I')
+
+MISSING = 0xFFFF
+EPOCH = datetime(1970, 1, 1, tzinfo=UTC())
+
+
+def pack_msisdn(msisdn):
+    """
+    Turn an E.164 MSISDN into the integer it is sorted and searched by,
+    ``None`` if it is not one.
+    """
+    digits = msisdn[1:]
+    if not msisdn.startswith('+') or not digits.isdigit() or \
+            len(digits) > 15:
+        return None
+    return int(digits)
+
+
+def to_epoch(timestamp):
+    delta = timestamp - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10 ** 6 + \
+        delta.microseconds
+
+
+def from_epoch(epoch):
+    return (EPOCH + timedelta(microseconds=epoch)).isoformat()
+
+
+class SnapshotBuilder(Storage):
+    """
+    Collects entries in memory through the storage write interface and
+    saves them as a snapshot file for ``SnapshotStorage``. Only the
+    ``SLOTS`` annotations are kept, others are counted in ``dropped``.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.dropped = 0
+
+    def write_many(self, entries):
+        skipped = 0
+        for msisdn, annotations in entries:
+            key = pack_msisdn(msisdn)
+            if key is None:
+                raise PortiaException('Invalid MSISDN: %s.' % (msisdn,))
+            slots = self.entries.setdefault(key, [None] * len(SLOTS))
+            for name, (value, timestamp) in annotations.iteritems():
+                if name not in SLOTS:
+                    self.dropped += 1
+                    continue
+                index = SLOTS.index(name)
+                epoch = to_epoch(timestamp)
+                if slots[index] is not None and slots[index][1] >= epoch:
+                    skipped += 1
+                    continue
+                slots[index] = (value, epoch)
+        return succeed(skipped)
+
+    def add_entries(self, entries):
+        """
+        Add ``(msisdn, annotations)`` entries as read from a storage.
+        """
+        d = self.write_many([
+            (msisdn, parse_annotations(annotations))
+            for msisdn, annotations in entries])
+        d.addCallback(lambda _: len(entries))
+        return d
+
+    def save(self, path):
+        """
+        Write the snapshot to ``path``, replacing it atomically. Returns
+        the number of entries saved.
+        """
+        values = {}
+        for slots in self.entries.itervalues():
+            for slot in slots:
+                if slot is not None:
+                    values.setdefault(slot[0], len(values))
+        if len(values) >= MISSING:
+            raise PortiaException(
+                'Too many distinct values for a snapshot: %d.' % (
+                    len(values),))
+
+        keys = sorted(self.entries)
+        keys_offset = HEADER.size
+        records_offset = keys_offset + KEY.size * len(keys)
+        dictionary_offset = records_offset + RECORD.size * len(keys)
+
+        tmp_path = '%s.tmp' % (path,)
+        with open(tmp_path, 'wb') as fp:
+            fp.write(HEADER.pack(
+                MAGIC, VERSION, len(SLOTS), len(keys), keys_offset,
+                records_offset, dictionary_offset))
+            for key in keys:
+                fp.write(KEY.pack(key))
+            for key in keys:
+                fields = []
+                for slot in self.entries[key]:
+                    if slot is None:
+                        fields.extend([MISSING, 0])
+                    else:
+                        fields.extend([values[slot[0]], slot[1]])
+                fp.write(RECORD.pack(*fields))
+            fp.write(COUNT.pack(len(values)))
+            for value, _ in sorted(values.items(), key=lambda item: item[1]):
+                if isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                fp.write(LENGTH.pack(len(value)))
+                fp.write(value)
+        os.rename(tmp_path, path)
+        return len(keys)
+
+
+class SnapshotStorage(Storage):
+    """
+    A read-only storage backed by a snapshot file built with
+    ``SnapshotBuilder``.
+
+    The file holds a header, the MSISDNs as sorted 64 bit integers, a
+    fixed width record per MSISDN with a value id and timestamp for each
+    of the ``SLOTS`` and a dictionary of the values. It is memory mapped
+    and MSISDNs are found with a binary search over the mapping, only the
+    dictionary is read at startup.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.getsize(path) < HEADER.size:
+            raise PortiaException('Not a Portia snapshot: %s.' % (path,))
+        with open(path, 'rb') as fp:
+            self.mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, slots, self.count, self.keys_offset,
+         self.records_offset, dictionary_offset) = HEADER.unpack_from(
+            self.mmap)
+        if magic != MAGIC:
+            raise PortiaException('Not a Portia snapshot: %s.' % (path,))
+        if version != VERSION or slots != len(SLOTS):
+            raise PortiaException(
+                'Unsupported snapshot version %d: %s.' % (version, path))
+        self.values = self.load_values(dictionary_offset)
+
+    def load_values(self, offset):
+        values = []
+        count, = COUNT.unpack_from(self.mmap, offset)
+        offset += COUNT.size
+        for _ in range(count):
+            length, = LENGTH.unpack_from(self.mmap, offset)
+            offset += LENGTH.size
+            values.append(self.mmap[offset:offset + length])
+            offset += length
+        return values
+
+    def close(self):
+        self.mmap.close()
+
+    def find(self, msisdn):
+        """
+        Return the index of ``msisdn``'s record or ``None``.
+        """
+        key = pack_msisdn(msisdn)
+        if key is None:
+            return None
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            found, = KEY.unpack_from(
+                self.mmap, self.keys_offset + middle * KEY.size)
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                return middle
+        return None
+
+    def record(self, index, keys=SLOTS):
+        annotations = {}
+        if index is None:
+            return annotations
+        fields = RECORD.unpack_from(
+            self.mmap, self.records_offset + index * RECORD.size)
+        for slot, name in enumerate(SLOTS):
+            value_id, epoch = fields[slot * 2:slot * 2 + 2]
+            if value_id != MISSING and name in keys:
+                annotations[name] = self.values[value_id]
+                annotations['%s-timestamp' % (name,)] = from_epoch(epoch)
+        return annotations
+
+    def msisdn(self, index):
+        key, = KEY.unpack_from(
+            self.mmap, self.keys_offset + index * KEY.size)
+        return '+%d' % (key,)
+
+    def read_only(self, *args, **kwargs):
+        return fail(
+            ReadOnlyStorageException('The snapshot storage is read-only.'))
+
+    write = write_many = delete_annotations = remove = flush = read_only
+
+    def get(self, msisdn):
+        return succeed(self.record(self.find(msisdn)))
+
+    def get_many(self, msisdns):
+        return succeed([
+            self.record(self.find(msisdn)) for msisdn in msisdns])
+
+    def get_keys(self, msisdn, keys):
+        return succeed(self.record(self.find(msisdn), keys))
+
+    def get_keys_many(self, msisdns, keys):
+        return succeed([
+            self.record(self.find(msisdn), keys) for msisdn in msisdns])
+
+    def read(self, msisdn, key):
+        annotations = self.record(self.find(msisdn), [key])
+        timestamp_key = '%s-timestamp' % (key,)
+        return succeed({
+            key: annotations.get(key),
+            timestamp_key: annotations.get(timestamp_key),
+        })
+
+    def scan_entries(self, process, count=1000, concurrency=4):
+        totals = [0]
+
+        def add(total):
+            totals[0] += total
+
+        def batches():
+            for start in xrange(0, self.count, count):
+                d = maybeDeferred(process, [
+                    (self.msisdn(index), self.record(index))
+                    for index in xrange(
+                        start, min(start + count, self.count))])
+                yield d.addCallback(add)
+
+        d = coiterate(batches())
+        d.addCallback(lambda _: totals[0])
+        return d
@@ -0,0 +1,806 @@
+from datetime import datetime, timedelta
+from itertools import chain
+
+import dateutil.parser
+
+from twisted.internet.defer import (
+    gatherResults, succeed, maybeDeferred, DeferredSemaphore)
+from twisted.python.failure import Failure
+
+from txredisapi import ResponseError, ScriptDoesNotExist
+
+from .exceptions import PortiaException
+from .utils import UTC, chunked
+
+
+class Storage(object):
+    """
+    Where ``Portia`` keeps its annotations, every method returns a
+    Deferred.
+
+    Storages are handed MSISDNs in E.164 format and annotations as a
+    mapping of ``{key: (value, timestamp)}`` with UTC timestamps. Reads
+    return annotations as ``{key: value, '<key>-timestamp': isoformat}``
+    whatever the backend.
+
+    Writes only replace an annotation if the incoming timestamp is newer
+    than the stored one and fire with the number of annotations skipped.
+    """
+
+    def write(self, msisdn, annotations):
+        return self.write_many([(msisdn, annotations)])
+
+    def write_many(self, entries):
+        """
+        Write a list of ``(msisdn, annotations)`` entries.
+        """
+        raise NotImplementedError()
+
+    def get(self, msisdn):
+        raise NotImplementedError()
+
+    def get_many(self, msisdns):
+        raise NotImplementedError()
+
+    def get_keys(self, msisdn, keys):
+        """
+        Fetch only the annotations for ``keys``, annotations that are not
+        stored are left out.
+        """
+        raise NotImplementedError()
+
+    def get_keys_many(self, msisdns, keys):
+        raise NotImplementedError()
+
+    def read(self, msisdn, key):
+        """
+        Fetch the annotation for ``key``, with ``None`` for the value and
+        timestamp if it is not stored.
+        """
+        raise NotImplementedError()
+
+    def get_timestamps(self, msisdn):
+        """
+        Fetch only the timestamps of the annotations stored for
+        ``msisdn`` as ``{key: isoformat}``, enough to tell whether an
+        entry changed without fetching its values.
+        """
+        d = self.get(msisdn)
+        d.addCallback(lambda annotations: dict(
+            (key[:-len('-timestamp')], timestamp)
+            for key, timestamp in annotations.iteritems()
+            if key.endswith('-timestamp')))
+        return d
+
+    def delete_annotations(self, msisdn, keys):
+        raise NotImplementedError()
+
+    def remove(self, msisdn):
+        raise NotImplementedError()
+
+    def flush(self, count=1000, concurrency=4, progress=None):
+        """
+        Delete everything, fires with the number of keys deleted.
+        """
+        raise NotImplementedError()
+
+    def scan_entries(self, process, count=1000, concurrency=4):
+        """
+        Walk every entry and call ``process`` with each batch of
+        ``(msisdn, annotations)`` found, at most ``concurrency`` batches
+        at a time. Fires with the sum of what ``process`` returned.
+        """
+        raise NotImplementedError()
+
+    def shard_key(self, msisdn):
+        """
+        What ``msisdn`` is placed on a shard by, MSISDNs sharing a Redis
+        key must share a shard.
+        """
+        return msisdn
+
+
+class RedisStorage(Storage):
+    """
+    The Redis plumbing shared by the storage layouts: batched reads and
+    prefix-wide maintenance.
+
+    Writes go through a Lua script which checks the timestamps and
+    writes atomically.
+    """
+
+    # Batches of reads go through scripts rather than MULTI blocks so
+    # that each batch is a single command, which any connection in the
+    # pool can run concurrently with the others. txredisapi hands a
+    # connection to the next waiting MULTI while it is still processing
+    # the previous EXEC reply and loses track of the replies.
+    HGETALL_SCRIPT = """
+    local hashes = {}
+    for i, key in ipairs(KEYS) do
+        hashes[i] = redis.call('HGETALL', key)
+    end
+    return hashes
+    """
+
+    HMGET_SCRIPT = """
+    local count = #ARGV / #KEYS
+    local values = {}
+    for i, key in ipairs(KEYS) do
+        values[i] = redis.call(
+            'HMGET', key, unpack(ARGV, (i - 1) * count + 1, i * count))
+    end
+    return values
+    """
+
+    def __init__(self, redis, prefix):
+        self.redis = redis
+        self.prefix = prefix
+        self.unlink_supported = True
+        self.script_hashes = {}
+
+    def eval_script(self, script, keys, args):
+        """
+        Run ``script`` with EVALSHA, loading it with SCRIPT LOAD the
+        first time it is used or if Redis has lost it since.
+        """
+        def load():
+            d = self.redis.script_load(script)
+            d.addCallback(
+                lambda script_hash: self.script_hashes.update(
+                    {script: script_hash}))
+            d.addCallback(lambda _: evalsha())
+            return d
+
+        def evalsha():
+            return self.redis.evalsha(self.script_hashes[script], keys, args)
+
+        def reload(failure):
+            failure.trap(ScriptDoesNotExist)
+            return load()
+
+        if script not in self.script_hashes:
+            return load()
+        d = evalsha()
+        d.addErrback(reload)
+        return d
+
+    def hgetall_many(self, keys):
+        """
+        Fetch the hashes at ``keys`` in one round trip, missing ones are
+        empty.
+        """
+        if not keys:
+            return succeed([])
+        d = self.eval_script(self.HGETALL_SCRIPT, keys, [])
+        d.addCallback(lambda hashes: [
+            dict(zip(fields[::2], fields[1::2])) for fields in hashes])
+        return d
+
+    def hmget_many(self, keys, fields):
+        """
+        Fetch the fields listed for each of the hashes at ``keys`` in one
+        round trip, with ``None`` for fields that are not set. Every hash
+        must have the same number of fields listed.
+        """
+        if not keys:
+            return succeed([])
+        return self.eval_script(
+            self.HMGET_SCRIPT, keys, list(chain.from_iterable(fields)))
+
+    def scan_keys(self, process, match=None, count=1000, concurrency=4):
+        """
+        Walk every key matching ``match``, which defaults to everything
+        under ``prefix``, with SCAN and call ``process`` with each batch
+        of keys found. SCAN does not block Redis the way KEYS does and at
+        most ``concurrency`` batches are processed at a time. Fires with
+        the sum of what ``process`` returned.
+        """
+        if match is None:
+            match = '%s*' % (self.prefix,)
+
+        semaphore = DeferredSemaphore(concurrency)
+        pending = set()
+        failures = []
+        totals = [0]
+
+        def finished(result, d):
+            pending.discard(d)
+            semaphore.release()
+            if isinstance(result, Failure):
+                failures.append(result)
+            else:
+                totals[0] += result
+
+        def start(_, keys):
+            d = maybeDeferred(process, keys)
+            pending.add(d)
+            d.addBoth(finished, d)
+
+        def scanned(reply):
+            cursor, keys = reply
+            d = succeed(None)
+            if keys:
+                d = semaphore.acquire()
+                d.addCallback(start, keys)
+            if int(cursor):
+                d.addCallback(lambda _: scan(cursor))
+            return d
+
+        def scan(cursor):
+            d = self.redis.scan(cursor, match, count)
+            d.addCallback(scanned)
+            return d
+
+        def done(_):
+            if failures:
+                return failures[0]
+            return totals[0]
+
+        d = scan(0)
+        d.addCallback(lambda _: gatherResults(list(pending)))
+        d.addCallback(done)
+        return d
+
+    def unlink(self, keys):
+        """
+        Delete ``keys`` with UNLINK, which frees memory in the background,
+        falling back to DEL on Redis versions older than 4.0.
+        """
+        if not self.unlink_supported:
+            return self.redis.delete(keys)
+
+        def fallback(failure):
+            failure.trap(ResponseError)
+            if 'unknown command' not in str(failure.value).lower():
+                return failure
+            self.unlink_supported = False
+            return self.redis.delete(keys)
+
+        d = self.redis.execute_command('UNLINK', *keys)
+        d.addErrback(fallback)
+        return d
+
+    def flush(self, count=1000, concurrency=4, progress=None):
+        def delete(keys):
+            d = self.unlink(keys)
+            if progress is not None:
+                d.addCallback(progress.update)
+            return d
+
+        return self.scan_keys(delete, count=count, concurrency=concurrency)
+
+
+class HashStorage(RedisStorage):
+    """
+    Stores every MSISDN in its own hash at ``<prefix><msisdn>`` with
+    a ``<key>`` and ``<key>-timestamp`` field per annotation.
+    """
+
+    # KEYS[i] is written with the field, value & timestamp at ARGV[i * 3 - 2]
+    # onwards. ISO 8601 timestamps in UTC sort lexicographically.
+    WRITE_SCRIPT = """
+    local skipped = 0
+    for i, key in ipairs(KEYS) do
+        local field = ARGV[i * 3 - 2]
+        local timestamp = ARGV[i * 3]
+        local timestamp_field = field .. '-timestamp'
+        local current = redis.call('HGET', key, timestamp_field)
+        if current and current >= timestamp then
+            skipped = skipped + 1
+        else
+            redis.call(
+                'HMSET', key, field, ARGV[i * 3 - 1],
+                timestamp_field, timestamp)
+        end
+    end
+    return skipped
+    """
+
+    # Returns the timestamp fields of KEYS[1] and their values.
+    TIMESTAMPS_SCRIPT = """
+    local fields = redis.call('HGETALL', KEYS[1])
+    local timestamps = {}
+    for i = 1, #fields, 2 do
+        if string.sub(fields[i], -10) == '-timestamp' then
+            table.insert(timestamps, fields[i])
+            table.insert(timestamps, fields[i + 1])
+        end
+    end
+    return timestamps
+    """
+
+    def key(self, msisdn):
+        return '%s%s' % (self.prefix, msisdn)
+
+    def write_many(self, entries):
+        keys, args = [], []
+        for msisdn, annotations in entries:
+            for key, (value, timestamp) in annotations.iteritems():
+                keys.append(self.key(msisdn))
+                args.extend([key, value, timestamp.isoformat()])
+        return self.eval_script(self.WRITE_SCRIPT, keys, args)
+
+    def get(self, msisdn):
+        return self.redis.hgetall(self.key(msisdn))
+
+    def get_many(self, msisdns):
+        return self.hgetall_many([self.key(msisdn) for msisdn in msisdns])
+
+    def fields(self, keys):
+        return list(chain.from_iterable(
+            [key, '%s-timestamp' % (key,)] for key in keys))
+
+    def get_keys(self, msisdn, keys):
+        """
+        Fetch only the annotations for ``keys``, annotations that are not
+        stored are left out.
+        """
+        fields = self.fields(keys)
+        d = self.redis.hmget(self.key(msisdn), fields)
+        d.addCallback(lambda values: dict(
+            (field, value) for field, value in zip(fields, values)
+            if value is not None))
+        return d
+
+    def get_keys_many(self, msisdns, keys):
+        fields = self.fields(keys)
+        d = self.hmget_many(
+            [self.key(msisdn) for msisdn in msisdns],
+            [fields] * len(msisdns))
+        d.addCallback(lambda replies: [
+            dict((field, value) for field, value in zip(fields, values)
+                 if value is not None)
+            for values in replies])
+        return d
+
+    def read(self, msisdn, key):
+        timestamp_key = '%s-timestamp' % (key,)
+        d = self.redis.hmget(self.key(msisdn), [key, timestamp_key])
+        d.addCallback(lambda values: {
+            key: values[0],
+            timestamp_key: values[1],
+        })
+        return d
+
+    def get_timestamps(self, msisdn):
+        d = self.eval_script(self.TIMESTAMPS_SCRIPT, [self.key(msisdn)], [])
+        d.addCallback(lambda reply: dict(
+            (field[:-len('-timestamp')], timestamp)
+            for field, timestamp in zip(reply[::2], reply[1::2])))
+        return d
+
+    def delete_annotations(self, msisdn, keys):
+        return self.redis.hdel(self.key(msisdn), keys + [
+            '%s-timestamp' % (key,) for key in keys])
+
+    def remove(self, msisdn):
+        return self.redis.delete(self.key(msisdn))
+
+    def scan_entries(self, process, count=1000, concurrency=4):
+        """
+        Walk every entry with SCAN and call ``process`` with each batch
+        of ``(msisdn, annotations)`` found.
+        """
+        def fetch(keys):
+            d = self.get_many([key[len(self.prefix):] for key in keys])
+            d.addCallback(lambda entries: process([
+                (key[len(self.prefix):], annotations)
+                for key, annotations in zip(keys, entries)
+                if annotations]))
+            return d
+
+        return self.scan_keys(
+            fetch, match='%s+*' % (self.prefix,), count=count,
+            concurrency=concurrency)
+
+
+class CompactHashStorage(RedisStorage):
+    """
+    Packs MSISDNs into shared hashes to keep Redis' memory overhead down.
+
+    MSISDNs are bucketed on all but their last ``bucket_digits`` digits
+    into a hash at ``<prefix>c:<msisdn[:-bucket_digits]>`` holding one
+    ``<suffix>:<code>`` field per annotation. Values are stored as
+    ``<epoch microseconds> <value>`` and network names are dictionary
+    encoded as ``#<id>``, literal values are stored as ``=<value>``.
+
+    To keep the buckets listpack (or ziplist) encoded Redis'
+    ``hash-max-listpack-entries`` must allow for
+    ``10 ** bucket_digits`` times the annotations per MSISDN, 512 is
+    a good fit for the default of two digits.
+    """
+
+    KEY_CODES = {
+        'observed-network': 'o',
+        'ported-to': 't',
+        'ported-from': 'f',
+        'do-not-call': 'd',
+    }
+
+    CODE_KEYS = dict((code, key) for key, code in KEY_CODES.iteritems())
+
+    DICTIONARY_KEYS = frozenset([
+        'observed-network',
+        'ported-to',
+        'ported-from',
+    ])
+
+    EPOCH = datetime(1970, 1, 1, tzinfo=UTC())
+
+    # KEYS[i] is written with the field, packed value & epoch timestamp
+    # at ARGV[i * 3 - 2] onwards.
+    WRITE_SCRIPT = """
+    local skipped = 0
+    for i, key in ipairs(KEYS) do
+        local field = ARGV[i * 3 - 2]
+        local current = redis.call('HGET', key, field)
+        if current and tonumber(string.match(current, '^-?%d+'))
+                >= tonumber(ARGV[i * 3]) then
+            skipped = skipped + 1
+        else
+            redis.call('HSET', key, field, ARGV[i * 3 - 1])
+        end
+    end
+    return skipped
+    """
+
+    # Returns the codes and epoch timestamps of the fields in KEYS[1]
+    # for the suffix ARGV[1].
+    TIMESTAMPS_SCRIPT = """
+    local fields = redis.call('HGETALL', KEYS[1])
+    local prefix = ARGV[1] .. ':'
+    local timestamps = {}
+    for i = 1, #fields, 2 do
+        if string.sub(fields[i], 1, #prefix) == prefix then
+            table.insert(timestamps, string.sub(fields[i], #prefix + 1))
+            table.insert(
+                timestamps, string.match(fields[i + 1], '^-?%d+'))
+        end
+    end
+    return timestamps
+    """
+
+    def __init__(self, redis, prefix, bucket_digits=2):
+        super(CompactHashStorage, self).__init__(redis, prefix)
+        self.bucket_digits = bucket_digits
+        self.network_ids_key = '%snetwork-ids' % (prefix,)
+        self.network_names_key = '%snetwork-names' % (prefix,)
+        self.network_counter_key = '%snetwork-counter' % (prefix,)
+        self.network_ids = {}
+        self.network_names = {}
+
+    def bucket(self, msisdn):
+        return ('%sc:%s' % (self.prefix, msisdn[:-self.bucket_digits]),
+                msisdn[-self.bucket_digits:])
+
+    def field(self, suffix, key):
+        return '%s:%s' % (suffix, self.KEY_CODES.get(key, key))
+
+    def shard_key(self, msisdn):
+        return msisdn[:-self.bucket_digits]
+
+    def to_epoch(self, timestamp):
+        delta = timestamp - self.EPOCH
+        return (delta.days * 86400 + delta.seconds) * 10 ** 6 + \
+            delta.microseconds
+
+    def from_epoch(self, epoch):
+        return self.EPOCH + timedelta(microseconds=epoch)
+
+    def remember_network(self, network_id, name):
+        network_id, name = int(network_id), u'%s' % (name,)
+        self.network_ids[name] = network_id
+        self.network_names[network_id] = name
+        return network_id
+
+    def network_id(self, name):
+        """
+        Fire with the dictionary id for the network ``name``, allocating
+        one if the network has not been seen before.
+        """
+        if name in self.network_ids:
+            return succeed(self.network_ids[name])
+
+        def allocate(network_id):
+            # Publish the name before claiming it so readers can always
+            # decode an id found in a bucket. Ids lost in a race to claim
+            # a name are left unused.
+            d = self.redis.hset(self.network_names_key, network_id, name)
+            d.addCallback(lambda _: self.redis.hsetnx(
+                self.network_ids_key, name, network_id))
+            d.addCallback(
+                lambda claimed: network_id if claimed else self.redis.hget(
+                    self.network_ids_key, name))
+            return d
+
+        def found(network_id):
+            if network_id is not None:
+                return network_id
+            d = self.redis.incr(self.network_counter_key)
+            d.addCallback(allocate)
+            return d
+
+        d = self.redis.hget(self.network_ids_key, name)
+        d.addCallback(found)
+        d.addCallback(self.remember_network, name)
+        return d
+
+    def load_network_names(self, network_ids):
+        missing = list(set(network_ids) - set(self.network_names))
+        if not missing:
+            return succeed(None)
+
+        def loaded(names):
+            for network_id, name in zip(missing, names):
+                if name is None:
+                    raise PortiaException(
+                        'Unknown network id: %s' % (network_id,))
+                self.remember_network(network_id, name)
+
+        d = self.redis.hmget(self.network_names_key, missing)
+        d.addCallback(loaded)
+        return d
+
+    def pack(self, msisdn, key, value, timestamp):
+        """
+        Fire with the ``(bucket, field, packed value, epoch)`` an
+        annotation is written with.
+        """
+        bucket, suffix = self.bucket(msisdn)
+        epoch = self.to_epoch(timestamp)
+
+        def packed(encoded):
+            return (bucket, self.field(suffix, key),
+                    '%d %s' % (epoch, encoded), epoch)
+
+        if key in self.DICTIONARY_KEYS:
+            d = self.network_id(value)
+            d.addCallback(lambda network_id: packed('#%d' % (network_id,)))
+            return d
+        return succeed(packed('=%s' % (value,)))
+
+    def unpack(self, packed):
+        epoch, encoded = packed.split(' ', 1)
+        if encoded.startswith('#'):
+            value = self.network_names[int(encoded[1:])]
+        else:
+            value = encoded[1:]
+        return value, self.from_epoch(int(epoch)).isoformat()
+
+    def decode(self, fields):
+        """
+        Turn a mapping of ``{field: packed}`` for a bucket into a mapping
+        of ``{suffix: annotations}``.
+        """
+        network_ids = [
+            int(packed.split(' ', 1)[1][1:])
+            for packed in fields.itervalues()
+            if packed.split(' ', 1)[1].startswith('#')]
+
+        def decoded(_):
+            entries = {}
+            for field, packed in fields.iteritems():
+                suffix, code = field.split(':', 1)
+                key = self.CODE_KEYS.get(code, code)
+                value, timestamp = self.unpack(packed)
+                annotations = entries.setdefault(suffix, {})
+                annotations[key] = value
+                annotations['%s-timestamp' % (key,)] = timestamp
+            return entries
+
+        d = self.load_network_names(network_ids)
+        d.addCallback(decoded)
+        return d
+
+    def write_many(self, entries):
+        def write(packed):
+            keys, args = [], []
+            for bucket, field, value, epoch in packed:
+                keys.append(bucket)
+                args.extend([field, value, epoch])
+            return self.eval_script(self.WRITE_SCRIPT, keys, args)
+
+        d = gatherResults([
+            self.pack(msisdn, key, value, timestamp)
+            for msisdn, annotations in entries
+            for key, (value, timestamp) in annotations.iteritems()])
+        d.addCallback(write)
+        return d
+
+    def scan_fields(self, msisdn):
+        """
+        Fire with the raw ``{field: packed}`` stored for ``msisdn``.
+        """
+        bucket, suffix = self.bucket(msisdn)
+        fields = {}
+
+        def scanned(reply):
+            cursor, items = reply
+            fields.update(zip(items[::2], items[1::2]))
+            if int(cursor):
+                return scan(cursor)
+            return fields
+
+        def scan(cursor):
+            d = self.redis.hscan(
+                bucket, cursor, '%s:*' % (suffix,), 10 ** self.bucket_digits)
+            d.addCallback(scanned)
+            return d
+
+        return scan(0)
+
+    def get(self, msisdn):
+        bucket, suffix = self.bucket(msisdn)
+        d = self.scan_fields(msisdn)
+        d.addCallback(self.decode)
+        d.addCallback(lambda entries: entries.get(suffix, {}))
+        return d
+
+    def get_many(self, msisdns):
+        buckets = [self.bucket(msisdn) for msisdn in msisdns]
+        distinct = sorted(set(bucket for bucket, _ in buckets))
+
+        def picked(decoded):
+            entries = dict(zip(distinct, decoded))
+            return [dict(entries[bucket].get(suffix, {}))
+                    for bucket, suffix in buckets]
+
+        d = self.hgetall_many(distinct)
+        d.addCallback(lambda hashes: gatherResults([
+            self.decode(fields) for fields in hashes]))
+        d.addCallback(picked)
+        return d
+
+    def get_keys(self, msisdn, keys):
+        """
+        Fetch only the annotations for ``keys``, annotations that are not
+        stored are left out.
+        """
+        bucket, suffix = self.bucket(msisdn)
+        fields = [self.field(suffix, key) for key in keys]
+        d = self.redis.hmget(bucket, fields)
+        d.addCallback(lambda values: self.decode(dict(
+            (field, value) for field, value in zip(fields, values)
+            if value is not None)))
+        d.addCallback(lambda entries: entries.get(suffix, {}))
+        return d
+
+    def get_keys_many(self, msisdns, keys):
+        buckets = [self.bucket(msisdn) for msisdn in msisdns]
+
+        def decode(replies):
+            return gatherResults([
+                self.decode(dict(
+                    (self.field(suffix, key), value)
+                    for key, value in zip(keys, values)
+                    if value is not None))
+                for (bucket, suffix), values in zip(buckets, replies)])
+
+        d = self.hmget_many(
+            [bucket for bucket, _ in buckets],
+            [[self.field(suffix, key) for key in keys]
+             for _, suffix in buckets])
+        d.addCallback(decode)
+        d.addCallback(lambda decoded: [
+            entries.get(suffix, {})
+            for (bucket, suffix), entries in zip(buckets, decoded)])
+        return d
+
+    def read(self, msisdn, key):
+        bucket, suffix = self.bucket(msisdn)
+        timestamp_key = '%s-timestamp' % (key,)
+
+        def decoded(entries):
+            annotations = entries.get(suffix, {})
+            return {
+                key: annotations.get(key),
+                timestamp_key: annotations.get(timestamp_key),
+            }
+
+        d = self.redis.hget(bucket, self.field(suffix, key))
+        d.addCallback(
+            lambda packed: {} if packed is None else {
+                self.field(suffix, key): packed})
+        d.addCallback(self.decode)
+        d.addCallback(decoded)
+        return d
+
+    def get_timestamps(self, msisdn):
+        bucket, suffix = self.bucket(msisdn)
+        d = self.eval_script(self.TIMESTAMPS_SCRIPT, [bucket], [suffix])
+        d.addCallback(lambda reply: dict(
+            (self.CODE_KEYS.get(code, code),
+             self.from_epoch(int(epoch)).isoformat())
+            for code, epoch in zip(reply[::2], reply[1::2])))
+        return d
+
+    def delete_annotations(self, msisdn, keys):
+        bucket, suffix = self.bucket(msisdn)
+        return self.redis.hdel(
+            bucket, [self.field(suffix, key) for key in keys])
+
+    def remove(self, msisdn):
+        bucket, suffix = self.bucket(msisdn)
+        d = self.scan_fields(msisdn)
+        d.addCallback(
+            lambda fields: self.redis.hdel(bucket, fields.keys())
+            if fields else 0)
+        return d
+
+    def flush(self, count=1000, concurrency=4, progress=None):
+        d = super(CompactHashStorage, self).flush(
+            count=count, concurrency=concurrency, progress=progress)
+        d.addCallback(self.forget_networks)
+        return d
+
+    def forget_networks(self, result=None):
+        self.network_ids.clear()
+        self.network_names.clear()
+        return result
+
+    def scan_entries(self, process, count=1000, concurrency=4):
+        """
+        Walk every entry with SCAN and call ``process`` with each batch
+        of ``(msisdn, annotations)`` found.
+        """
+        def fetch(buckets):
+            d = self.hgetall_many(buckets)
+            d.addCallback(lambda hashes: gatherResults([
+                self.decode(fields) for fields in hashes]))
+            d.addCallback(lambda decoded: process([
+                ('%s%s' % (bucket[len(self.prefix) + len('c:'):], suffix),
+                 annotations)
+                for bucket, entries in zip(buckets, decoded)
+                for suffix, annotations in sorted(entries.iteritems())]))
+            return d
+
+        return self.scan_keys(
+            fetch, match='%sc:*' % (self.prefix,), count=count,
+            concurrency=concurrency)
+
+
+LAYOUTS = {
+    'hash': HashStorage,
+    'compact': CompactHashStorage,
+}
+
+
+def storage_for_layout(layout, redis, prefix, bucket_digits=2):
+    if layout not in LAYOUTS:
+        raise PortiaException('Unknown storage layout: %s.' % (layout,))
+    if layout == 'compact':
+        return CompactHashStorage(redis, prefix, bucket_digits=bucket_digits)
+    return LAYOUTS[layout](redis, prefix)
+
+
+def parse_annotations(annotations):
+    """
+    Turn annotations as read from a storage back into the
+    ``{key: (value, timestamp)}`` mapping storages are written with.
+    """
+    return dict(
+        (key, (value, dateutil.parser.parse(
+            annotations['%s-timestamp' % (key,)])))
+        for key, value in annotations.iteritems()
+        if not key.endswith('-timestamp'))
+
+
+def migrate(source, target, count=1000, concurrency=4, progress=None):
+    """
+    Copy every entry from the ``source`` storage into ``target`` and
+    remove it from ``source``. Fires with the number of entries migrated.
+    """
+    def copy(entries):
+        d = maybeDeferred(lambda: gatherResults([
+            target.write_many([
+                (msisdn, parse_annotations(annotations))
+                for msisdn, annotations in chunk])
+            for chunk in chunked(entries, count)]))
+        d.addCallback(lambda _: gatherResults([
+            source.remove(msisdn) for msisdn, annotations in entries]))
+        d.addCallback(lambda _: len(entries))
+        if progress is not None:
+            d.addCallback(progress.update)
+        return d
+
+    return source.scan_entries(copy, count=count, concurrency=concurrency)
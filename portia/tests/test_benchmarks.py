@@ -0,0 +1,85 @@
+import phonenumbers
+from datetime import datetime
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial.unittest import TestCase
+
+from portia.benchmarks.memory import MemoryStorage
+from portia.benchmarks.suite import (
+    percentile, summarise, measure, compare, parse_thresholds)
+from portia.portia import Portia
+
+
+class SuiteTest(TestCase):
+
+    def test_percentile(self):
+        samples = range(1, 101)
+        self.assertEqual(percentile(samples, 50), 50)
+        self.assertEqual(percentile(samples, 99), 99)
+        self.assertEqual(percentile([3], 90), 3)
+        self.assertEqual(percentile([], 90), 0.0)
+
+    def test_summarise(self):
+        summary = summarise([0.002, 0.001, 0.003, 0.004], 0.01)
+        self.assertEqual(summary['ops'], 4)
+        self.assertAlmostEqual(summary['ops_per_sec'], 400)
+        self.assertAlmostEqual(summary['p50_ms'], 2)
+        self.assertAlmostEqual(summary['max_ms'], 4)
+
+    @inlineCallbacks
+    def test_measure(self):
+        calls = []
+        summary = yield measure(calls.append, 10, warmup=2)
+        self.assertEqual(calls, [0, 1] + range(10))
+        self.assertEqual(summary['ops'], 10)
+
+    def test_compare(self):
+        baseline = {
+            'resolve': {'ops_per_sec': 1000.0, 'p99_ms': 1.0},
+            'lookup': {'ops_per_sec': 1000.0, 'p99_ms': 1.0},
+        }
+        results = {
+            'resolve': {'ops_per_sec': 850.0, 'p99_ms': 1.05},
+            'lookup': {'ops_per_sec': 1000.0, 'p99_ms': 1.5},
+            'new': {'ops_per_sec': 1.0, 'p99_ms': 100.0},
+        }
+        self.assertEqual(compare(results, baseline, threshold=0.1), [
+            ('lookup', 'p99_ms', 1.0, 1.5),
+            ('resolve', 'ops_per_sec', 1000.0, 850.0),
+        ])
+        self.assertEqual(
+            compare(results, baseline, threshold=0.1, thresholds={
+                'resolve': 0.2, 'lookup': 0.5}),
+            [])
+
+    def test_parse_thresholds(self):
+        self.assertEqual(
+            parse_thresholds(['resolve=0.2']), {'resolve': 0.2})
+        self.assertRaises(Exception, parse_thresholds, ['resolve'])
+
+
+class MemoryStorageTest(TestCase):
+
+    def setUp(self):
+        self.portia = Portia(None, storage=MemoryStorage())
+
+    @inlineCallbacks
+    def test_resolve(self):
+        phonenumber = phonenumbers.parse('+27123456789')
+        yield self.portia.import_porting_record(
+            '+27123456789', 'MNO1', 'MNO2', datetime(2015, 10, 11))
+        skipped = yield self.portia.annotate(
+            phonenumber, 'ported-to', 'MNO3', datetime(2015, 10, 10))
+        self.assertEqual(skipped, 1)
+        result = yield self.portia.resolve(phonenumber)
+        self.assertEqual(result['network'], 'MNO2')
+        self.assertEqual(result['entry'], {
+            'ported-to': 'MNO2',
+            'ported-to-timestamp': '2015-10-11T00:00:00+00:00',
+            'ported-from': 'MNO1',
+            'ported-from-timestamp': '2015-10-11T00:00:00+00:00',
+        })
+        result = yield self.portia.resolve(phonenumber, entry=False)
+        self.assertFalse('entry' in result)
+        self.assertEqual(result['network'], 'MNO2')
+        self.assertEqual((yield self.portia.flush()), 1)
@@ -0,0 +1,73 @@
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from portia.cache import LRUCache
+
+
+class LRUCacheTest(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_get_set(self):
+        cache = LRUCache(2, clock=self.clock)
+        self.assertEqual(cache.get('a'), None)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+    def test_eviction(self):
+        cache = LRUCache(2, clock=self.clock)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_ttl(self):
+        cache = LRUCache(2, ttl=10, clock=self.clock)
+        cache.set('a', 1)
+        self.clock.advance(9)
+        self.assertEqual(cache.get('a'), 1)
+        self.clock.advance(1)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.expirations, 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate(self):
+        cache = LRUCache(2, clock=self.clock)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.invalidate('a')
+        self.assertFalse('a' in cache)
+        self.assertTrue('b' in cache)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_stale_version(self):
+        cache = LRUCache(2, clock=self.clock)
+        version = cache.version
+        cache.invalidate('a')
+        cache.set('a', 1, version=version)
+        self.assertFalse('a' in cache)
+        cache.set('a', 1, version=cache.version)
+        self.assertTrue('a' in cache)
+
+    def test_stats(self):
+        cache = LRUCache(1, clock=self.clock)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('b')
+        cache.get('a')
+        self.assertEqual(cache.stats(), {
+            'size': 1,
+            'max_size': 1,
+            'hits': 1,
+            'misses': 1,
+            'evictions': 1,
+            'expirations': 0,
+        })
@@ -0,0 +1,94 @@
+import bz2
+import gzip
+import os
+from StringIO import StringIO
+
+from twisted.trial.unittest import TestCase
+
+from portia.compression import (
+    DecompressingFile, Passthrough, lzma, open_compressed)
+from portia.exceptions import PortiaException
+
+
+class OpenCompressedTest(TestCase):
+
+    lines = ['+2776%07d,MNO1,MNO2,20151011\n' % (i,) for i in range(5000)]
+
+    def gzip(self, data):
+        fp = StringIO()
+        with gzip.GzipFile(fileobj=fp, mode='wb') as gz:
+            gz.write(data)
+        return fp.getvalue()
+
+    def assertDecompressed(self, fp):
+        fp = open_compressed(fp)
+        self.assertTrue(isinstance(fp, DecompressingFile))
+        self.assertEqual(list(fp), self.lines)
+        self.assertEqual(fp.readline(), '')
+
+    def assertTruncated(self, data):
+        fp = open_compressed(StringIO(data[:-len(data) // 3]))
+        self.assertRaises(PortiaException, list, fp)
+
+    def test_uncompressed(self):
+        fp = StringIO(''.join(self.lines))
+        self.assertTrue(open_compressed(fp) is fp)
+        self.assertEqual(fp.readline(), self.lines[0])
+
+    def test_gzip(self):
+        self.assertDecompressed(StringIO(self.gzip(''.join(self.lines))))
+
+    def test_gzip_members(self):
+        self.assertDecompressed(StringIO(
+            self.gzip(''.join(self.lines[:10])) +
+            self.gzip(''.join(self.lines[10:]))))
+
+    def test_gzip_truncated(self):
+        self.assertTruncated(self.gzip(''.join(self.lines)))
+
+    def test_gzip_member_truncated(self):
+        self.assertTruncated(
+            self.gzip(''.join(self.lines[:10])) +
+            self.gzip(''.join(self.lines[10:])))
+
+    def test_bz2(self):
+        self.assertDecompressed(StringIO(bz2.compress(''.join(self.lines))))
+
+    def test_bz2_streams(self):
+        self.assertDecompressed(StringIO(
+            bz2.compress(''.join(self.lines[:10])) +
+            bz2.compress(''.join(self.lines[10:]))))
+
+    def test_bz2_truncated(self):
+        self.assertTruncated(bz2.compress(''.join(self.lines)))
+
+    def test_xz(self):
+        if lzma is None:
+            raise self.skipTest('lzma is not installed.')
+        self.assertDecompressed(StringIO(lzma.compress(''.join(self.lines))))
+
+    def test_xz_truncated(self):
+        if lzma is None:
+            raise self.skipTest('lzma is not installed.')
+        self.assertTruncated(lzma.compress(''.join(self.lines)))
+
+    def test_pipe(self):
+        read, write = os.pipe()
+        os.write(write, ''.join(self.lines[:10]))
+        os.close(write)
+        fp = open_compressed(os.fdopen(read, 'r'))
+        self.addCleanup(fp.close)
+        self.assertTrue(isinstance(fp, DecompressingFile))
+        self.assertEqual(list(fp), self.lines[:10])
+
+    def test_read(self):
+        fp = DecompressingFile(StringIO('ab\ncd\nef'), Passthrough)
+        fp.block_size = 2
+        self.assertEqual(fp.read(4), 'ab\nc')
+        self.assertEqual(fp.readline(), 'd\n')
+        self.assertEqual(fp.readline(), 'ef')
+        self.assertEqual(fp.read(), '')
+
+    def test_corrupt(self):
+        fp = open_compressed(StringIO('\x1f\x8b' + 'a' * 100))
+        self.assertRaises(Exception, fp.readline)
@@ -0,0 +1,113 @@
+import csv
+import json
+from datetime import datetime
+from StringIO import StringIO
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.trial.unittest import TestCase
+
+from portia import utils
+from portia.exporter import EntryExporter
+from portia.portia import Portia
+from portia.storage import CompactHashStorage, HashStorage
+from portia.utils import UTC
+
+
+class EntryExporterTest(TestCase):
+
+    timeout = 1
+
+    @inlineCallbacks
+    def setUp(self):
+        self.redis = yield utils.start_redis()
+        self.storage = self.make_storage(self.redis, 'portia:')
+        self.portia = Portia(self.redis, storage=self.storage)
+        self.addCleanup(self.redis.disconnect)
+        self.addCleanup(self.portia.flush)
+        self.older = datetime(2015, 10, 11, tzinfo=UTC())
+        self.newer = datetime(2016, 1, 2, 3, 4, 5, tzinfo=UTC())
+        yield self.storage.write_many([
+            ('+27123456780', {
+                'ported-to': ('MNO2', self.older),
+                'ported-from': ('MNO1', self.older),
+            }),
+            ('+27123456781', {
+                'ported-to': ('MNO3', self.newer),
+                'observed-network': ('MNO4', self.older),
+            }),
+        ])
+
+    def make_storage(self, redis, prefix):
+        return HashStorage(redis, prefix)
+
+    @inlineCallbacks
+    def export(self, format='csv', **kwargs):
+        fp = StringIO()
+        exported = yield EntryExporter(
+            self.storage, fp, format=format, count=1, **kwargs).export()
+        fp.seek(0)
+        if format == 'csv':
+            rows = list(csv.reader(fp))
+            self.assertEqual(rows[0], ['msisdn', 'key', 'value', 'timestamp'])
+            rows = sorted(rows[1:])
+            self.assertEqual(exported, len(set(row[0] for row in rows)))
+        else:
+            rows = sorted(
+                (json.loads(line) for line in fp),
+                key=lambda row: row['msisdn'])
+            self.assertEqual(exported, len(rows))
+        returnValue(rows)
+
+    @inlineCallbacks
+    def test_csv(self):
+        rows = yield self.export()
+        self.assertEqual(rows, [
+            ['+27123456780', 'ported-from', 'MNO1', self.older.isoformat()],
+            ['+27123456780', 'ported-to', 'MNO2', self.older.isoformat()],
+            ['+27123456781', 'observed-network', 'MNO4',
+             self.older.isoformat()],
+            ['+27123456781', 'ported-to', 'MNO3', self.newer.isoformat()],
+        ])
+
+    @inlineCallbacks
+    def test_ndjson(self):
+        rows = yield self.export(format='ndjson')
+        self.assertEqual(rows[0], {
+            'msisdn': '+27123456780',
+            'entry': {
+                'ported-to': 'MNO2',
+                'ported-to-timestamp': self.older.isoformat(),
+                'ported-from': 'MNO1',
+                'ported-from-timestamp': self.older.isoformat(),
+            },
+        })
+        self.assertEqual(len(rows), 2)
+
+    @inlineCallbacks
+    def test_keys(self):
+        rows = yield self.export(keys=['ported-to'])
+        self.assertEqual(
+            [(row[0], row[1]) for row in rows],
+            [('+27123456780', 'ported-to'), ('+27123456781', 'ported-to')])
+
+    @inlineCallbacks
+    def test_timestamp_range(self):
+        rows = yield self.export(since=datetime(2016, 1, 1))
+        self.assertEqual(
+            rows, [['+27123456781', 'ported-to', 'MNO3',
+                    self.newer.isoformat()]])
+        rows = yield self.export(
+            format='ndjson', until=datetime(2016, 1, 1), keys=['ported-to'])
+        self.assertEqual(rows, [{
+            'msisdn': '+27123456780',
+            'entry': {
+                'ported-to': 'MNO2',
+                'ported-to-timestamp': self.older.isoformat(),
+            },
+        }])
+
+
+class CompactEntryExporterTest(EntryExporterTest):
+
+    def make_storage(self, redis, prefix):
+        return CompactHashStorage(redis, prefix)
@@ -0,0 +1,266 @@
+import gzip
+import os
+from StringIO import StringIO
+import pkg_resources
+import phonenumbers
+from multiprocessing import Pool
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from portia import utils
+from portia.exceptions import PortiaException
+from portia.portia import Portia
+from portia.importer import (
+    ImportProgress, LineReader, PortingImporter, SeekableLineReader,
+    normalize_porting_rows, read_checkpoint)
+
+
+class ReadCountingFile(object):
+    """
+    Wraps a file and counts the bytes read from it.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.bytes_read = 0
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+    def read(self, *args):
+        data = self.fp.read(*args)
+        self.bytes_read += len(data)
+        return data
+
+    def readline(self):
+        line = self.fp.readline()
+        self.bytes_read += len(line)
+        return line
+
+
+class PortingImporterTest(TestCase):
+
+    timeout = 1
+
+    @inlineCallbacks
+    def setUp(self):
+        self.redis = yield utils.start_redis()
+        self.portia = Portia(self.redis)
+        self.addCleanup(self.redis.disconnect)
+        self.addCleanup(self.portia.flush)
+
+    def fixture_path(self, fixture_name):
+        return pkg_resources.resource_filename(
+            'portia', os.path.join('tests', 'fixtures', fixture_name))
+
+    @inlineCallbacks
+    def test_import_filename(self):
+        importer = PortingImporter(self.portia, chunk_size=3, concurrency=2)
+        rows = yield importer.import_filename(
+            self.fixture_path('sample-db.txt'))
+        self.assertEqual(rows, 10)
+        annotations = yield self.portia.get_annotations(
+            phonenumbers.parse('+27123456780'))
+        self.assertEqual(annotations['ported-to'], 'MNO2')
+        self.assertEqual(annotations['ported-from'], 'MNO1')
+        self.assertEqual(
+            annotations['ported-to-timestamp'], '2015-10-11T00:00:00+00:00')
+
+    @inlineCallbacks
+    def test_import_matches_import_porting_file(self):
+        yield self.portia.import_porting_filename(
+            self.fixture_path('sample-db.txt'))
+        expected = yield self.portia.get_annotations(
+            phonenumbers.parse('+27123456780'))
+        yield self.portia.flush()
+
+        importer = PortingImporter(self.portia, chunk_size=4)
+        yield importer.import_filename(self.fixture_path('sample-db.txt'))
+        self.assertEqual(
+            (yield self.portia.get_annotations(
+                phonenumbers.parse('+27123456780'))),
+            expected)
+
+    @inlineCallbacks
+    def test_reimport_skips_older_annotations(self):
+        importer = PortingImporter(self.portia, chunk_size=3)
+        yield importer.import_filename(self.fixture_path('sample-db.txt'))
+        self.assertEqual(importer.skipped, 0)
+
+        importer = PortingImporter(self.portia, chunk_size=3)
+        rows = yield importer.import_rows([
+            ['+27123456780', 'MNO3', 'MNO4', '20151010'],
+            ['+27123456781', 'MNO3', 'MNO4', '20991010'],
+        ])
+        self.assertEqual(rows, 2)
+        self.assertEqual(importer.skipped, 2)
+        self.assertEqual(
+            (yield self.portia.get_annotations(
+                phonenumbers.parse('+27123456780')))['ported-to'], 'MNO2')
+        self.assertEqual(
+            (yield self.portia.get_annotations(
+                phonenumbers.parse('+27123456781')))['ported-to'], 'MNO4')
+
+    @inlineCallbacks
+    def test_import_invalid_row(self):
+        importer = PortingImporter(self.portia, chunk_size=2)
+        d = importer.import_rows([
+            ['+27123456780', 'MNO1', 'MNO2', '20151011'],
+            ['+27123456781', 'MNO1', 'MNO2', 'not-a-date'],
+        ])
+        yield self.assertFailure(d, ValueError)
+
+    def test_normalize_porting_rows(self):
+        records, errors = normalize_porting_rows([
+            ['+27123456780', 'MNO1', 'MNO2', '20151011'],
+            ['foo', 'MNO1', 'MNO2', '20151011'],
+        ])
+        self.assertEqual(records, [
+            ('+27123456780', 'MNO1', 'MNO2', 1444521600)])
+        [(row, error)] = errors
+        self.assertEqual(row, ['foo', 'MNO1', 'MNO2', '20151011'])
+        self.assertTrue(isinstance(error, PortiaException))
+
+    @inlineCallbacks
+    def test_import_skips_invalid_rows(self):
+        importer = PortingImporter(self.portia, chunk_size=2, max_errors=2)
+        rows = yield importer.import_rows([
+            ['+27123456780', 'MNO1', 'MNO2', '20151011'],
+            ['+27123456781', 'MNO1', 'MNO2', 'not-a-date'],
+            ['foo', 'MNO1', 'MNO2', '20151011'],
+        ])
+        self.assertEqual(rows, 1)
+        self.assertEqual(importer.errors, 2)
+        self.assertEqual(
+            (yield self.portia.get_annotations(
+                phonenumbers.parse('+27123456780')))['ported-to'], 'MNO2')
+
+    def write_porting_db(self, lines):
+        path = self.mktemp()
+        with open(path, 'w') as fp:
+            fp.write('MSISDN,DONOR,RECIPIENT,DATE\n')
+            for line in lines:
+                fp.write('%s\n' % (line,))
+        return path
+
+    @inlineCallbacks
+    def test_resume(self):
+        path = self.write_porting_db([
+            '+27123456780,MNO1,MNO2,20151011',
+            '+27123456781,MNO1,MNO2,20151011',
+            '+27123456782,MNO1,MNO2,not-a-date',
+            '+27123456783,MNO1,MNO2,20151011',
+        ])
+        checkpoint = '%s.checkpoint' % (path,)
+        importer = PortingImporter(
+            self.portia, chunk_size=2, concurrency=1, checkpoint=checkpoint,
+            checkpoint_interval=0)
+        yield self.assertFailure(importer.import_filename(path), ValueError)
+        saved = read_checkpoint(checkpoint)
+        with open(path, 'r') as fp:
+            lines = fp.readlines()
+        self.assertEqual(saved['offset'], len(''.join(lines[:3])))
+        self.assertEqual(saved['rows'], 2)
+        self.assertEqual(saved['errors'], 0)
+
+        importer = PortingImporter(
+            self.portia, chunk_size=2, concurrency=1, checkpoint=checkpoint,
+            max_errors=1)
+        rows = yield importer.import_filename(path, resume=True)
+        self.assertEqual(rows, 1)
+        self.assertEqual(importer.errors, 1)
+        self.assertFalse(os.path.exists(checkpoint))
+        self.assertEqual(
+            (yield self.portia.get_annotations(
+                phonenumbers.parse('+27123456783')))['ported-to'], 'MNO2')
+
+    @inlineCallbacks
+    def test_resume_seeks(self):
+        self.patch(SeekableLineReader, 'head_size', 16)
+        path = self.write_porting_db([
+            '+27123456780,MNO1,MNO2,20151011',
+            '+27123456781,MNO1,MNO2,not-a-date',
+            '+27123456782,MNO1,MNO2,20151011',
+        ])
+        checkpoint = '%s.checkpoint' % (path,)
+        importer = PortingImporter(
+            self.portia, chunk_size=1, concurrency=1, checkpoint=checkpoint,
+            checkpoint_interval=0)
+        yield self.assertFailure(importer.import_filename(path), ValueError)
+        offset = read_checkpoint(checkpoint)['offset']
+
+        importer = PortingImporter(
+            self.portia, chunk_size=1, concurrency=1, checkpoint=checkpoint,
+            max_errors=1)
+        with open(path, 'r') as fp:
+            content = fp.read()
+            fp.seek(0)
+            fp = ReadCountingFile(fp)
+            rows = yield importer.import_file(fp, resume=True)
+        self.assertEqual(rows, 1)
+        # Only the bytes checked for compression, the head that is
+        # fingerprinted and the rows after the checkpoint are read.
+        self.assertEqual(fp.bytes_read, 6 + 16 + len(content) - offset)
+
+    @inlineCallbacks
+    def test_resume_changed_file(self):
+        path = self.write_porting_db([
+            '+27123456780,MNO1,MNO2,20151011',
+            '+27123456781,MNO1,MNO2,not-a-date',
+        ])
+        checkpoint = '%s.checkpoint' % (path,)
+        importer = PortingImporter(
+            self.portia, chunk_size=1, concurrency=1, checkpoint=checkpoint,
+            checkpoint_interval=0)
+        yield self.assertFailure(importer.import_filename(path), ValueError)
+
+        path = self.write_porting_db([
+            '+27123456789,MNO1,MNO2,20151011',
+        ])
+        importer = PortingImporter(self.portia, checkpoint=checkpoint)
+        yield self.assertFailure(
+            importer.import_filename(path, resume=True), PortiaException)
+
+    def test_progress_eta(self):
+        clock = Clock()
+        progress = ImportProgress('Imported', 'rows', clock=clock)
+        reader = LineReader(StringIO('a\n' * 4))
+        progress.start()
+        progress.track(reader, 8)
+        self.assertEqual(progress.eta(), None)
+        next(reader)
+        clock.advance(2)
+        self.assertEqual(progress.eta(), 6.0)
+
+    @inlineCallbacks
+    def test_import_gzip(self):
+        path = self.mktemp()
+        with open(self.fixture_path('sample-db.txt'), 'r') as fp:
+            with gzip.open(path, 'wb') as gz:
+                gz.write(fp.read())
+        importer = PortingImporter(self.portia, chunk_size=3)
+        rows = yield importer.import_filename(path)
+        self.assertEqual(rows, 10)
+        self.assertEqual(
+            (yield self.portia.get_annotations(
+                phonenumbers.parse('+27123456780')))['ported-to'], 'MNO2')
+
+    @inlineCallbacks
+    def test_import_with_pool(self):
+        pool = Pool(2)
+        self.addCleanup(pool.join)
+        self.addCleanup(pool.close)
+        importer = PortingImporter(self.portia, chunk_size=3, pool=pool)
+        rows = yield importer.import_filename(
+            self.fixture_path('sample-db.txt'))
+        self.assertEqual(rows, 10)
+        annotations = yield self.portia.get_annotations(
+            phonenumbers.parse('+27123456780'))
+        self.assertEqual(annotations['ported-to'], 'MNO2')
+        self.assertEqual(
+            annotations['ported-to-timestamp'], '2015-10-11T00:00:00+00:00')
+
+        d = importer.import_rows([['foo', 'MNO1', 'MNO2', '20151011']])
+        yield self.assertFailure(d, PortiaException)
@@ -0,0 +1,59 @@
+import phonenumbers
+
+from twisted.trial.unittest import TestCase
+
+from portia.metadata import GeocodeMetadata
+
+
+class GeocodeMetadataTest(TestCase):
+
+    def setUp(self):
+        self.metadata = GeocodeMetadata()
+
+    def test_lookup(self):
+        self.assertEqual(
+            self.metadata.lookup(phonenumbers.parse('+27761234567')), {
+                'region_code': 'ZA',
+                'country_description': 'South Africa',
+                'original_carrier': 'Vodacom',
+                'timezones': ('Africa/Johannesburg',),
+            })
+
+    def test_lookup_matches_compute(self):
+        for msisdn in ['+27761234567', '+27123456789', '+2348031234567',
+                       '+14155552671', '+447911123456', '+100000000000']:
+            phonenumber = phonenumbers.parse(msisdn)
+            self.assertEqual(
+                self.metadata.lookup(phonenumber),
+                self.metadata.compute(phonenumber))
+
+    def test_lookup_memoized(self):
+        self.metadata.lookup(phonenumbers.parse('+27761234567'))
+        self.metadata.lookup(phonenumbers.parse('+27761234568'))
+        self.assertEqual(self.metadata.cache.hits, 1)
+        self.assertEqual(self.metadata.cache.misses, 1)
+
+    def test_key_includes_length(self):
+        self.assertNotEqual(
+            self.metadata.key(phonenumbers.parse('+27761234567')),
+            self.metadata.key(phonenumbers.parse('+2776123456')))
+
+    def test_key_includes_validity(self):
+        valid = phonenumbers.parse('+302893481828')
+        invalid = phonenumbers.parse('+302890000000')
+        self.assertTrue(phonenumbers.is_valid_number(valid))
+        self.assertFalse(phonenumbers.is_valid_number(invalid))
+        self.assertNotEqual(
+            self.metadata.key(valid), self.metadata.key(invalid))
+        self.assertEqual(
+            self.metadata.lookup(valid)['timezones'], ('Europe/Athens',))
+        self.assertEqual(
+            self.metadata.lookup(invalid), self.metadata.compute(invalid))
+
+    def test_key_includes_region(self):
+        # +1 is shared by the US, Canada and others.
+        for msisdn in ['+12015550123', '+16135550123', '+18005550123']:
+            phonenumber = phonenumbers.parse(msisdn)
+            self.assertEqual(
+                self.metadata.lookup(phonenumber),
+                self.metadata.compute(phonenumber))
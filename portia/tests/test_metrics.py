@@ -0,0 +1,125 @@
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from portia import utils
+from portia.cache import LRUCache
+from portia.metrics import Metrics, InstrumentedRedis
+from portia.storage import HashStorage
+
+
+class MetricsTest(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = Metrics(clock=self.clock)
+        self.metrics.metrics = []
+
+    def test_counter(self):
+        counter = self.metrics.counter('requests_total', 'Requests.', ['a'])
+        counter.inc('x')
+        counter.inc('x', amount=2)
+        counter.inc('y "z"')
+        self.assertEqual(self.metrics.render(), '\n'.join([
+            '# HELP requests_total Requests.',
+            '# TYPE requests_total counter',
+            'requests_total{a="x"} 3.0',
+            'requests_total{a="y \\"z\\""} 1.0',
+        ]) + '\n')
+
+    def test_gauge(self):
+        gauge = self.metrics.gauge('in_flight', 'In flight.')
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        self.assertEqual(self.metrics.render(), '\n'.join([
+            '# HELP in_flight In flight.',
+            '# TYPE in_flight gauge',
+            'in_flight 1.0',
+        ]) + '\n')
+
+    def test_histogram(self):
+        histogram = self.metrics.histogram(
+            'duration_seconds', 'Duration.', ['route'], buckets=[0.1, 1])
+        histogram.observe(0.05, 'r')
+        histogram.observe(0.1, 'r')
+        histogram.observe(2, 'r')
+        self.assertEqual(self.metrics.render(), '\n'.join([
+            '# HELP duration_seconds Duration.',
+            '# TYPE duration_seconds histogram',
+            'duration_seconds_bucket{route="r",le="0.1"} 2',
+            'duration_seconds_bucket{route="r",le="1.0"} 2',
+            'duration_seconds_bucket{route="r",le="+Inf"} 3',
+            'duration_seconds_sum{route="r"} 2.15',
+            'duration_seconds_count{route="r"} 3',
+        ]) + '\n')
+
+    def test_track_cache(self):
+        cache = LRUCache(1)
+        self.metrics.track_cache('resolve', cache)
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('b')
+        cache.set('b', 2)
+        self.assertEqual(self.metrics.render(), '\n'.join([
+            '# HELP portia_cache_entries Entries held in an in-memory cache.',
+            '# TYPE portia_cache_entries gauge',
+            'portia_cache_entries{cache="resolve"} 1.0',
+            '# HELP portia_cache_hits_total Cache lookups that found a live '
+            'entry.',
+            '# TYPE portia_cache_hits_total counter',
+            'portia_cache_hits_total{cache="resolve"} 1.0',
+            '# HELP portia_cache_misses_total Cache lookups that found no '
+            'live entry.',
+            '# TYPE portia_cache_misses_total counter',
+            'portia_cache_misses_total{cache="resolve"} 1.0',
+            '# HELP portia_cache_evictions_total Entries dropped to make room '
+            'for new ones.',
+            '# TYPE portia_cache_evictions_total counter',
+            'portia_cache_evictions_total{cache="resolve"} 1.0',
+            '# HELP portia_cache_expirations_total Entries found to have '
+            'outlived their TTL.',
+            '# TYPE portia_cache_expirations_total counter',
+            'portia_cache_expirations_total{cache="resolve"} 0.0',
+        ]) + '\n')
+
+
+class InstrumentedRedisTest(TestCase):
+
+    timeout = 1
+
+    @inlineCallbacks
+    def setUp(self):
+        redis = yield utils.start_redis()
+        self.addCleanup(redis.disconnect)
+        self.metrics = Metrics()
+        self.redis = InstrumentedRedis(redis, self.metrics)
+        self.storage = HashStorage(self.redis, 'portia:')
+        self.addCleanup(self.storage.flush)
+
+    def commands(self):
+        return dict(
+            (labels[0], counts[0])
+            for labels, counts in self.metrics.redis_commands.values.items())
+
+    @inlineCallbacks
+    def test_commands(self):
+        yield self.redis.hset('portia:+27123456789', 'foo', 'bar')
+        self.assertEqual(
+            (yield self.redis.hget('portia:+27123456789', 'foo')), 'bar')
+        yield self.redis.execute_command('UNLINK', 'portia:+27123456789')
+        transaction = yield self.redis.multi()
+        transaction.hgetall('portia:+27123456789')
+        yield transaction.commit()
+        commands = self.commands()
+        self.assertEqual(
+            sorted(commands), ['EXEC', 'HGET', 'HSET', 'MULTI', 'UNLINK'])
+        self.assertEqual(sum(commands['HGET']), 1)
+        self.assertEqual(self.metrics.redis_errors.values, {})
+
+    @inlineCallbacks
+    def test_errors(self):
+        yield self.assertFailure(
+            self.redis.execute_command('NOT-A-COMMAND'), Exception)
+        self.assertEqual(
+            self.metrics.redis_errors.values, {('NOT-A-COMMAND',): 1})
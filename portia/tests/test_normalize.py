@@ -0,0 +1,56 @@
+import phonenumbers
+
+from twisted.trial.unittest import TestCase
+
+from portia.benchmarks.geocode import generate_phonenumbers
+from portia.normalize import MsisdnNormalizer, NormalizedNumber
+from portia.portia import as_msisdn
+
+
+class MsisdnNormalizerTest(TestCase):
+
+    def setUp(self):
+        self.normalizer = MsisdnNormalizer(size=10)
+
+    def assertNormalized(self, msisdn):
+        number = self.normalizer.normalize(msisdn)
+        expected = phonenumbers.parse(msisdn)
+        self.assertEqual(number, expected)
+        self.assertEqual(
+            number.msisdn,
+            phonenumbers.format_number(
+                expected, phonenumbers.PhoneNumberFormat.E164))
+        return number
+
+    def test_e164(self):
+        number = self.assertNormalized('+27761234567')
+        self.assertTrue(isinstance(number, NormalizedNumber))
+        self.assertEqual(number.country_code, 27)
+        self.assertEqual(number.national_number, 761234567)
+        self.assertEqual(as_msisdn(number), '+27761234567')
+
+    def test_matches_phonenumbers(self):
+        for phonenumber in generate_phonenumbers(500):
+            self.assertNormalized(phonenumbers.format_number(
+                phonenumber, phonenumbers.PhoneNumberFormat.E164))
+
+    def test_not_e164(self):
+        self.assertEqual(
+            self.assertNormalized('+27 76 123 4567').msisdn, '+27761234567')
+        # The national prefix is stripped and Italian leading zeros kept.
+        self.assertEqual(
+            self.assertNormalized('+270761234567').msisdn, '+27761234567')
+        self.assertEqual(
+            self.assertNormalized('+390612345678').msisdn, '+390612345678')
+
+    def test_invalid(self):
+        self.assertRaises(
+            phonenumbers.NumberParseException, self.normalizer.parse, 'foo')
+        self.assertRaises(
+            phonenumbers.NumberParseException, self.normalizer.parse,
+            '+99912345678')
+
+    def test_memoized(self):
+        number = self.normalizer.parse('+27761234567')
+        self.assertTrue(self.normalizer.parse('+27761234567') is number)
+        self.assertEqual(self.normalizer.cache.hits, 1)
@@ -7,6 +7,7 @@ from twisted.internet.defer import inlineCallbacks
 from twisted.trial.unittest import TestCase
 
 from portia import utils
+from portia.cache import LRUCache
 from portia.portia import Portia
 
 
@@ -62,6 +63,41 @@ class PortiaTest(TestCase):
         self.assertTrue((yield self.portia.flush()))
         self.assertFalse((yield self.portia.get_annotations(msisdn)))
 
+    @inlineCallbacks
+    def test_flush_batches(self):
+        yield self.portia.import_porting_filename(
+            self.fixture_path('sample-db.txt'))
+        yield self.redis.set('other:key', 'value')
+        self.addCleanup(self.redis.delete, 'other:key')
+        progress = utils.Progress('Deleted', 'keys')
+        progress.start()
+        deleted = yield self.portia.flush(
+            count=3, concurrency=2, progress=progress)
+        self.assertEqual(deleted, 10)
+        self.assertEqual(progress.count, 10)
+        self.assertEqual((yield self.redis.keys('%s*' % (
+            self.portia.prefix,))), [])
+        self.assertEqual((yield self.redis.get('other:key')), 'value')
+
+    @inlineCallbacks
+    def test_flush_without_unlink(self):
+        self.portia.storage.unlink_supported = False
+        yield self.portia.import_porting_record(
+            '+27123456789', 'DONOR', 'RECIPIENT', datetime.now())
+        self.assertEqual((yield self.portia.flush()), 1)
+
+    @inlineCallbacks
+    def test_scan_keys_failure(self):
+        yield self.portia.import_porting_filename(
+            self.fixture_path('sample-db.txt'))
+
+        def process(keys):
+            raise ValueError('boom')
+
+        yield self.assertFailure(
+            self.portia.storage.scan_keys(process, count=2, concurrency=1),
+            ValueError)
+
     @inlineCallbacks
     def test_annotate(self):
         timestamp1 = datetime.now()
@@ -165,3 +201,130 @@ class PortiaTest(TestCase):
             phonenumbers.parse('+100000000000'))
         self.assertEqual(result['network'], None)
         self.assertEqual(result['strategy'], 'prefix-guess')
+
+    @inlineCallbacks
+    def test_resolve_cache(self):
+        self.portia.resolve_cache = LRUCache(10)
+        phonenumber = phonenumbers.parse('+27123456789')
+        first = yield self.portia.resolve(phonenumber)
+        second = yield self.portia.resolve(phonenumber)
+        self.assertEqual(first, second)
+        self.assertEqual(self.portia.resolve_cache.hits, 1)
+        self.assertEqual(self.portia.resolve_cache.misses, 1)
+
+    @inlineCallbacks
+    def test_resolve_cache_invalidation(self):
+        self.portia.resolve_cache = LRUCache(10)
+        phonenumber = phonenumbers.parse('+27123456789')
+        yield self.portia.annotate(
+            phonenumber, 'observed-network', 'MNO1',
+            timestamp=datetime.now())
+        self.assertEqual(
+            (yield self.portia.resolve(phonenumber))['network'], 'MNO1')
+
+        yield self.portia.annotate(
+            phonenumber, 'observed-network', 'MNO2',
+            timestamp=datetime.now())
+        self.assertEqual(
+            (yield self.portia.resolve(phonenumber))['network'], 'MNO2')
+
+        yield self.portia.remove_annotations(phonenumber, 'observed-network')
+        self.assertEqual(
+            (yield self.portia.resolve(phonenumber))['strategy'],
+            'prefix-guess')
+
+        yield self.portia.import_porting_record(
+            '+27123456789', 'MNO1', 'MNO3', datetime.now())
+        self.assertEqual(
+            (yield self.portia.resolve(phonenumber))['network'], 'MNO3')
+
+        yield self.portia.remove(phonenumber)
+        self.assertEqual(
+            (yield self.portia.resolve(phonenumber))['strategy'],
+            'prefix-guess')
+
+    @inlineCallbacks
+    def test_resolve_cache_flush(self):
+        self.portia.resolve_cache = LRUCache(10)
+        yield self.portia.resolve(phonenumbers.parse('+27123456789'))
+        self.assertEqual(len(self.portia.resolve_cache), 1)
+        yield self.portia.flush()
+        self.assertEqual(len(self.portia.resolve_cache), 0)
+
+    @inlineCallbacks
+    def test_get_annotations_many(self):
+        timestamp = datetime.now()
+        yield self.portia.annotate(
+            phonenumbers.parse('+27123456789'), 'X-foo', 'bar',
+            timestamp=timestamp)
+        entries = yield self.portia.get_annotations_many([
+            phonenumbers.parse('+27123456789'),
+            phonenumbers.parse('+27123456780'),
+        ])
+        self.assertEqual(entries, [{
+            'X-foo': 'bar',
+            'X-foo-timestamp': self.portia.to_utc(timestamp).isoformat(),
+        }, {}])
+
+    @inlineCallbacks
+    def test_resolve_many(self):
+        yield self.portia.import_porting_record(
+            '+27123456789', 'DONOR', 'RECIPIENT', datetime.now())
+        phonenumbers_ = [
+            phonenumbers.parse('+27763456789'),
+            phonenumbers.parse('+27123456789'),
+            phonenumbers.parse('+100000000000'),
+        ]
+        results = yield self.portia.resolve_many(phonenumbers_, chunk_size=2)
+        self.assertEqual(
+            [(result['network'], result['strategy']) for result in results],
+            [('VODACOM', 'prefix-guess'),
+             ('RECIPIENT', 'ported-to'),
+             (None, 'prefix-guess')])
+        for phonenumber, result in zip(phonenumbers_, results):
+            self.assertEqual(
+                result, (yield self.portia.resolve(phonenumber)))
+
+    @inlineCallbacks
+    def test_resolve_without_entry(self):
+        phonenumber = phonenumbers.parse('+27123456789')
+        yield self.portia.import_porting_record(
+            '+27123456789', 'DONOR', 'RECIPIENT', datetime.now())
+        yield self.portia.annotate(
+            phonenumber, 'X-foo', 'bar', timestamp=datetime.now())
+        full = yield self.portia.resolve(phonenumber)
+        result = yield self.portia.resolve(phonenumber, entry=False)
+        self.assertFalse('entry' in result)
+        del full['entry']
+        self.assertEqual(result, full)
+
+        results = yield self.portia.resolve_many(
+            [phonenumber, phonenumbers.parse('+27763456789')], entry=False)
+        self.assertEqual(results[0], result)
+        self.assertEqual(results[1]['strategy'], 'prefix-guess')
+        self.assertFalse('entry' in results[1])
+
+    @inlineCallbacks
+    def test_resolve_without_entry_cache(self):
+        self.portia.resolve_cache = LRUCache(10)
+        phonenumber = phonenumbers.parse('+27123456789')
+        yield self.portia.resolve(phonenumber)
+        result = yield self.portia.resolve(phonenumber, entry=False)
+        self.assertFalse('entry' in result)
+        self.assertEqual(len(self.portia.resolve_cache), 2)
+        yield self.portia.annotate(
+            phonenumber, 'observed-network', 'MNO', timestamp=datetime.now())
+        self.assertEqual(len(self.portia.resolve_cache), 0)
+        self.assertEqual(
+            (yield self.portia.resolve(phonenumber, entry=False))['network'],
+            'MNO')
+
+    @inlineCallbacks
+    def test_resolve_many_cache(self):
+        self.portia.resolve_cache = LRUCache(10)
+        phonenumber = phonenumbers.parse('+27763456789')
+        cached = yield self.portia.resolve(phonenumber)
+        results = yield self.portia.resolve_many(
+            [phonenumber, phonenumbers.parse('+27123456789')])
+        self.assertTrue(results[0] is cached)
+        self.assertEqual(len(self.portia.resolve_cache), 2)
@@ -0,0 +1,59 @@
+import pkg_resources
+
+from twisted.trial.unittest import TestCase
+
+from portia import utils
+from portia.prefixes import NetworkPrefixTrie
+
+
+class NetworkPrefixTrieTest(TestCase):
+
+    def test_lookup(self):
+        trie = NetworkPrefixTrie.from_mapping({
+            '27': {
+                '2771': {
+                    '27710': 'MTN',
+                    '27711': 'VODACOM',
+                },
+                '2772': 'VODACOM',
+            },
+        })
+        self.assertEqual(len(trie), 3)
+        self.assertEqual(trie.lookup('+27710000000'), 'MTN')
+        self.assertEqual(trie.lookup('+27711000000'), 'VODACOM')
+        self.assertEqual(trie.lookup('27720000000'), 'VODACOM')
+        self.assertEqual(trie.lookup('+27712000000'), None)
+        self.assertEqual(trie.lookup('+1000000000'), None)
+
+    def test_longest_prefix_wins(self):
+        trie = NetworkPrefixTrie.from_mapping({
+            '2772': 'VODACOM',
+            '27721': 'MTN',
+            '277212': 'CELLC',
+        })
+        self.assertEqual(trie.lookup('+27720000000'), 'VODACOM')
+        self.assertEqual(trie.lookup('+27721000000'), 'MTN')
+        self.assertEqual(trie.lookup('+27721200000'), 'CELLC')
+
+    def test_conflicts(self):
+        trie = NetworkPrefixTrie([
+            {'2772': 'VODACOM'},
+            {'27': {'2772': 'MTN'}},
+        ])
+        self.assertEqual(trie.conflicts, [('2772', 'VODACOM', 'MTN')])
+        self.assertEqual(trie.lookup('+27720000000'), 'MTN')
+        self.assertEqual(len(trie), 1)
+
+    def test_shadowed(self):
+        trie = NetworkPrefixTrie.from_mapping({
+            '27': {'2672': 'MTN'},
+        })
+        self.assertEqual(trie.shadowed, [('27', '2672')])
+
+    def test_compile_network_prefix_mappings(self):
+        trie = utils.compile_network_prefix_mappings(
+            [pkg_resources.resource_filename(
+                'portia', 'assets/mappings/*.mapping.json')])
+        self.assertTrue(isinstance(trie, NetworkPrefixTrie))
+        self.assertEqual(trie.lookup('+27763456789'), 'VODACOM')
+        self.assertEqual(trie.lookup('+27741000000'), 'VIRGIN')
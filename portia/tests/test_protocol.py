@@ -1,4 +1,5 @@
 import json
+import struct
 import pkg_resources
 import phonenumbers
 from datetime import datetime
@@ -8,10 +9,13 @@ from dateutil.parser import parse
 from twisted.trial.unittest import TestCase
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, maybeDeferred, Deferred
-from twisted.test.proto_helpers import StringTransportWithDisconnection
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import (
+    StringTransport, StringTransportWithDisconnection)
 
+from portia.metrics import Metrics
 from portia.portia import Portia
-from portia.protocol import JsonProtocolFactory
+from portia.protocol import JsonProtocol, JsonProtocolFactory, msgpack
 from portia import utils
 
 
@@ -64,6 +68,27 @@ class ProtocolTest(TestCase):
 
         return response_d
 
+    @inlineCallbacks
+    def test_metrics(self):
+        metrics = Metrics()
+        self.proto = JsonProtocolFactory(
+            self.portia, metrics=metrics).buildProtocol()
+        self.proto.makeConnection(self.transport)
+        self.assertEqual(metrics.tcp_connections.values, {(): 1})
+
+        yield self.send_command('resolve', msisdn='+27761234567')
+        yield self.send_command('resolve', msisdn='foo')
+        self.assertEqual(metrics.tcp_replies.values, {
+            ('resolve', 'ok'): 1,
+            ('resolve', 'error'): 1,
+        })
+        self.assertEqual(
+            metrics.tcp_commands.values[('resolve',)][0][-1], 0)
+        self.assertEqual(metrics.tcp_in_flight.values, {(): 0})
+
+        self.proto.connectionLost(None)
+        self.assertEqual(metrics.tcp_connections.values, {(): 0})
+
     @inlineCallbacks
     def test_get_empty(self):
         resp = yield self.send_command("get", id='123',
@@ -189,3 +214,244 @@ class ProtocolTest(TestCase):
         #       recent than 23pm in +02:00
         print result
         self.assertEqual(result['response']['network'], 'utc-network')
+
+    @inlineCallbacks
+    def test_get_many(self):
+        timestamp = datetime.utcnow()
+        yield self.portia.annotate(
+            phonenumbers.parse('+27123456789'), 'ported-to', 'MNO',
+            timestamp=timestamp)
+        result = yield self.send_command(
+            'get_many', id='abc', msisdns=['+27123456789', '+27123456780'])
+        self.assertEqual(result['reference_id'], 'abc')
+        self.assertEqual(result['reference_cmd'], 'get_many')
+        self.assertEqual(result['response'], {
+            '+27123456789': {
+                'ported-to': 'MNO',
+                'ported-to-timestamp': self.portia.to_utc(
+                    timestamp).isoformat(),
+            },
+            '+27123456780': {},
+        })
+
+    @inlineCallbacks
+    def test_resolve_many(self):
+        yield self.portia.annotate(
+            phonenumbers.parse('+27123456789'), 'ported-to', 'MNO',
+            timestamp=datetime.utcnow())
+        result = yield self.send_command(
+            'resolve_many', msisdns=['+27123456789', '+27761234567', 'foo'])
+        response = result['response']
+        self.assertEqual(result['status'], 'ok')
+        self.assertEqual(response['+27123456789']['network'], 'MNO')
+        self.assertEqual(response['+27123456789']['strategy'], 'ported-to')
+        self.assertEqual(response['+27761234567']['network'], 'VODACOM')
+        self.assertEqual(
+            response['+27761234567']['strategy'], 'prefix-guess')
+        self.assertTrue(response['foo']['error'])
+
+    @inlineCallbacks
+    def test_resolve_many_not_strings(self):
+        result = yield self.send_command(
+            'resolve_many', msisdns=['+27761234567', ['+27761234568'],
+                                     {'msisdn': 'foo'}, 27761234569])
+        response = result['response']
+        self.assertEqual(result['status'], 'ok')
+        self.assertEqual(response['+27761234567']['network'], 'VODACOM')
+        self.assertEqual(
+            set(response), set([
+                '+27761234567', '["+27761234568"]', '{"msisdn": "foo"}',
+                '27761234569']))
+        self.assertEqual(
+            response['["+27761234568"]']['error'],
+            'Invalid MSISDN: ["+27761234568"]')
+
+        result = yield self.send_command('get_many', msisdns='+27761234567')
+        self.assertEqual(result['status'], 'error')
+
+    @inlineCallbacks
+    def test_resolve_without_entry(self):
+        yield self.portia.annotate(
+            phonenumbers.parse('+27123456789'), 'ported-to', 'MNO',
+            timestamp=datetime.utcnow())
+        result = yield self.send_command(
+            'resolve', msisdn='+27123456789', entry=False)
+        response = result['response']
+        self.assertEqual(response['network'], 'MNO')
+        self.assertFalse('entry' in response)
+        result = yield self.send_command(
+            'resolve_many', msisdns=['+27123456789'], entry=False)
+        self.assertEqual(result['response'], {'+27123456789': response})
+
+
+class BackpressureTest(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = Metrics()
+        self.pending = []
+        self.proto = JsonProtocol(
+            None, metrics=self.metrics, max_in_flight=4, clock=self.clock)
+        self.proto.handle_wait = self.wait
+        self.transport = StringTransport()
+        self.transport.writeSequence = self.write_sequence
+        self.writes = []
+        self.proto.makeConnection(self.transport)
+
+    def wait(self):
+        d = Deferred()
+        self.pending.append(d)
+        return d
+
+    def write_sequence(self, data):
+        self.writes.append(data)
+        StringTransport.writeSequence(self.transport, data)
+
+    def send(self, count):
+        self.proto.dataReceived(''.join(
+            json.dumps({'cmd': 'wait', 'id': i, 'version': '0.1.0',
+                        'request': {}}) + '\r\n'
+            for i in range(count)))
+
+    def replies(self):
+        return [json.loads(line)['reference_id']
+                for line in self.transport.value().splitlines()]
+
+    def test_pause_and_resume(self):
+        self.send(5)
+        self.assertEqual(len(self.pending), 4)
+        self.assertEqual(self.transport.producerState, 'paused')
+        self.assertEqual(self.metrics.tcp_pauses.values, {(): 1})
+        self.assertEqual(self.metrics.tcp_paused.values, {(): 1})
+
+        self.pending[0].callback('ok')
+        self.assertEqual(self.transport.producerState, 'paused')
+        self.pending[1].callback('ok')
+        self.assertEqual(self.transport.producerState, 'producing')
+        self.assertEqual(self.metrics.tcp_paused.values, {(): 0})
+        # The buffered lines are handled once the connection resumes.
+        self.assertEqual(len(self.pending), 5)
+        self.assertEqual(self.proto.in_flight, 3)
+        self.assertEqual(self.metrics.tcp_pauses.values, {(): 1})
+        self.assertEqual(
+            sum(self.metrics.tcp_queue_depth.values[()][0]), 5)
+
+    def test_replies_batched(self):
+        self.send(3)
+        for d in self.pending:
+            d.callback('ok')
+        self.assertEqual(self.writes, [])
+        self.clock.advance(0)
+        self.assertEqual(len(self.writes), 1)
+        self.assertEqual(self.replies(), [0, 1, 2])
+        self.assertEqual(self.proto.in_flight, 0)
+
+    def test_full_batch_written(self):
+        self.proto.max_in_flight = 2
+        self.send(2)
+        for d in self.pending:
+            d.callback('ok')
+        self.assertEqual(len(self.writes), 1)
+        self.assertEqual(self.replies(), [0, 1])
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    def test_connection_lost(self):
+        self.send(1)
+        self.pending[0].callback('ok')
+        self.proto.connectionLost(None)
+        self.assertFalse(self.clock.getDelayedCalls())
+
+
+class FramingTest(TestCase):
+
+    if msgpack is None:
+        skip = 'msgpack is not installed.'
+
+    def setUp(self):
+        self.clock = Clock()
+        self.proto = JsonProtocol(None, clock=self.clock)
+        self.proto.handle_echo = lambda **kwargs: kwargs
+        self.pending = []
+        self.proto.handle_wait = self.wait
+        self.transport = StringTransportWithDisconnection()
+        self.transport.protocol = self.proto
+        self.proto.makeConnection(self.transport)
+
+    def wait(self):
+        d = Deferred()
+        self.pending.append(d)
+        return d
+
+    def line(self, cmd, id=1, **request):
+        return json.dumps({
+            'cmd': cmd, 'id': id, 'version': '0.1.0',
+            'request': request}) + '\r\n'
+
+    def frame(self, cmd, id=1, **request):
+        payload = msgpack.packb({'cmd': cmd, 'id': id, 'request': request})
+        return struct.pack('>I', len(payload)) + payload
+
+    def read(self):
+        self.clock.advance(0)
+        data = self.transport.value()
+        self.transport.clear()
+        return data
+
+    def read_frames(self, data):
+        frames = []
+        while data:
+            length, = struct.unpack_from('>I', data)
+            frames.append(msgpack.unpackb(data[4:4 + length], raw=False))
+            data = data[4 + length:]
+        return frames
+
+    def test_handshake(self):
+        self.proto.dataReceived(
+            self.line('framing', framing='msgpack') +
+            self.frame('echo', id=2, msisdn='+27123456789'))
+        reply, frames = self.read().split('\r\n', 1)
+        self.assertEqual(json.loads(reply)['response'], 'msgpack')
+        self.assertEqual(self.read_frames(frames), [{
+            'status': 'ok',
+            'reference_id': 2,
+            'response': {'msisdn': '+27123456789'},
+        }])
+
+    def test_partial_frames(self):
+        self.proto.dataReceived(self.line('framing', framing='msgpack'))
+        self.read()
+        data = self.frame('echo', id=3) + self.frame('foo', id=4)
+        for offset in range(0, len(data), 3):
+            self.proto.dataReceived(data[offset:offset + 3])
+        self.assertEqual(self.read_frames(self.read()), [{
+            'status': 'ok',
+            'reference_id': 3,
+            'response': {},
+        }, {
+            'status': 'error',
+            'reference_id': 4,
+            'message': 'Unsupported command: foo.',
+        }])
+
+    def test_unsupported_framing(self):
+        self.proto.dataReceived(self.line('framing', framing='xml'))
+        reply = json.loads(self.read())
+        self.assertEqual(reply['status'], 'error')
+        self.assertEqual(reply['message'], 'Unsupported framing: xml.')
+        self.proto.dataReceived(self.line('echo', id=2))
+        self.assertEqual(json.loads(self.read())['reference_id'], 2)
+
+    def test_framing_with_commands_in_flight(self):
+        self.proto.dataReceived(
+            self.line('wait') + self.line('framing', id=2, framing='msgpack'))
+        self.pending[0].callback('ok')
+        replies = [json.loads(line) for line in self.read().splitlines()]
+        self.assertEqual(replies[0]['message'], (
+            'Framing can only be changed with no commands in flight.'))
+        self.assertTrue(self.proto.line_mode)
+
+    def test_frame_too_long(self):
+        self.proto.dataReceived(self.line('framing', framing='msgpack'))
+        self.proto.dataReceived(
+            struct.pack('>I', self.proto.MAX_LENGTH + 1) + 'x')
+        self.assertFalse(self.transport.connected)
@@ -0,0 +1,153 @@
+from datetime import datetime
+
+from twisted.internet.defer import inlineCallbacks, fail
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from portia.benchmarks.memory import MemoryStorage
+from portia.exceptions import PortiaException
+from portia.replication import (
+    ReplicatedStorage, LeastLatency, parse_replica_uris)
+from portia.sharding import start_storage
+from portia.storage import HashStorage
+from portia.utils import UTC
+
+
+class FailingStorage(MemoryStorage):
+
+    def get(self, msisdn):
+        return fail(Exception('Replica down.'))
+
+
+class ReplicatedStorageTest(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.primary = MemoryStorage()
+        self.replicas = [MemoryStorage(), MemoryStorage()]
+        self.storage = ReplicatedStorage(
+            self.primary, self.replicas, read_your_writes=5,
+            clock=self.clock)
+        for name, storage in [('primary', self.primary),
+                              ('replica-0', self.replicas[0]),
+                              ('replica-1', self.replicas[1])]:
+            storage.entries['+27123456789'] = {'X-from': name}
+            storage.entries['+27123456788'] = {'X-from': name}
+
+    @inlineCallbacks
+    def test_round_robin(self):
+        sources = []
+        for _ in range(4):
+            sources.append((yield self.storage.get('+27123456789'))['X-from'])
+        self.assertEqual(
+            sources, ['replica-0', 'replica-1', 'replica-0', 'replica-1'])
+
+    @inlineCallbacks
+    def test_writes(self):
+        timestamp = datetime(2015, 10, 11, tzinfo=UTC())
+        yield self.storage.write_many([
+            ('+27000000000', {'X-foo': ('bar', timestamp)})])
+        self.assertTrue('+27000000000' in self.primary.entries)
+        self.assertFalse(self.storage.recent_writes)
+        yield self.storage.write(
+            '+27123456789', {'X-foo': ('bar', timestamp)})
+        self.assertEqual(
+            self.primary.entries['+27123456789']['X-foo'], 'bar')
+        self.assertFalse('X-foo' in self.replicas[0].entries['+27123456789'])
+
+    @inlineCallbacks
+    def test_read_your_writes(self):
+        yield self.storage.write('+27123456789', {
+            'X-foo': ('bar', datetime(2015, 10, 11, tzinfo=UTC()))})
+        self.assertEqual(
+            (yield self.storage.get('+27123456789'))['X-from'], 'primary')
+        self.assertEqual(
+            (yield self.storage.get_many(
+                ['+27123456788', '+27123456789']))[0]['X-from'],
+            'primary')
+        self.assertEqual(
+            (yield self.storage.get('+27123456788'))['X-from'], 'replica-0')
+        self.clock.advance(5)
+        self.assertEqual(
+            (yield self.storage.get('+27123456789'))['X-from'], 'replica-1')
+
+    @inlineCallbacks
+    def test_recent_writes_expire(self):
+        yield self.storage.remove('+27123456789')
+        self.clock.advance(6)
+        yield self.storage.remove('+27123456788')
+        self.assertEqual(list(self.storage.recent_writes), ['+27123456788'])
+
+    @inlineCallbacks
+    def test_replica_failure(self):
+        storage = ReplicatedStorage(
+            self.primary, [FailingStorage()], clock=self.clock)
+        self.assertEqual(
+            (yield storage.get('+27123456789'))['X-from'], 'primary')
+
+    def test_least_latency(self):
+        strategy = LeastLatency(self.replicas)
+        strategy.observe(self.replicas[0], 0.01)
+        self.assertTrue(strategy.choose() is self.replicas[1])
+        strategy.observe(self.replicas[1], 0.05)
+        self.assertTrue(strategy.choose() is self.replicas[0])
+        strategy.observe(self.replicas[0], 0.0, failed=True)
+        self.assertTrue(strategy.choose() is self.replicas[1])
+
+    def test_least_latency_recovers(self):
+        strategy = LeastLatency(self.replicas)
+        for _ in range(5):
+            strategy.observe(self.replicas[0], 0.0, failed=True)
+        reads = 0
+        while strategy.choose() is self.replicas[1]:
+            strategy.observe(self.replicas[1], 0.01)
+            reads += 1
+            self.assertTrue(reads < 1000, 'replica never retried')
+        # It has recovered, so it stays in use once it is fast again.
+        strategy.observe(self.replicas[0], 0.001)
+        self.assertTrue(strategy.choose() is self.replicas[0])
+
+    def test_invalid(self):
+        self.assertRaises(
+            PortiaException, ReplicatedStorage, self.primary, [])
+        self.assertRaises(
+            PortiaException, ReplicatedStorage, self.primary, self.replicas,
+            strategy='random')
+
+
+class ParseReplicaUrisTest(TestCase):
+
+    def test_single_primary(self):
+        self.assertEqual(
+            parse_replica_uris(['redis://b/1', 'redis://c/1'],
+                               ['redis://a/1']),
+            {'redis://a/1': ['redis://b/1', 'redis://c/1']})
+
+    def test_sharded(self):
+        self.assertEqual(
+            parse_replica_uris(
+                ['redis://a/1,redis://c/1'], ['redis://a/1', 'redis://b/1']),
+            {'redis://a/1': ['redis://c/1'], 'redis://b/1': []})
+        self.assertRaises(
+            PortiaException, parse_replica_uris, ['redis://c/1'],
+            ['redis://a/1', 'redis://b/1'])
+        self.assertRaises(
+            PortiaException, parse_replica_uris, ['redis://d/1,redis://c/1'],
+            ['redis://a/1', 'redis://b/1'])
+
+
+class StartStorageTest(TestCase):
+
+    timeout = 1
+
+    @inlineCallbacks
+    def test_replicas(self):
+        storage = yield start_storage(
+            ['redis://localhost:6379/1'], 'portia:',
+            replica_uris=['redis://localhost:6379/1'],
+            read_your_writes=1)
+        self.addCleanup(storage.replicas[0].redis.disconnect)
+        self.addCleanup(storage.primary.redis.disconnect)
+        self.assertTrue(isinstance(storage, ReplicatedStorage))
+        self.assertTrue(isinstance(storage.primary, HashStorage))
+        self.assertTrue(storage.primary is not storage.replicas[0])
@@ -0,0 +1,93 @@
+from datetime import datetime
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial.unittest import TestCase
+
+from portia import utils
+from portia.exceptions import PortiaException
+from portia.sharding import HashRing, ShardedStorage
+from portia.storage import HashStorage, CompactHashStorage
+from portia.tests import test_storage
+from portia.utils import UTC
+
+
+class HashRingTest(TestCase):
+
+    def test_spread(self):
+        ring = HashRing(['a', 'b', 'c'])
+        counts = {}
+        for number in range(3000):
+            node = ring.get('+2782%07d' % (number,))
+            counts[node] = counts.get(node, 0) + 1
+        self.assertEqual(sorted(counts), ['a', 'b', 'c'])
+        for count in counts.values():
+            self.assertTrue(700 < count < 1300, counts)
+
+    def test_adding_a_node_moves_only_its_keys(self):
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b', 'c', 'd'])
+        keys = ['+2782%07d' % (number,) for number in range(2000)]
+        moved = [key for key in keys if before.get(key) != after.get(key)]
+        self.assertTrue(all(after.get(key) == 'd' for key in moved))
+        self.assertTrue(len(moved) < len(keys) / 2)
+
+    def test_no_nodes(self):
+        self.assertRaises(PortiaException, HashRing, [])
+
+
+class ShardedHashStorageTest(test_storage.HashStorageTest):
+
+    layout = HashStorage
+
+    @inlineCallbacks
+    def setUp(self):
+        self.connections = []
+        for _ in range(3):
+            redis = yield utils.start_redis()
+            self.addCleanup(redis.disconnect)
+            self.connections.append(redis)
+        yield super(ShardedHashStorageTest, self).setUp()
+
+    def make_storage(self, redis, prefix):
+        self.shards = [
+            self.layout(connection, '%s%d:' % (prefix, index))
+            for index, connection in enumerate(self.connections)]
+        return ShardedStorage(self.shards, names=['a', 'b', 'c'])
+
+    def test_names(self):
+        self.assertRaises(
+            PortiaException, ShardedStorage, self.shards, names=['a'])
+        self.assertRaises(
+            PortiaException, ShardedStorage, self.shards,
+            names=['a', 'a', 'b'])
+
+    @inlineCallbacks
+    def test_fan_out(self):
+        timestamp = datetime(2015, 10, 11, tzinfo=UTC())
+        msisdns = ['+2778%02d00000' % (number,) for number in range(30)]
+        yield self.storage.write_many([
+            (msisdn, {'X-foo': (msisdn, timestamp)}) for msisdn in msisdns])
+
+        stored = []
+        for shard in self.shards:
+            entries = yield shard.get_many(msisdns)
+            stored.append(len(filter(None, entries)))
+        self.assertEqual(sum(stored), 30)
+        self.assertEqual(len(filter(None, stored)), 3)
+
+        entries = yield self.storage.get_many(msisdns)
+        self.assertEqual(
+            [entry['X-foo'] for entry in entries], msisdns)
+        self.assertEqual((yield self.storage.flush()), 30)
+
+
+class ShardedCompactHashStorageTest(ShardedHashStorageTest):
+
+    layout = CompactHashStorage
+
+    def test_buckets_share_a_shard(self):
+        storage = ShardedStorage(self.shards, names=['a', 'b', 'c'])
+        self.assertTrue(all(
+            storage.shard('+277812345%02d' % (number,)) is
+            storage.shard('+27781234500')
+            for number in range(100)))
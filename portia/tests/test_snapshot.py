@@ -0,0 +1,145 @@
+import phonenumbers
+from datetime import datetime
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial.unittest import TestCase
+
+from portia import utils
+from portia.exceptions import PortiaException, ReadOnlyStorageException
+from portia.portia import Portia
+from portia.snapshot import SnapshotBuilder, SnapshotStorage, pack_msisdn
+from portia.storage import HashStorage
+from portia.utils import UTC
+
+
+class SnapshotTest(TestCase):
+
+    def setUp(self):
+        self.builder = SnapshotBuilder()
+        self.path = self.mktemp()
+
+    def load(self):
+        self.builder.save(self.path)
+        storage = SnapshotStorage(self.path)
+        self.addCleanup(storage.close)
+        return storage
+
+    def test_pack_msisdn(self):
+        self.assertEqual(pack_msisdn('+27123456789'), 27123456789)
+        self.assertEqual(pack_msisdn('27123456789'), None)
+        self.assertEqual(pack_msisdn('+2712345678a'), None)
+        self.assertEqual(pack_msisdn('+' + '9' * 16), None)
+
+    @inlineCallbacks
+    def test_lookups(self):
+        older = datetime(2015, 10, 11, tzinfo=UTC())
+        newer = datetime(2015, 10, 12, 1, 2, 3, 4, tzinfo=UTC())
+        skipped = yield self.builder.write_many([
+            ('+27123456789', {
+                'ported-to': ('MNO2', newer),
+                'ported-from': ('MNO1', newer),
+                'X-foo': ('bar', newer),
+            }),
+            ('+27123456789', {'ported-to': ('MNO3', older)}),
+            ('+27123456700', {'observed-network': ('MNO1', older)}),
+        ])
+        self.assertEqual(skipped, 1)
+        self.assertEqual(self.builder.dropped, 1)
+        storage = self.load()
+
+        entry = {
+            'ported-to': 'MNO2',
+            'ported-to-timestamp': '2015-10-12T01:02:03.000004+00:00',
+            'ported-from': 'MNO1',
+            'ported-from-timestamp': '2015-10-12T01:02:03.000004+00:00',
+        }
+        self.assertEqual((yield storage.get('+27123456789')), entry)
+        self.assertEqual((yield storage.get('+27123456788')), {})
+        self.assertEqual((yield storage.get('not-an-msisdn')), {})
+        self.assertEqual(
+            (yield storage.get_many(['+27123456700', '+27123456789']))[1],
+            entry)
+        self.assertEqual(
+            (yield storage.get_keys_many(
+                ['+27123456700', '+27123456789'],
+                ['observed-network', 'ported-to'])),
+            [{
+                'observed-network': 'MNO1',
+                'observed-network-timestamp': '2015-10-11T00:00:00+00:00',
+            }, {
+                'ported-to': 'MNO2',
+                'ported-to-timestamp': '2015-10-12T01:02:03.000004+00:00',
+            }])
+        self.assertEqual(
+            (yield storage.read('+27123456789', 'do-not-call')), {
+                'do-not-call': None,
+                'do-not-call-timestamp': None,
+            })
+
+    @inlineCallbacks
+    def test_scan_entries(self):
+        timestamp = datetime(2015, 10, 11, tzinfo=UTC())
+        yield self.builder.write_many([
+            ('+2712345678%d' % (digit,), {'ported-to': ('MNO', timestamp)})
+            for digit in [3, 1, 2]])
+        storage = self.load()
+        found = []
+
+        def process(entries):
+            found.extend(msisdn for msisdn, _ in entries)
+            return len(entries)
+
+        self.assertEqual((yield storage.scan_entries(process, count=2)), 3)
+        self.assertEqual(
+            found, ['+27123456781', '+27123456782', '+27123456783'])
+
+    @inlineCallbacks
+    def test_read_only(self):
+        storage = self.load()
+        yield self.assertFailure(
+            storage.write('+27123456789', {}), ReadOnlyStorageException)
+        yield self.assertFailure(
+            storage.remove('+27123456789'), ReadOnlyStorageException)
+
+    def test_invalid_file(self):
+        with open(self.path, 'wb') as fp:
+            fp.write('not a snapshot' * 10)
+        self.assertRaises(PortiaException, SnapshotStorage, self.path)
+
+    @inlineCallbacks
+    def test_resolve(self):
+        portia = Portia(None, storage=self.builder)
+        yield portia.import_porting_record(
+            '+27123456789', 'MNO1', 'MNO2', datetime(2015, 10, 11))
+        portia = Portia(None, storage=self.load())
+        result = yield portia.resolve(phonenumbers.parse('+27123456789'))
+        self.assertEqual(result['network'], 'MNO2')
+        self.assertEqual(result['strategy'], 'ported-to')
+
+
+class SnapshotFromRedisTest(TestCase):
+
+    timeout = 1
+
+    @inlineCallbacks
+    def setUp(self):
+        self.redis = yield utils.start_redis()
+        self.storage = HashStorage(self.redis, 'portia:')
+        self.addCleanup(self.redis.disconnect)
+        self.addCleanup(self.storage.flush)
+
+    @inlineCallbacks
+    def test_build(self):
+        portia = Portia(self.redis, storage=self.storage)
+        yield portia.import_porting_record(
+            '+27123456789', 'MNO1', 'MNO2', datetime(2015, 10, 11))
+        builder = SnapshotBuilder()
+        self.assertEqual(
+            (yield self.storage.scan_entries(builder.add_entries)), 1)
+        path = self.mktemp()
+        self.assertEqual(builder.save(path), 1)
+        snapshot = SnapshotStorage(path)
+        self.addCleanup(snapshot.close)
+        self.assertEqual(
+            (yield snapshot.get('+27123456789')),
+            (yield self.storage.get('+27123456789')))
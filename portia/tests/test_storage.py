@@ -0,0 +1,288 @@
+import os
+import pkg_resources
+import phonenumbers
+from datetime import datetime
+
+from twisted.internet.defer import gatherResults, inlineCallbacks
+from twisted.trial.unittest import TestCase
+
+from portia import utils
+from portia.exceptions import PortiaException
+from portia.portia import Portia
+from portia.storage import (
+    HashStorage, CompactHashStorage, storage_for_layout, migrate)
+from portia.utils import UTC
+
+
+class HashStorageTest(TestCase):
+
+    timeout = 1
+
+    @inlineCallbacks
+    def setUp(self):
+        self.redis = yield utils.start_redis()
+        self.storage = self.make_storage(self.redis, 'portia:')
+        self.portia = Portia(self.redis, storage=self.storage)
+        self.addCleanup(self.redis.disconnect)
+        self.addCleanup(self.portia.flush)
+
+    def make_storage(self, redis, prefix):
+        return HashStorage(redis, prefix)
+
+    def fixture_path(self, fixture_name):
+        return pkg_resources.resource_filename(
+            'portia', os.path.join('tests', 'fixtures', fixture_name))
+
+    @inlineCallbacks
+    def test_annotations(self):
+        phonenumber = phonenumbers.parse('+27123456789')
+        yield self.portia.annotate(
+            phonenumber, 'ported-to', 'MNO',
+            timestamp=datetime(2015, 10, 11, 12, 13, 14, 15))
+        yield self.portia.annotate(
+            phonenumber, 'X-foo', 'bar',
+            timestamp=datetime(2015, 10, 10))
+        self.assertEqual((yield self.portia.get_annotations(phonenumber)), {
+            'ported-to': 'MNO',
+            'ported-to-timestamp': '2015-10-11T12:13:14.000015+00:00',
+            'X-foo': 'bar',
+            'X-foo-timestamp': '2015-10-10T00:00:00+00:00',
+        })
+        self.assertEqual(
+            (yield self.portia.read_annotation(phonenumber, 'X-foo')), {
+                'X-foo': 'bar',
+                'X-foo-timestamp': '2015-10-10T00:00:00+00:00',
+            })
+        self.assertEqual(
+            (yield self.portia.read_annotation(phonenumber, 'ported-from')), {
+                'ported-from': None,
+                'ported-from-timestamp': None,
+            })
+
+    @inlineCallbacks
+    def test_conditional_writes(self):
+        newer = {'ported-to': ('MNO2', datetime(2015, 10, 12, tzinfo=UTC()))}
+        older = {
+            'ported-to': ('MNO1', datetime(2015, 10, 11, tzinfo=UTC())),
+            'X-foo': ('bar', datetime(2015, 10, 11, tzinfo=UTC())),
+        }
+        self.assertEqual((yield self.storage.write('+27123456789', newer)), 0)
+        self.assertEqual((yield self.storage.write_many([
+            ('+27123456789', older),
+            ('+27123456789', newer),
+        ])), 2)
+        self.assertEqual((yield self.storage.get('+27123456789')), {
+            'ported-to': 'MNO2',
+            'ported-to-timestamp': '2015-10-12T00:00:00+00:00',
+            'X-foo': 'bar',
+            'X-foo-timestamp': '2015-10-11T00:00:00+00:00',
+        })
+
+    @inlineCallbacks
+    def test_script_reloaded(self):
+        annotations = {'X-foo': ('bar', datetime(2015, 10, 11, tzinfo=UTC()))}
+        yield self.storage.write('+27123456789', annotations)
+        yield self.redis.execute_command('SCRIPT', 'FLUSH')
+        self.assertEqual(
+            (yield self.storage.write('+27123456789', annotations)), 1)
+
+    @inlineCallbacks
+    def test_get_keys(self):
+        timestamp = datetime(2015, 10, 11, tzinfo=UTC())
+        yield self.storage.write('+27123456789', {
+            'ported-to': ('MNO', timestamp),
+            'X-foo': ('bar', timestamp),
+        })
+        expected = {
+            'ported-to': 'MNO',
+            'ported-to-timestamp': '2015-10-11T00:00:00+00:00',
+        }
+        keys = ['observed-network', 'ported-to']
+        self.assertEqual(
+            (yield self.storage.get_keys('+27123456789', keys)), expected)
+        self.assertEqual(
+            (yield self.storage.get_keys_many(
+                ['+27123456789', '+27123456788'], keys)),
+            [expected, {}])
+
+    @inlineCallbacks
+    def test_get_timestamps(self):
+        yield self.storage.write_many([
+            ('+27123456789', {
+                'ported-to': (
+                    'MNO', datetime(2015, 10, 11, 1, 2, 3, 4, tzinfo=UTC())),
+                'X-foo': ('bar', datetime(2015, 10, 12, tzinfo=UTC())),
+            }),
+            ('+27123456788', {
+                'ported-to': ('MNO', datetime(2015, 10, 13, tzinfo=UTC())),
+            }),
+        ])
+        timestamps = yield self.storage.get_timestamps('+27123456789')
+        self.assertEqual(timestamps, {
+            'ported-to': '2015-10-11T01:02:03.000004+00:00',
+            'X-foo': '2015-10-12T00:00:00+00:00',
+        })
+        entry = yield self.storage.get('+27123456789')
+        self.assertEqual(timestamps, dict(
+            (key, entry['%s-timestamp' % (key,)]) for key in timestamps))
+        self.assertEqual(
+            (yield self.storage.get_timestamps('+27123456780')), {})
+
+    @inlineCallbacks
+    def test_neighbours(self):
+        yield self.portia.import_porting_record(
+            '+27123456789', 'MNO1', 'MNO2', datetime(2015, 10, 11))
+        yield self.portia.import_porting_record(
+            '+27123456788', 'MNO2', 'MNO3', datetime(2015, 10, 12))
+        yield self.portia.remove(phonenumbers.parse('+27123456789'))
+        self.assertEqual(
+            (yield self.portia.get_annotations(
+                phonenumbers.parse('+27123456789'))), {})
+        self.assertEqual(
+            (yield self.portia.get_annotations(
+                phonenumbers.parse('+27123456788')))['ported-to'], 'MNO3')
+
+    @inlineCallbacks
+    def test_get_annotations_many(self):
+        yield self.portia.import_porting_filename(
+            self.fixture_path('sample-db.txt'))
+        entries = yield self.portia.get_annotations_many([
+            phonenumbers.parse('+27123456780'),
+            phonenumbers.parse('+27000000000'),
+        ], chunk_size=1)
+        self.assertEqual(entries[0]['ported-to'], 'MNO2')
+        self.assertEqual(
+            entries[0]['ported-from-timestamp'], '2015-10-11T00:00:00+00:00')
+        self.assertEqual(entries[1], {})
+
+    @inlineCallbacks
+    def test_concurrent_batches(self):
+        redis = yield utils.start_redis(pool_size=2)
+        self.addCleanup(redis.disconnect)
+        storage = self.make_storage(redis, 'portia:')
+        timestamp = datetime(2015, 10, 11, tzinfo=UTC())
+        msisdns = ['+2712345678%d' % (i,) for i in range(10)]
+        yield storage.write_many([
+            (msisdn, {'ported-to': (msisdn, timestamp)})
+            for msisdn in msisdns])
+        entries, keys = yield gatherResults([
+            gatherResults([storage.get_many([msisdn, '+27000000000'])
+                           for msisdn in msisdns]),
+            gatherResults([storage.get_keys_many([msisdn], ['ported-to'])
+                           for msisdn in msisdns]),
+        ])
+        self.assertEqual(
+            [entry['ported-to'] for entry, missing in entries], msisdns)
+        self.assertEqual([missing for _, missing in entries], [{}] * 10)
+        self.assertEqual(
+            [entry['ported-to'] for [entry] in keys], msisdns)
+
+    @inlineCallbacks
+    def test_scan_entries(self):
+        yield self.portia.import_porting_filename(
+            self.fixture_path('sample-db.txt'))
+        found = []
+
+        def process(entries):
+            found.extend(entries)
+            return len(entries)
+
+        self.assertEqual(
+            (yield self.storage.scan_entries(process, count=3)), 10)
+        self.assertEqual(len(set(msisdn for msisdn, _ in found)), 10)
+        for msisdn, annotations in found:
+            self.assertEqual(
+                (yield self.portia.get_annotations(
+                    phonenumbers.parse(msisdn))), annotations)
+
+
+class CompactHashStorageTest(HashStorageTest):
+
+    def make_storage(self, redis, prefix):
+        return CompactHashStorage(redis, prefix)
+
+    @inlineCallbacks
+    def test_bucketing(self):
+        yield self.portia.import_porting_record(
+            '+27123456789', 'MNO1', 'MNO2', datetime(2015, 10, 11))
+        yield self.portia.import_porting_record(
+            '+27123456788', 'MNO2', 'MNO1', datetime(2015, 10, 12))
+        self.assertEqual(
+            (yield self.redis.keys('portia:c:*')), ['portia:c:+271234567'])
+        self.assertEqual((yield self.redis.hgetall('portia:c:+271234567')), {
+            '89:t': '1444521600000000 #1',
+            '89:f': '1444521600000000 #2',
+            '88:t': '1444608000000000 #2',
+            '88:f': '1444608000000000 #1',
+        })
+
+    @inlineCallbacks
+    def test_get_many_one_round_trip(self):
+        yield self.portia.import_porting_filename(
+            self.fixture_path('sample-db.txt'))
+        msisdns = ['+27123456780', '+27123456789', '+27000000000',
+                   '+27123456780']
+        expected = yield gatherResults(
+            [self.storage.get(msisdn) for msisdn in msisdns])
+        scripts = []
+        eval_script = self.storage.eval_script
+        self.patch(self.storage.redis, 'hscan', None)
+        self.patch(self.storage, 'eval_script', lambda *args: (
+            scripts.append(args[0]) or eval_script(*args)))
+        self.assertEqual((yield self.storage.get_many(msisdns)), expected)
+        self.assertEqual(scripts, [self.storage.HGETALL_SCRIPT])
+
+    @inlineCallbacks
+    def test_network_dictionary(self):
+        self.assertEqual((yield self.storage.network_id('MNO1')), 1)
+        self.assertEqual((yield self.storage.network_id('MNO2')), 2)
+        other = CompactHashStorage(self.redis, 'portia:')
+        self.assertEqual((yield other.network_id('MNO2')), 2)
+        yield other.load_network_names([1])
+        self.assertEqual(other.network_names, {1: 'MNO1', 2: 'MNO2'})
+
+    def test_unknown_network_id(self):
+        return self.assertFailure(
+            self.storage.load_network_names([1]), PortiaException)
+
+
+class MigrateTest(TestCase):
+
+    timeout = 1
+
+    @inlineCallbacks
+    def setUp(self):
+        self.redis = yield utils.start_redis()
+        self.portia = Portia(self.redis)
+        self.addCleanup(self.redis.disconnect)
+        self.addCleanup(self.portia.flush)
+
+    def test_storage_for_layout(self):
+        self.assertTrue(isinstance(
+            storage_for_layout('hash', self.redis, 'portia:'), HashStorage))
+        storage = storage_for_layout(
+            'compact', self.redis, 'portia:', bucket_digits=3)
+        self.assertTrue(isinstance(storage, CompactHashStorage))
+        self.assertEqual(storage.bucket_digits, 3)
+        self.assertRaises(
+            PortiaException, storage_for_layout, 'foo', self.redis, 'portia:')
+
+    @inlineCallbacks
+    def test_migrate(self):
+        yield self.portia.import_porting_filename(
+            pkg_resources.resource_filename(
+                'portia', os.path.join('tests', 'fixtures', 'sample-db.txt')))
+        before = yield self.portia.get_annotations(
+            phonenumbers.parse('+27123456780'))
+        compact = CompactHashStorage(self.redis, 'portia:')
+        migrated = yield migrate(self.portia.storage, compact, count=3)
+        self.assertEqual(migrated, 10)
+        self.assertEqual((yield self.redis.keys('portia:+*')), [])
+        self.assertEqual((yield compact.get('+27123456780')), before)
+
+        migrated = yield migrate(compact, self.portia.storage)
+        self.assertEqual(migrated, 10)
+        self.assertEqual((yield self.redis.keys('portia:c:*')), [])
+        self.assertEqual(
+            (yield self.portia.get_annotations(
+                phonenumbers.parse('+27123456780'))), before)
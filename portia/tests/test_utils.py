@@ -0,0 +1,93 @@
+from twisted.internet.defer import inlineCallbacks, gatherResults
+from twisted.internet.protocol import ServerFactory
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from portia import utils
+from portia.exceptions import PortiaException
+
+
+class ChunkedTest(TestCase):
+
+    def test_chunked(self):
+        self.assertEqual(
+            list(utils.chunked(range(7), 3)), [[0, 1, 2], [3, 4, 5], [6]])
+
+    def test_chunked_empty(self):
+        self.assertEqual(list(utils.chunked([], 3)), [])
+
+
+class ProgressTest(TestCase):
+
+    def test_rate(self):
+        clock = Clock()
+        progress = utils.Progress('Imported', 'rows', clock=clock, interval=5)
+        progress.start()
+        clock.advance(2)
+        progress.update(100)
+        self.assertEqual(progress.count, 100)
+        self.assertEqual(progress.rate(), 50.0)
+        self.assertEqual(progress.finish(), 100)
+
+
+class RedisUriTest(TestCase):
+
+    def test_tcp(self):
+        self.assertEqual(
+            utils.parse_redis_uri('redis://:secret@redis:6380/2'), {
+                'host': 'redis',
+                'port': 6380,
+                'dbid': 2,
+                'password': 'secret',
+            })
+        self.assertEqual(
+            utils.parse_redis_uri('redis://localhost/1')['port'], 6379)
+
+    def test_unix(self):
+        self.assertEqual(
+            utils.parse_redis_uri('unix:///var/run/redis.sock?db=3'), {
+                'path': '/var/run/redis.sock',
+                'dbid': 3,
+                'password': None,
+            })
+        self.assertEqual(
+            utils.parse_redis_uri('unix:///tmp/redis.sock')['dbid'], 0)
+
+    def test_invalid(self):
+        self.assertRaises(
+            PortiaException, utils.parse_redis_uri, 'redis:///1')
+        self.assertRaises(
+            PortiaException, utils.parse_redis_uri, 'redis://localhost/a')
+        self.assertRaises(
+            PortiaException, utils.parse_redis_uri, 'unix://?db=1')
+
+
+class StartRedisTest(TestCase):
+
+    timeout = 1
+
+    @inlineCallbacks
+    def test_pool(self):
+        redis = yield utils.start_redis(pool_size=3, command_timeout=1)
+        self.addCleanup(redis.disconnect)
+        self.assertEqual(len(redis._factory.pool), 3)
+        results = yield gatherResults([redis.ping() for _ in range(10)])
+        self.assertEqual(set(results), set(['PONG']))
+
+    @inlineCallbacks
+    def test_lazy(self):
+        redis = yield utils.start_redis(pool_size=2, lazy=True)
+        self.addCleanup(redis.disconnect)
+        self.assertEqual((yield redis.ping()), 'PONG')
+
+
+class ListenTest(TestCase):
+
+    @inlineCallbacks
+    def test_listen_shared(self):
+        shared = yield utils.listen_shared('tcp:0:interface=127.0.0.1')
+        self.addCleanup(shared.stopListening)
+        port = yield utils.listen(
+            ServerFactory(), None, fd=shared.socket.fileno())
+        self.addCleanup(port.stopListening)
+        self.assertEqual(port.getHost().port, shared.getHost().port)
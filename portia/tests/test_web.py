@@ -1,16 +1,19 @@
+import json
 import pkg_resources
 import phonenumbers
 from datetime import datetime
 
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, fail
 from twisted.web.client import HTTPConnectionPool
 from twisted.trial.unittest import TestCase
 
 import treq
 
 from portia.web import PortiaWebServer
+from portia.metrics import Metrics
 from portia.portia import Portia
+from portia.cache import LRUCache
 from portia import utils
 
 
@@ -38,13 +41,14 @@ class PortiaServerTest(TestCase):
         self.pool = HTTPConnectionPool(reactor, persistent=False)
         self.addCleanup(self.pool.closeCachedConnections)
 
-    def request(self, method, path, data=None):
+    def request(self, method, path, data=None, headers=None):
         return treq.request(
             method, 'http://localhost:%s%s' % (
                 self.listener_port,
                 path
             ),
             data=data,
+            headers=headers,
             pool=self.pool)
 
     @inlineCallbacks
@@ -63,7 +67,7 @@ class PortiaServerTest(TestCase):
     @inlineCallbacks
     def test_lookup(self):
         timestamp = datetime.now()
-        self.portia.import_porting_record(
+        yield self.portia.import_porting_record(
             '+27123456789', 'MNO1', 'MNO2', timestamp)
         response = yield self.request('GET', '/entry/%2B27123456789')
         data = yield response.json()
@@ -74,10 +78,107 @@ class PortiaServerTest(TestCase):
             'ported-from-timestamp': self.portia.to_utc(timestamp).isoformat(),
         })
 
+    @inlineCallbacks
+    def test_lookup_not_modified(self):
+        yield self.portia.import_porting_record(
+            '+27123456789', 'MNO1', 'MNO2', datetime(2015, 10, 11, 12))
+        response = yield self.request('GET', '/entry/%2B27123456789')
+        yield response.content()
+        etag = response.headers.getRawHeaders('ETag')[0]
+        self.assertEqual(
+            response.headers.getRawHeaders('Last-Modified'),
+            ['Sun, 11 Oct 2015 12:00:00 GMT'])
+
+        response = yield self.request(
+            'GET', '/entry/%2B27123456789', headers={'If-None-Match': etag})
+        self.assertEqual((yield response.content()), '')
+        self.assertEqual(response.code, 304)
+        response = yield self.request(
+            'GET', '/entry/%2B27123456789',
+            headers={'If-Modified-Since': 'Sun, 11 Oct 2015 12:00:00 GMT'})
+        yield response.content()
+        self.assertEqual(response.code, 304)
+
+        # An older annotation leaves Last-Modified alone but not the ETag.
+        yield self.portia.annotate(
+            phonenumbers.parse('+27123456789'), 'X-foo', 'bar',
+            timestamp=datetime(2015, 10, 10))
+        response = yield self.request(
+            'GET', '/entry/%2B27123456789', headers={'If-None-Match': etag})
+        data = yield response.json()
+        self.assertEqual(response.code, 200)
+        self.assertEqual(data['X-foo'], 'bar')
+        self.assertNotEqual(
+            response.headers.getRawHeaders('ETag')[0], etag)
+
+    @inlineCallbacks
+    def test_resolve_not_modified(self):
+        yield self.portia.annotate(
+            phonenumbers.parse('+27123456789'), 'observed-network', 'MNO',
+            timestamp=datetime(2015, 10, 11))
+        response = yield self.request('GET', '/resolve/%2B27123456789')
+        data = yield response.json()
+        self.assertEqual(data['network'], 'MNO')
+        etag = response.headers.getRawHeaders('ETag')[0]
+        for path in ['/resolve/%2B27123456789',
+                     '/resolve/%2B27123456789?entry=false']:
+            response = yield self.request(
+                'GET', path, headers={'If-None-Match': 'W/%s' % (etag,)})
+            yield response.content()
+            self.assertEqual(response.code, 304)
+        response = yield self.request(
+            'GET', '/resolve/%2B27123456789',
+            headers={'If-Modified-Since': 'Sat, 10 Oct 2015 00:00:00 GMT'})
+        yield response.content()
+        self.assertEqual(response.code, 200)
+
+    @inlineCallbacks
+    def test_resolve_not_modified_cached(self):
+        self.portia.resolve_cache = LRUCache(100, ttl=60)
+        phonenumber = phonenumbers.parse('+27123456789')
+        yield self.portia.annotate(
+            phonenumber, 'ported-to', 'MNO1',
+            timestamp=datetime(2015, 10, 10))
+        response = yield self.request('GET', '/resolve/%2B27123456789')
+        yield response.content()
+        etag = response.headers.getRawHeaders('ETag')[0]
+
+        # A write through another process leaves this one's cache stale.
+        other = Portia(self.redis)
+        yield other.annotate(
+            phonenumber, 'ported-to', 'MNO2',
+            timestamp=datetime(2015, 10, 11))
+        for path in ['/resolve/%2B27123456789',
+                     '/resolve/%2B27123456789?entry=false']:
+            response = yield self.request(
+                'GET', path, headers={'If-None-Match': etag})
+            data = yield response.json()
+            self.assertEqual(data['network'], 'MNO2')
+            new_etag = response.headers.getRawHeaders('ETag')[0]
+            self.assertNotEqual(new_etag, etag)
+            response = yield self.request(
+                'GET', path, headers={'If-None-Match': new_etag})
+            yield response.content()
+            self.assertEqual(response.code, 304)
+
+    @inlineCallbacks
+    def test_resolve_without_entry_unconditional(self):
+        yield self.portia.annotate(
+            phonenumbers.parse('+27123456789'), 'observed-network', 'MNO',
+            timestamp=datetime(2015, 10, 11))
+        self.patch(self.portia, 'get_timestamps', lambda phonenumber: fail(
+            AssertionError('timestamps looked up')))
+        response = yield self.request(
+            'GET', '/resolve/%2B27123456789?entry=false')
+        data = yield response.json()
+        self.assertEqual(data['network'], 'MNO')
+        self.assertFalse(response.headers.hasHeader('ETag'))
+        self.assertFalse(response.headers.hasHeader('Last-Modified'))
+
     @inlineCallbacks
     def test_lookup_key(self):
         timestamp = datetime.now()
-        self.portia.import_porting_record(
+        yield self.portia.import_porting_record(
             '+27123456789', 'MNO1', 'MNO2', timestamp)
         response = yield self.request('GET', '/entry/%2B27123456789/ported-to')
         data = yield response.json()
@@ -131,6 +232,57 @@ class PortiaServerTest(TestCase):
         self.assertEqual(result['network'], 'MNO')
         self.assertEqual(result['strategy'], 'observed-network')
 
+    @inlineCallbacks
+    def test_resolve_without_entry(self):
+        yield self.portia.annotate(
+            phonenumbers.parse('+27123456789'), 'observed-network', 'MNO',
+            timestamp=datetime.now())
+        response = yield self.request(
+            'GET', '/resolve/%2B27123456789?entry=false')
+        result = yield response.json()
+        self.assertEqual(result['network'], 'MNO')
+        self.assertEqual(result['strategy'], 'observed-network')
+        self.assertFalse('entry' in result)
+
+        response = yield self.request(
+            'POST', '/resolve?entry=false', data=json.dumps(['+27123456789']))
+        results = yield response.json()
+        self.assertEqual(results, [result])
+
+    @inlineCallbacks
+    def test_metrics_disabled(self):
+        response = yield self.request('GET', '/metrics')
+        self.assertEqual(response.code, 404)
+
+    @inlineCallbacks
+    def test_metrics(self):
+        self.listener.loseConnection()
+        metrics = Metrics()
+        self.listener = yield utils.start_webserver(
+            self.portia, 'tcp:0', metrics=metrics)
+        self.listener_port = self.listener.getHost().port
+        self.addCleanup(self.listener.loseConnection)
+
+        response = yield self.request('GET', '/resolve/%2B27763456789')
+        yield response.content()
+        response = yield self.request('GET', '/entry/%2B27763456789/foo')
+        yield response.content()
+        response = yield self.request('GET', '/metrics')
+        self.assertEqual(
+            response.headers.getRawHeaders('Content-Type'),
+            [metrics.content_type])
+        content = yield response.content()
+        self.assertTrue(
+            'portia_http_responses_total{route="resolve",code="200"} 1.0'
+            in content)
+        self.assertTrue(
+            'portia_http_responses_total{route="read_annotation",code="400"}'
+            ' 1.0' in content)
+        self.assertTrue(
+            'portia_http_request_duration_seconds_count{route="resolve"} 1'
+            in content)
+        self.assertTrue('portia_http_requests_in_flight 0.0' in content)
+
     @inlineCallbacks
     def test_resolve_prefix_guess(self):
         response = yield self.request('GET', '/resolve/%2B27763456789')
@@ -144,3 +296,71 @@ class PortiaServerTest(TestCase):
         result = yield response.json()
         self.assertEqual(result['network'], None)
         self.assertEqual(result['strategy'], 'prefix-guess')
+
+    @inlineCallbacks
+    def test_resolve_many(self):
+        yield self.portia.annotate(
+            phonenumbers.parse('+27123456789'), 'observed-network', 'MNO',
+            timestamp=datetime.now())
+        response = yield self.request(
+            'POST', '/resolve',
+            data=json.dumps(['+27123456789', 'foo', '+27763456789']))
+        results = yield response.json()
+        self.assertEqual(response.code, 200)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0]['network'], 'MNO')
+        self.assertEqual(results[0]['strategy'], 'observed-network')
+        self.assertEqual(results[0]['msisdn'], '+27123456789')
+        self.assertEqual(results[1]['msisdn'], 'foo')
+        self.assertTrue(results[1]['error'])
+        self.assertEqual(results[2]['network'], 'VODACOM')
+        self.assertEqual(results[2]['strategy'], 'prefix-guess')
+
+    @inlineCallbacks
+    def test_resolve_many_ndjson(self):
+        response = yield self.request(
+            'POST', '/resolve',
+            data='"+27763456789"\n123\n["+27763456788"]\n',
+            headers={'Content-Type': ['application/x-ndjson']})
+        content = yield response.content()
+        self.assertEqual(
+            response.headers.getRawHeaders('Content-Type'),
+            ['application/x-ndjson'])
+        first, second, third = [
+            json.loads(line) for line in content.splitlines()]
+        self.assertEqual(first['network'], 'VODACOM')
+        self.assertEqual(second, {
+            'msisdn': 123,
+            'error': 'Invalid MSISDN: 123',
+        })
+        self.assertEqual(third, {
+            'msisdn': ['+27763456788'],
+            'error': 'Invalid MSISDN: ["+27763456788"]',
+        })
+
+    @inlineCallbacks
+    def test_resolve_many_invalid_json(self):
+        response = yield self.request('POST', '/resolve', data='[')
+        self.assertEqual((yield response.json()), 'Invalid JSON supplied')
+        self.assertEqual(response.code, 400)
+
+    @inlineCallbacks
+    def test_resolve_many_not_a_list(self):
+        response = yield self.request('POST', '/resolve', data='{}')
+        self.assertEqual(
+            (yield response.json()), 'Expected a list of MSISDNs')
+        self.assertEqual(response.code, 400)
+
+    @inlineCallbacks
+    def test_resolve_many_too_large(self):
+        self.listener.loseConnection()
+        self.listener = yield utils.start_webserver(
+            self.portia, 'tcp:0', max_batch_size=1)
+        self.listener_port = self.listener.getHost().port
+        self.addCleanup(self.listener.loseConnection)
+        response = yield self.request(
+            'POST', '/resolve', data=json.dumps(['+27123456789'] * 2))
+        self.assertEqual(
+            (yield response.json()),
+            'Too many MSISDNs supplied, the maximum is 1')
+        self.assertEqual(response.code, 413)
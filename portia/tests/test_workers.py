@@ -0,0 +1,102 @@
+from twisted.internet.error import ProcessDone, ProcessTerminated
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.trial.unittest import TestCase
+
+from portia.workers import WorkerSupervisor
+
+
+class FakeProcess(object):
+
+    def __init__(self, protocol, pid, args, child_fds):
+        self.protocol = protocol
+        self.pid = pid
+        self.args = args
+        self.child_fds = child_fds
+        self.signals = []
+
+    def signalProcess(self, name):
+        self.signals.append(name)
+
+    def end(self, reason):
+        self.protocol.processEnded(Failure(reason))
+
+
+class FakeProcessReactor(Clock):
+
+    def __init__(self):
+        Clock.__init__(self)
+        self.spawned = []
+
+    def spawnProcess(self, protocol, executable, args, env=None,
+                     childFDs=None):
+        process = FakeProcess(
+            protocol, 100 + len(self.spawned), args, childFDs)
+        self.spawned.append(process)
+        protocol.makeConnection(process)
+        return process
+
+
+class WorkerSupervisorTest(TestCase):
+
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        self.supervisor = WorkerSupervisor(
+            ['-m', 'portia.cli', 'run'], 2, fds=[7], executable='python',
+            env={}, restart_delay=1, max_restart_delay=4, min_uptime=10,
+            reactor=self.reactor)
+
+    def test_start(self):
+        self.supervisor.start()
+        self.assertEqual(len(self.reactor.spawned), 2)
+        process = self.reactor.spawned[0]
+        self.assertEqual(process.args, ['python', '-m', 'portia.cli', 'run'])
+        self.assertEqual(process.child_fds, {0: 0, 1: 1, 2: 2, 7: 7})
+
+    def test_restart(self):
+        self.supervisor.start()
+        self.reactor.advance(60)
+        self.reactor.spawned[0].end(ProcessTerminated(signal=9))
+        self.assertEqual(sorted(self.supervisor.processes), [1])
+        self.reactor.advance(1)
+        self.assertEqual(len(self.reactor.spawned), 3)
+        self.assertEqual(sorted(self.supervisor.processes), [0, 1])
+
+    def test_restart_backoff(self):
+        self.supervisor.start()
+        delays = []
+        for _ in range(4):
+            self.supervisor.processes[0].end(ProcessTerminated(exitCode=1))
+            delays.append(self.reactor.getDelayedCalls()[0].getTime() -
+                          self.reactor.seconds())
+            self.reactor.advance(delays[-1])
+        self.assertEqual(delays, [1, 2, 4, 4])
+
+    def test_stop(self):
+        self.supervisor.start()
+        d = self.supervisor.stop()
+        self.assertEqual(
+            [process.signals for process in self.reactor.spawned],
+            [['TERM'], ['TERM']])
+        self.reactor.spawned[0].end(ProcessDone(0))
+        self.assertNoResult(d)
+        self.reactor.spawned[1].end(ProcessDone(0))
+        self.successResultOf(d)
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+        self.assertEqual(len(self.reactor.spawned), 2)
+
+    def test_stop_kills_after_timeout(self):
+        self.supervisor.start()
+        d = self.supervisor.stop(timeout=5)
+        self.reactor.spawned[0].end(ProcessDone(0))
+        self.reactor.advance(5)
+        self.assertEqual(self.reactor.spawned[1].signals, ['TERM', 'KILL'])
+        self.reactor.spawned[1].end(ProcessTerminated(signal=9))
+        self.successResultOf(d)
+
+    def test_stop_cancels_restarts(self):
+        self.supervisor.start()
+        self.reactor.spawned[0].end(ProcessTerminated(exitCode=1))
+        self.supervisor.stop()
+        self.reactor.advance(60)
+        self.assertEqual(len(self.reactor.spawned), 2)
@@ -1,51 +1,226 @@
+from datetime import tzinfo, timedelta
 from glob import glob
+from itertools import islice
 import json
 import os
-from urlparse import urlparse
+import socket
+from urlparse import urlparse, parse_qs
 
 from twisted.internet.endpoints import serverFromString
 from twisted.internet import reactor as default_reactor
+from twisted.internet.defer import succeed
+from twisted.internet.protocol import ServerFactory
 from twisted.web.server import Site
 from twisted.python import log
 
-from txredisapi import Connection
+from txredisapi import (
+    ConnectionPool, lazyConnectionPool, UnixConnectionPool,
+    lazyUnixConnectionPool)
 
 from .web import PortiaWebServer
 from .protocol import JsonProtocolFactory
+from .prefixes import NetworkPrefixTrie
 from .exceptions import PortiaException
 
 
-def start_redis(redis_uri='redis://localhost:6379/1'):
+class UTC(tzinfo):
+    """
+    UTC implementation taken from Python's docs.
+    """
+
+    def __repr__(self):
+        return "<UTC>"
+
+    def utcoffset(self, dt):
+        return timedelta(0)
+
+    def tzname(self, dt):
+        return "UTC"
+
+    def dst(self, dt):
+        return timedelta(0)
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class Progress(object):
+    """
+    Keeps count of how many items an operation has processed and logs
+    the throughput every ``interval`` seconds.
+
+    :param str action:
+        What is being done to the items, e.g. ``Imported``.
+    :param str unit:
+        What the items are called, e.g. ``rows``.
+    """
+
+    def __init__(self, action, unit, clock=default_reactor, interval=5):
+        self.action = action
+        self.unit = unit
+        self.clock = clock
+        self.interval = interval
+        self.count = 0
+        self.started = None
+        self.last_report = None
+
+    def start(self):
+        self.started = self.last_report = self.clock.seconds()
+
+    def elapsed(self):
+        return self.clock.seconds() - self.started
+
+    def rate(self):
+        elapsed = self.elapsed()
+        if not elapsed:
+            return 0.0
+        return self.count / elapsed
+
+    def update(self, count):
+        self.count += count
+        if self.clock.seconds() - self.last_report >= self.interval:
+            self.last_report = self.clock.seconds()
+            self.report()
+        return count
+
+    def report(self):
+        log.msg('%s %d %s (%.1f %s/sec).' % (
+            self.action, self.count, self.unit, self.rate(), self.unit))
+
+    def finish(self):
+        log.msg('Finished: %s %d %s in %.1f seconds (%.1f %s/sec).' % (
+            self.action.lower(), self.count, self.unit, self.elapsed(),
+            self.rate(), self.unit))
+        return self.count
+
+
+def parse_redis_uri(redis_uri):
+    """
+    Parse ``redis://[:password@]hostname[:port]/db`` or
+    ``unix://[:password@]/path/to/redis.sock[?db=db]`` into the keyword
+    arguments for a txredisapi connection.
+    """
     try:
         url = urlparse(redis_uri)
     except (AttributeError, TypeError):
         raise PortiaException('Invalid url: %s.' % (redis_uri,))
 
-    if not url.hostname:
-        raise PortiaException('Missing Redis hostname.')
+    if url.scheme == 'unix':
+        path = url.path
+        if not path and url.netloc:
+            path = url.netloc.rpartition('@')[2]
+        if not path:
+            raise PortiaException('Missing Redis socket path.')
+        db = parse_qs(url.query).get('db', ['0'])[0]
+        config = {'path': path}
+    else:
+        if not url.hostname:
+            raise PortiaException('Missing Redis hostname.')
+        db = url.path[1:]
+        config = {'host': url.hostname, 'port': int(url.port or 6379)}
 
     try:
-        int(url.path[1:])
-    except (IndexError, ValueError):
+        config['dbid'] = int(db)
+    except ValueError:
         raise PortiaException('Invalid Redis db index.')
 
-    return Connection(url.hostname, int(url.port or 6379),
-                      dbid=int(url.path[1:]))
+    config['password'] = url.password
+    return config
+
+
+def start_redis(redis_uri='redis://localhost:6379/1', pool_size=1,
+                lazy=False, connect_timeout=None, command_timeout=None):
+    """
+    Connect to Redis with a pool of ``pool_size`` connections, commands
+    are sent over whichever connection is free. A lazy pool connects in
+    the background and holds commands until a connection is made.
+    Fires with the connection handler.
+    """
+    config = parse_redis_uri(redis_uri)
+    kwargs = {
+        'dbid': config['dbid'],
+        'poolsize': pool_size,
+        'password': config['password'],
+        'connectTimeout': connect_timeout,
+        'replyTimeout': command_timeout,
+    }
+
+    if 'path' in config:
+        connect = lazyUnixConnectionPool if lazy else UnixConnectionPool
+        handler = connect(config['path'], **kwargs)
+    else:
+        connect = lazyConnectionPool if lazy else ConnectionPool
+        handler = connect(config['host'], config['port'], **kwargs)
+
+    if lazy:
+        return succeed(handler)
+    return handler
+
+
+def socket_family(fd):
+    """
+    Return the address family of the socket open on ``fd``.
+    """
+    address = socket.fromfd(
+        fd, socket.AF_INET, socket.SOCK_STREAM).getsockname()
+    if isinstance(address, basestring):
+        return socket.AF_UNIX
+    if len(address) == 4:
+        return socket.AF_INET6
+    return socket.AF_INET
 
 
-def start_webserver(portia, endpoint_str, cors=None, reactor=default_reactor):
+def listen(factory, endpoint_str, reactor=default_reactor, fd=None):
+    """
+    Listen on ``endpoint_str``, or adopt the listening socket already
+    open on ``fd`` if given.
+    """
+    if fd is not None:
+        return succeed(reactor.adoptStreamPort(fd, socket_family(fd), factory))
     endpoint = serverFromString(reactor, str(endpoint_str))
-    return endpoint.listen(
-        Site(PortiaWebServer(portia, cors=cors).app.resource()))
+    return endpoint.listen(factory)
 
 
-def start_tcpserver(portia, endpoint_str, reactor=default_reactor):
+def listen_shared(endpoint_str, reactor=default_reactor):
+    """
+    Listen on ``endpoint_str`` without accepting any connections so the
+    socket can be handed to worker processes. Fires with the port.
+    """
     endpoint = serverFromString(reactor, str(endpoint_str))
-    return endpoint.listen(JsonProtocolFactory(portia))
+    d = endpoint.listen(ServerFactory())
+
+    def stop_reading(port):
+        port.stopReading()
+        return port
+
+    return d.addCallback(stop_reading)
+
+
+def start_webserver(portia, endpoint_str, cors=None, reactor=default_reactor,
+                    max_batch_size=10000, metrics=None, fd=None):
+    return listen(
+        Site(PortiaWebServer(
+            portia, cors=cors, max_batch_size=max_batch_size,
+            metrics=metrics).app.resource()),
+        endpoint_str, reactor=reactor, fd=fd)
+
+
+def start_tcpserver(portia, endpoint_str, reactor=default_reactor,
+                    metrics=None, fd=None, max_in_flight=100):
+    return listen(
+        JsonProtocolFactory(
+            portia, metrics=metrics, max_in_flight=max_in_flight),
+        endpoint_str, reactor=reactor, fd=fd)
 
 
 def compile_network_prefix_mappings(glob_paths):
-    mapping = {}
+    mappings = []
     for glob_path in glob_paths:
         for mapping_file in glob(glob_path):
             if not os.path.isfile(mapping_file):
@@ -53,5 +228,14 @@ def compile_network_prefix_mappings(glob_paths):
 
             log.msg('Loading mapping file: %s.' % (mapping_file,))
             with open(mapping_file) as fp:
-                mapping.update(json.load(fp))
-    return mapping
+                mappings.append(json.load(fp))
+
+    trie = NetworkPrefixTrie(mappings)
+    for prefix, previous, network in trie.conflicts:
+        log.msg('Conflicting network prefix %s: %s replaced by %s.' % (
+            prefix, previous, network))
+    for parent, prefix in trie.shadowed:
+        log.msg('Network prefix %s is not nested under %s.' % (
+            prefix, parent))
+    log.msg('Compiled %d network prefixes.' % (len(trie),))
+    return trie
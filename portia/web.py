@@ -1,12 +1,18 @@
+import calendar
+import hashlib
 import json
 import phonenumbers
 from functools import wraps
 
+import dateutil.parser
+
 from twisted.internet import reactor
+from twisted.web import http
 
 from klein import Klein
 
-from .exceptions import PortiaException
+from .exceptions import PortiaException, ReadOnlyStorageException
+from .metrics import timed_route
 
 
 def validate_key(func):
@@ -29,15 +35,21 @@ class PortiaWebServer(object):
 
     :param txredisapi.Connection redis:
         The txredis connection
+    :param portia.metrics.Metrics metrics:
+        Where to record request metrics, ``None`` disables them and the
+        ``/metrics`` endpoint.
     """
 
     app = Klein()
     clock = reactor
     timeout = 5
 
-    def __init__(self, portia, cors=None):
+    def __init__(self, portia, cors=None, max_batch_size=10000,
+                 metrics=None):
         self.portia = portia
         self.cors = cors
+        self.max_batch_size = max_batch_size
+        self.metrics = metrics
 
     def default_headers(self, request):
         request.setHeader('Content-Type', 'application/json')
@@ -46,35 +58,199 @@ class PortiaWebServer(object):
                 'Access-Control-Allow-Origin',
                 self.cors)
 
+    def include_entry(self, request):
+        """
+        Whether the full entry should be included in resolve results,
+        ``?entry=false`` leaves it out and only fetches what is needed
+        to resolve the network.
+        """
+        value = request.args.get('entry', ['true'])[0]
+        return value.lower() not in ('false', '0', 'no')
+
+    def is_conditional(self, request):
+        return (request.getHeader('If-None-Match') is not None or
+                request.getHeader('If-Modified-Since') is not None)
+
+    def not_modified(self, request, timestamps):
+        """
+        Set the ``ETag`` and ``Last-Modified`` headers for an entry whose
+        annotations have ``timestamps`` and return whether the client's
+        copy is still current.
+
+        The ETag covers every annotation's key and timestamp, so it
+        changes with every write and delete. ``Last-Modified`` is the
+        newest annotation timestamp, which is when the annotation was
+        made rather than when it was stored.
+        """
+        etag = '"%s"' % (hashlib.md5(
+            json.dumps(sorted(timestamps.items()))).hexdigest(),)
+        request.setHeader('ETag', etag)
+        last_modified = None
+        if timestamps:
+            last_modified = calendar.timegm(dateutil.parser.parse(
+                max(timestamps.values())).utctimetuple())
+            request.setHeader(
+                'Last-Modified', http.datetimeToString(last_modified))
+
+        if_none_match = request.getHeader('If-None-Match')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or etag in [
+                tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+        if_modified_since = request.getHeader('If-Modified-Since')
+        if if_modified_since is not None and last_modified is not None:
+            try:
+                since = http.stringToDatetime(if_modified_since)
+            except ValueError:
+                return False
+            return last_modified <= since
+        return False
+
+    def entry_timestamps(self, entry):
+        return dict(
+            (key[:-len('-timestamp')], timestamp)
+            for key, timestamp in entry.iteritems()
+            if key.endswith('-timestamp'))
+
+    def conditional_get(self, request, phonenumber, fetch, fresh,
+                        timestamps, entry=True):
+        """
+        Answer a GET for ``phonenumber`` with the JSON of what ``fetch``
+        fires with, or a 304 if the client's copy is current.
+
+        Conditional requests look up only the annotation timestamps
+        first. If the entry changed the response comes from ``fresh``,
+        which reads the whole entry from Redis rather than the resolve
+        cache, because another process may have written since the result
+        was cached. Validators are always worked out by ``timestamps``
+        from the data they are sent with. Without ``entry`` the entry is
+        left out of the response, and unconditional responses carry no
+        validators since there is nothing to work them out from.
+        """
+        def respond(data):
+            if self.not_modified(request, timestamps(data)):
+                request.setResponseCode(http.NOT_MODIFIED)
+                return ''
+            if not entry:
+                data = self.portia.without_entry(data)
+            return json.dumps(data)
+
+        def check(stored):
+            if self.not_modified(request, stored):
+                request.setResponseCode(http.NOT_MODIFIED)
+                return ''
+            d = fresh()
+            d.addCallback(respond)
+            return d
+
+        if self.is_conditional(request):
+            d = self.portia.get_timestamps(phonenumber)
+            d.addCallback(check)
+            return d
+
+        d = fetch()
+        d.addCallback(respond if entry else json.dumps)
+        return d
+
     @app.route('/resolve/<msisdn>', methods=['GET'])
+    @timed_route('resolve')
     def resolve(self, request, msisdn):
-        phonenumber = phonenumbers.parse(msisdn)
+        phonenumber = self.portia.parse(msisdn)
         self.default_headers(request)
-        d = self.portia.resolve(phonenumber)
-        d.addCallback(lambda data: json.dumps(data))
+        entry = self.include_entry(request)
+        return self.conditional_get(
+            request, phonenumber,
+            lambda: self.portia.resolve(phonenumber, entry=entry),
+            lambda: self.portia.resolve_uncached(phonenumber),
+            lambda data: self.entry_timestamps(data['entry']),
+            entry=entry)
+
+    @app.route('/resolve', methods=['POST'])
+    @timed_route('resolve_many')
+    def resolve_many(self, request):
+        content = request.content.read()
+        self.default_headers(request)
+        ndjson = (request.getHeader('Content-Type') or '').startswith(
+            'application/x-ndjson')
+
+        try:
+            if ndjson:
+                msisdns = [json.loads(line) for line in content.splitlines()
+                           if line.strip()]
+            else:
+                msisdns = json.loads(content)
+        except ValueError:
+            request.setResponseCode(400)
+            return json.dumps('Invalid JSON supplied')
+
+        if not isinstance(msisdns, list):
+            request.setResponseCode(400)
+            return json.dumps('Expected a list of MSISDNs')
+
+        if (self.max_batch_size is not None and
+                len(msisdns) > self.max_batch_size):
+            request.setResponseCode(413)
+            return json.dumps(
+                'Too many MSISDNs supplied, the maximum is %s' % (
+                    self.max_batch_size,))
+
+        results = []
+        phonenumbers_ = []
+        for msisdn in msisdns:
+            try:
+                if not isinstance(msisdn, basestring):
+                    raise PortiaException(
+                        'Invalid MSISDN: %s' % (json.dumps(msisdn),))
+                phonenumbers_.append(self.portia.parse(msisdn))
+                results.append(None)
+            except (PortiaException, phonenumbers.NumberParseException), e:
+                results.append({'msisdn': msisdn, 'error': str(e)})
+
+        def merge(resolved):
+            resolved = iter(resolved)
+            return [result if result is not None else next(resolved)
+                    for result in results]
+
+        def encode(results):
+            if ndjson:
+                request.setHeader('Content-Type', 'application/x-ndjson')
+                return ''.join('%s\n' % (json.dumps(result),)
+                               for result in results)
+            return json.dumps(results)
+
+        d = self.portia.resolve_many(
+            phonenumbers_, entry=self.include_entry(request))
+        d.addCallback(merge)
+        d.addCallback(encode)
         return d
 
     @app.route('/entry/<msisdn>', methods=['GET'])
+    @timed_route('get_annotations')
     def get_annotations(self, request, msisdn):
-        phonenumber = phonenumbers.parse(msisdn)
+        phonenumber = self.portia.parse(msisdn)
         self.default_headers(request)
-        d = self.portia.get_annotations(phonenumber)
-        d.addCallback(lambda data: json.dumps(data))
-        return d
+        return self.conditional_get(
+            request, phonenumber,
+            lambda: self.portia.get_annotations(phonenumber),
+            lambda: self.portia.get_annotations(phonenumber),
+            self.entry_timestamps)
 
     @app.route('/entry/<msisdn>/<key>', methods=['GET'])
+    @timed_route('read_annotation')
     @validate_key
     def read_annotation(self, request, msisdn, key):
-        phonenumber = phonenumbers.parse(msisdn)
+        phonenumber = self.portia.parse(msisdn)
         self.default_headers(request)
         d = self.portia.read_annotation(phonenumber, key)
         d.addCallback(lambda data: json.dumps(data))
         return d
 
     @app.route('/entry/<msisdn>/<key>', methods=['PUT'])
+    @timed_route('annotate')
     @validate_key
     def annotate(self, request, msisdn, key):
-        phonenumber = phonenumbers.parse(msisdn)
+        phonenumber = self.portia.parse(msisdn)
         content = request.content.read()
         self.default_headers(request)
 
@@ -82,6 +258,20 @@ class PortiaWebServer(object):
             request.setResponseCode(400)
             return json.dumps('No content supplied')
 
+        def read_only(failure):
+            failure.trap(ReadOnlyStorageException)
+            request.setResponseCode(405)
+            return json.dumps(str(failure.value))
+
         d = self.portia.annotate(phonenumber, key, content, self.portia.now())
         d.addCallback(lambda _: json.dumps(content))
+        d.addErrback(read_only)
         return d
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics_text(self, request):
+        if self.metrics is None:
+            request.setResponseCode(404)
+            return json.dumps('Metrics are disabled')
+        request.setHeader('Content-Type', self.metrics.content_type)
+        return self.metrics.render()
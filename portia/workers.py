@@ -0,0 +1,128 @@
+import os
+import sys
+
+from twisted.internet import reactor as default_reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.protocol import ProcessProtocol
+from twisted.python import log
+
+
+class WorkerProcessProtocol(ProcessProtocol):
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.pid = None
+
+    def connectionMade(self):
+        self.pid = self.transport.pid
+
+    def processEnded(self, reason):
+        self.supervisor.worker_ended(self.index, self.pid, reason)
+
+
+class WorkerSupervisor(object):
+    """
+    Runs ``workers`` copies of ``args`` as child processes that inherit
+    the listening sockets in ``fds``, restarting any that exit until
+    ``stop`` is called.
+
+    :param list args:
+        The arguments to run ``executable`` with.
+    :param list fds:
+        The file descriptors to pass on to each worker.
+    :param float restart_delay:
+        Seconds to wait before restarting a worker, doubled for each
+        worker that exits within ``min_uptime`` seconds of starting up to
+        ``max_restart_delay``.
+    """
+
+    def __init__(self, args, workers, fds=(), executable=sys.executable,
+                 env=None, restart_delay=1.0, max_restart_delay=30.0,
+                 min_uptime=10.0, reactor=default_reactor):
+        self.args = args
+        self.workers = workers
+        self.fds = fds
+        self.executable = executable
+        self.env = os.environ.copy() if env is None else env
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.min_uptime = min_uptime
+        self.reactor = reactor
+        self.processes = {}
+        self.started = {}
+        self.failures = {}
+        self.restarts = {}
+        self.stopping = False
+        self.stopped = None
+
+    def start(self):
+        for index in range(self.workers):
+            self.spawn(index)
+
+    def spawn(self, index):
+        self.restarts.pop(index, None)
+        child_fds = {0: 0, 1: 1, 2: 2}
+        for fd in self.fds:
+            child_fds[fd] = fd
+        self.started[index] = self.reactor.seconds()
+        self.processes[index] = self.reactor.spawnProcess(
+            WorkerProcessProtocol(self, index), self.executable,
+            [self.executable] + list(self.args), env=self.env,
+            childFDs=child_fds)
+        log.msg('Started worker %d (pid %s).' % (
+            index, self.processes[index].pid))
+
+    def worker_ended(self, index, pid, reason):
+        self.processes.pop(index, None)
+        log.msg('Worker %d (pid %s) exited: %s' % (
+            index, pid, reason.getErrorMessage()))
+
+        if self.stopping:
+            if not self.processes and self.stopped is not None:
+                self.stopped.callback(None)
+            return
+
+        uptime = self.reactor.seconds() - self.started.pop(index)
+        if uptime < self.min_uptime:
+            self.failures[index] = self.failures.get(index, 0) + 1
+        else:
+            self.failures[index] = 0
+        delay = min(
+            self.max_restart_delay,
+            self.restart_delay * 2 ** max(0, self.failures[index] - 1))
+        log.msg('Restarting worker %d in %.1f seconds.' % (index, delay))
+        self.restarts[index] = self.reactor.callLater(
+            delay, self.spawn, index)
+
+    def signal(self, name):
+        for process in self.processes.values():
+            try:
+                process.signalProcess(name)
+            except ProcessExitedAlready:
+                pass
+
+    def stop(self, timeout=10.0):
+        """
+        Stop restarting workers, ask the running ones to shut down and
+        kill those still running after ``timeout`` seconds. Fires once
+        every worker has exited.
+        """
+        self.stopping = True
+        for delayed in self.restarts.values():
+            delayed.cancel()
+        self.restarts.clear()
+        if not self.processes:
+            return succeed(None)
+
+        self.stopped = Deferred()
+        self.signal('TERM')
+        kill = self.reactor.callLater(timeout, self.signal, 'KILL')
+
+        def cancel_kill(result):
+            if kill.active():
+                kill.cancel()
+            return result
+
+        return self.stopped.addBoth(cancel_kill)
@@ -30,11 +30,17 @@ setup(
     url='https://github.com/praekelt/portia',
     packages=[
         'portia',
+        'portia.benchmarks',
     ],
     package_dir={'portia':
                  'portia'},
+    package_data={'portia': ['assets/mappings/*.json']},
     include_package_data=True,
     install_requires=requirements,
+    extras_require={
+        'msgpack': ['msgpack>=0.6'],
+        'xz': ['backports.lzma'],
+    },
     license="BSD",
     zip_safe=False,
     keywords='portia',